@@ -0,0 +1,141 @@
+import logging
+import shutil
+import threading
+import time
+import zipfile
+from concurrent.futures import as_completed
+
+from telebot import apihelper
+
+MAX_RETRY_AFTER_ATTEMPTS = 5
+# Telegram rejects texts over 4096 characters; leave room for emoji it counts twice
+MAX_PROGRESS_LENGTH = 4000
+PROGRESS_NAMES_SHOWN = 20
+PROGRESS_NAMES_LENGTH = 1500  # per sent/failed line, so long names don't crowd out the failures
+PROGRESS_NOTES_SHOWN = 10
+
+
+def with_retry_after(func, *args, **kwargs):
+    """Calls a Bot API method, sleeping and retrying when Telegram answers 429 with retry_after."""
+    for attempt in range(MAX_RETRY_AFTER_ATTEMPTS):
+        try:
+            return func(*args, **kwargs)
+        except apihelper.ApiTelegramException as e:
+            if e.error_code != 429 or attempt == MAX_RETRY_AFTER_ATTEMPTS - 1:
+                raise
+            retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+            logging.warning(f"Rate limited by Telegram on {getattr(func, '__name__', func)}, retrying in {retry_after}s.")
+            time.sleep(retry_after)
+
+
+def send_batch(executor, items, send, on_done):
+    """Runs send(item) for every item on executor, at most as many at once as it has workers.
+
+    on_done(item, error) is called as each one finishes, error being None on success.
+    """
+    futures = {executor.submit(with_retry_after, send, item): item for item in items}
+    for future in as_completed(futures):
+        on_done(futures[future], future.exception())
+
+
+def write_zip(dest, files, chunk_size=1024 * 1024):
+    """Bundles (open_file, name) pairs into a zip at dest, streaming each file from open_file().
+
+    Entries are stored uncompressed: the point is one send instead of many, and most uploads
+    (archives, photos, videos) would not shrink anyway.
+    """
+    with zipfile.ZipFile(dest, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        seen = set()
+        for open_file, name in files:
+            arcname = name
+            counter = 1
+            while arcname in seen:  # The same name requested twice would otherwise collide
+                counter += 1
+                arcname = f"{counter}_{name}"
+            seen.add(arcname)
+            with open_file() as src, zf.open(arcname, 'w', force_zip64=True) as dst:
+                shutil.copyfileobj(src, dst, chunk_size)
+
+
+def recent(names, shown=PROGRESS_NAMES_SHOWN, max_length=PROGRESS_NAMES_LENGTH):
+    """Joins the last names that fit in shown entries and max_length characters, counting the rest."""
+    kept = []
+    length = 0
+    for name in reversed(names):
+        if len(kept) == shown or (kept and length + len(name) + 2 > max_length):
+            break
+        kept.append(name)
+        length += len(name) + 2
+    joined = ', '.join(reversed(kept))[:max_length]
+    if len(kept) == len(names):
+        return joined
+    return f"{len(names) - len(kept)} earlier, then {joined}"
+
+
+class BatchProgress:
+    """One status message for a batch transfer, edited in place instead of a reply per file."""
+
+    def __init__(self, bot, message, title, total, min_interval=1.0):
+        self.bot = bot
+        self.title = title
+        self.total = total
+        self.min_interval = min_interval  # edits are rate limited by Telegram too
+        self.lock = threading.Lock()
+        self.edit_lock = threading.Lock()
+        self.sent = []
+        self.failed = []
+        self.notes = []
+        self.last_text = None
+        self.last_edit = 0.0
+        self.status = with_retry_after(bot.reply_to, message, self.render())
+        self.last_text = self.status.text
+
+    def add_note(self, note):
+        with self.lock:
+            self.notes.append(note)
+
+    def done(self, name, error=None):
+        with self.lock:
+            if error is None:
+                self.sent.append(name)
+            else:
+                self.failed.append(f"{name} ({error})")
+        self.refresh()
+
+    def render(self):
+        # Large batches only show their latest names and notes, so the text stays within one message
+        lines = [f"📥 {self.title}: {len(self.sent) + len(self.failed)}/{self.total} done"]
+        if self.sent:
+            lines.append(f"✅ Sent: {recent(self.sent)}")
+        if self.failed:
+            lines.append(f"❌ Failed: {recent(self.failed)}")
+        if len(self.notes) > PROGRESS_NOTES_SHOWN:
+            lines.append(f"… {len(self.notes) - PROGRESS_NOTES_SHOWN} earlier notes")
+        lines.extend(self.notes[-PROGRESS_NOTES_SHOWN:])
+        text = "\n".join(lines)
+        if len(text) > MAX_PROGRESS_LENGTH:  # long file names can still overflow
+            text = text[:MAX_PROGRESS_LENGTH - 1] + "…"
+        return text
+
+    def refresh(self, force=False):
+        # One edit at a time so an older text never lands after a newer one; skip if one is already going
+        if not self.edit_lock.acquire(blocking=force):
+            return
+        try:
+            with self.lock:
+                now = time.monotonic()
+                if not force and now - self.last_edit < self.min_interval:
+                    return
+                text = self.render()
+                if text == self.last_text:
+                    return  # Telegram rejects edits that change nothing
+                self.last_text = text
+                self.last_edit = now
+            with_retry_after(self.bot.edit_message_text, text, self.status.chat.id, self.status.message_id)
+        except apihelper.ApiTelegramException as e:
+            logging.warning(f"Could not update progress message: {e.description}")
+        except Exception as e:
+            # Best effort: a network error here must not fail (and re-run) the transfer being reported
+            logging.warning(f"Could not update progress message: {str(e)}")
+        finally:
+            self.edit_lock.release()
@@ -0,0 +1,102 @@
+"""Measures what compression at rest costs in CPU against the disk space it saves, per kind of content.
+
+    python benchmarks/bench_compression.py --size-mb 32 --levels 1 6 9
+
+Each sample is streamed through the same writer uploads use, in 1 MB chunks, then read back
+the way downloads read it. CPU time is process time, so the numbers hold on a busy machine too.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from compression import CompressingWriter, open_blob  # noqa: E402
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def log_lines(rng, size):
+    levels = ['INFO', 'INFO', 'INFO', 'WARNING', 'ERROR']
+    lines = []
+    total = 0
+    while total < size:
+        line = (f"2026-10-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00 "
+                f"{rng.choice(levels)} chat={rng.randint(1000, 9999)} File {rng.randint(1, 100000)} "
+                f"sent in {rng.random() * 5:.2f}s\n")
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines).encode()[:size]
+
+
+def json_records(rng, size):
+    records = []
+    total = 0
+    while total < size:
+        record = json.dumps({'id': rng.randint(1, 10 ** 9), 'name': f'file_{rng.randint(1, 10 ** 6)}.pdf',
+                             'size': rng.randint(1, 50_000_000), 'owner': rng.choice(['alice', 'bob', 'carol'])})
+        records.append(record)
+        total += len(record) + 1
+    return '\n'.join(records).encode()[:size]
+
+
+def random_bytes(rng, size):
+    return rng.randbytes(size)  # stands in for encrypted archives and anything else the magic numbers miss
+
+
+def jpeg_like(rng, size):
+    return b'\xff\xd8\xff\xe0' + rng.randbytes(size - 4)
+
+
+KINDS = {'logs': log_lines, 'json': json_records, 'random': random_bytes, 'jpeg': jpeg_like}
+
+
+def measure(data, level, directory):
+    path = os.path.join(directory, 'blob')
+    started = time.process_time()
+    with open(path, 'wb') as f:
+        writer = CompressingWriter(f, level)
+        for offset in range(0, len(data), CHUNK_SIZE):
+            writer.write(data[offset:offset + CHUNK_SIZE])
+        writer.finish()
+    write_cpu = time.process_time() - started
+
+    started = time.process_time()
+    with open_blob(path, writer.compressed) as f:
+        while f.read(CHUNK_SIZE):
+            pass
+    read_cpu = time.process_time() - started
+    return writer.compressed, os.path.getsize(path), write_cpu, read_cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=32, help='size of each sample')
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 6, 9])
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    size = args.size_mb * 1024 * 1024
+    directory = tempfile.mkdtemp(prefix='vortxtra-compression-')
+    print(f"{'content':8} {'level':>5} {'stored':>8} {'on disk':>10} {'saved MB':>9} "
+          f"{'write CPU s/GB':>15} {'read CPU s/GB':>14} {'CPU s per GB saved':>19}")
+    for kind, make in KINDS.items():
+        data = make(rng, size)
+        for level in args.levels:
+            compressed, stored, write_cpu, read_cpu = measure(data, level, directory)
+            saved = size - stored
+            per_gb = 1024 ** 3 / size
+            per_saved = f"{(write_cpu + read_cpu) * 1024 ** 3 / saved:19.1f}" if saved > 0 else f"{'-':>19}"
+            print(f"{kind:8} {level:5} {'gzip' if compressed else 'as is':>8} {stored / size:9.1%} "
+                  f"{saved / 1024 ** 2:9.1f} {write_cpu * per_gb:15.2f} {read_cpu * per_gb:14.2f} {per_saved}")
+    os.remove(os.path.join(directory, 'blob'))
+    os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Measures command latency while uploads are in flight, against the local fake Bot API.
+
+    python benchmarks/bench_dispatch.py --workers 8 --uploads 4
+    python benchmarks/bench_dispatch.py --workers 1 --uploads 4   # a single dispatcher thread
+
+The uploads themselves run on the job queue's workers (JOB_WORKERS), whatever --workers is, so
+this mostly shows what the dispatcher threads cost the commands besides.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotAPI, TOKEN  # noqa: E402
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def load_bot(api, workers):
+    """Imports bot.py inside a scratch directory so uploads and bot.log stay out of the repo."""
+    os.chdir(tempfile.mkdtemp(prefix='vortxtra-bench-'))
+    os.environ.update({'TOKEN': TOKEN, 'user': 'bench', 'password': 'bench', 'WORKER_THREADS': str(workers)})
+    # The fake API has no rate limits; a benchmark can still set these to measure the limiter
+    for name in ('COMMAND_RATE', 'SEND_GLOBAL_RATE', 'SEND_CHAT_RATE'):
+        os.environ.setdefault(name, '1000000')
+    api.install()
+    import bot
+    bot.start_services()  # as bot.py's main does; uploads and downloads wait in the queue until then
+    return bot
+
+
+class ReplyWaiter:
+    """Lets a benchmark thread block until the bot answers in a given chat."""
+
+    def __init__(self, api):
+        self.cond = threading.Condition()
+        self.replies = {}
+        api.on_reply(self._on_reply)
+
+    def _on_reply(self, timestamp, method, params):
+        chat_id = int(params.get('chat_id', 0) or 0)
+        with self.cond:
+            self.replies.setdefault(chat_id, []).append((timestamp, method, params))
+            self.cond.notify_all()
+
+    def wait(self, chat_id, count=1, timeout=300):
+        deadline = time.time() + timeout
+        with self.cond:
+            while len(self.replies.get(chat_id, [])) < count:
+                if not self.cond.wait(deadline - time.time()):
+                    raise TimeoutError(f"no reply in chat {chat_id}")
+            return self.replies[chat_id][count - 1]
+
+    def count(self, chat_id):
+        with self.cond:
+            return len(self.replies.get(chat_id, []))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=8, help='WORKER_THREADS for the bot')
+    parser.add_argument('--uploads', type=int, default=4, help='concurrent uploads kept in flight')
+    parser.add_argument('--size-mb', type=float, default=20, help='size of each upload')
+    parser.add_argument('--bandwidth-mb', type=float, default=20, help='fake file endpoint bandwidth in MB/s')
+    parser.add_argument('--commands', type=int, default=50, help='/list commands per command chat')
+    parser.add_argument('--command-chats', type=int, default=4)
+    args = parser.parse_args()
+
+    api = FakeBotAPI(bandwidth=args.bandwidth_mb * 1024 * 1024).start()
+    bot = load_bot(api, args.workers)
+    waiter = ReplyWaiter(api)
+    threading.Thread(target=bot.bot.polling, kwargs={'non_stop': True, 'timeout': 30}, daemon=True).start()
+
+    upload_chats = [1000 + i for i in range(args.uploads)]
+    command_chats = [2000 + i for i in range(args.command_chats)]
+    for chat_id in upload_chats + command_chats:
+        api.push_message(chat_id, '/login bench bench')
+    for chat_id in upload_chats + command_chats:
+        waiter.wait(chat_id)
+
+    # Keep every upload chat busy for the whole run
+    stop = threading.Event()
+    upload_size = int(args.size_mb * 1024 * 1024)
+
+    def uploader(chat_id):
+        n = 0
+        while not stop.is_set():
+            n += 1
+            seen = waiter.count(chat_id)
+            api.push_document(chat_id, f'bench-{chat_id}-{n}.bin', f'docs/{chat_id}-{n}.bin', upload_size)
+            waiter.wait(chat_id, seen + 2)  # "upload started" + "uploaded successfully"
+
+    latencies = []
+    lock = threading.Lock()
+
+    def commander(chat_id):
+        for _ in range(args.commands):
+            seen = waiter.count(chat_id)
+            start = time.time()
+            api.push_message(chat_id, '/list')
+            replied_at, _, _ = waiter.wait(chat_id, seen + 1)
+            with lock:
+                latencies.append(replied_at - start)
+
+    uploaders = [threading.Thread(target=uploader, args=(c,), daemon=True) for c in upload_chats]
+    commanders = [threading.Thread(target=commander, args=(c,)) for c in command_chats]
+    for t in uploaders:
+        t.start()
+    time.sleep(0.2)  # let the first uploads get going
+    started = time.time()
+    for t in commanders:
+        t.start()
+    for t in commanders:
+        t.join()
+    elapsed = time.time() - started
+    stop.set()
+
+    print(f"workers={args.workers} uploads_in_flight={args.uploads} size={args.size_mb}MB "
+          f"bandwidth={args.bandwidth_mb}MB/s")
+    print(f"/list commands: {len(latencies)} in {elapsed:.2f}s")
+    print(f"  p50 latency: {percentile(latencies, 50) * 1000:.1f} ms")
+    print(f"  p99 latency: {percentile(latencies, 99) * 1000:.1f} ms")
+    print(f"  max latency: {max(latencies) * 1000:.1f} ms")
+
+    bot.bot.stop_polling()
+    api.stop()
+    os._exit(0)  # polling and upload threads are daemons blocked on sockets
+
+
+if __name__ == '__main__':
+    main()
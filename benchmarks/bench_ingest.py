@@ -0,0 +1,143 @@
+"""Replays a burst of updates into the bot and measures updates/sec for long polling versus webhook.
+
+    python benchmarks/bench_ingest.py --mode both --updates 5000
+    python benchmarks/bench_ingest.py --mode webhook --concurrency 16 --duplicates 0.1
+    python benchmarks/bench_ingest.py --mode polling --record updates.jsonl
+
+By default every update is a /list from a chat that is not logged in, which the bot answers
+with exactly one message. A --record file holds one Telegram update (JSON) per line and should
+keep to that too, since the run ends when every distinct update has been answered.
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_dispatch import ReplyWaiter, load_bot  # noqa: E402
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def load_updates(api, args):
+    if args.record:
+        with open(args.record) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    return [api.make_update(3000 + i % args.chats, '/list') for i in range(args.updates)]
+
+
+def wait_for_replies(waiter, chats, expected, timeout=300):
+    deadline = time.time() + timeout
+    with waiter.cond:
+        while sum(len(waiter.replies.get(chat, [])) for chat in chats) < expected:
+            if not waiter.cond.wait(deadline - time.time()):
+                raise TimeoutError("the bot stopped answering")
+        return max(timestamp for chat in chats for timestamp, _, _ in waiter.replies.get(chat, []))
+
+
+def post_updates(url, secret, bodies, concurrency):
+    """POSTs the bodies over concurrency keep-alive connections, like Telegram's max_connections."""
+    host, port = url.split('//', 1)[1].split('/', 1)[0].split(':')
+    path = '/' + url.split('//', 1)[1].split('/', 1)[1]
+    headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': secret}
+    statuses = {}
+    lock = threading.Lock()
+
+    def sender(chunk):
+        conn = http.client.HTTPConnection(host, int(port), timeout=30)
+        for body in chunk:
+            conn.request('POST', path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            with lock:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+        conn.close()
+
+    threads = [threading.Thread(target=sender, args=(bodies[i::concurrency],)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return statuses
+
+
+def run(args):
+    api = FakeBotAPI(latency=args.latency_ms / 1000).start()
+    port = free_port()
+    os.environ.update({'UPDATE_MODE': args.mode, 'PORT': str(port), 'KEEP_ALIVE_HOST': '127.0.0.1',
+                       'WEBHOOK_URL': f'http://127.0.0.1:{port}'})
+    bot = load_bot(api, args.workers)
+    waiter = ReplyWaiter(api)
+
+    updates = load_updates(api, args)
+    chats = {update['message']['chat']['id'] for update in updates if 'message' in update}
+    expected = len({update['update_id'] for update in updates})
+
+    if args.mode == 'webhook':
+        bot.start_webhook()
+        url = api.webhook['url']
+        secret = api.webhook['secret_token']
+        bodies = [json.dumps(update).encode() for update in updates]
+        bodies += bodies[:int(len(bodies) * args.duplicates)]  # redeliveries, as after a slow acknowledgement
+        started = time.time()
+        statuses = post_updates(url, secret, bodies, args.concurrency)
+        acked = time.time()
+        finished = wait_for_replies(waiter, chats, expected)
+        detail = (f"POSTs: {len(bodies)} ({statuses}), all acknowledged after {acked - started:.2f}s, "
+                  f"webhook_connections={args.concurrency}")
+    else:
+        threading.Thread(target=bot.bot.polling, kwargs={'non_stop': True, 'timeout': 30}, daemon=True).start()
+        time.sleep(0.5)  # let the first getUpdates start waiting
+        started = time.time()
+        api.push_updates(updates)
+        finished = wait_for_replies(waiter, chats, expected)
+        detail = "getUpdates limit=100 per call"
+
+    time.sleep(0.5)
+    handled = sum(waiter.count(chat) for chat in chats)
+    elapsed = finished - started
+    print(f"mode={args.mode} workers={args.workers} updates={expected} chats={len(chats)} "
+          f"api_latency={args.latency_ms}ms")
+    print(f"  {detail}")
+    print(f"  handled: {handled} replies for {expected} distinct updates in {elapsed:.2f}s")
+    print(f"  throughput: {expected / elapsed:.0f} updates/s")
+    sys.stdout.flush()
+    os._exit(0)  # polling and server threads are daemons blocked on sockets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['polling', 'webhook', 'both'], default='both')
+    parser.add_argument('--updates', type=int, default=2000, help='synthetic updates to replay')
+    parser.add_argument('--chats', type=int, default=200, help='chats the synthetic updates are spread over')
+    parser.add_argument('--record', help='JSON lines file of recorded updates to replay instead')
+    parser.add_argument('--workers', type=int, default=8, help='WORKER_THREADS for the bot')
+    parser.add_argument('--concurrency', type=int, default=8, help='parallel webhook connections')
+    parser.add_argument('--duplicates', type=float, default=0.0, help='fraction of webhook updates delivered twice')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='added to every Bot API call')
+    args = parser.parse_args()
+
+    if args.mode == 'both':
+        # bot.py reads its mode at import, so each mode gets a fresh process
+        for mode in ('polling', 'webhook'):
+            argv = [arg for arg in sys.argv[1:] if arg not in ('both', '--mode', '--mode=both')]
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--mode', mode] + argv, check=True)
+        return
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Measures how long a handler thread spends inside logging calls, old file handler versus the queue pipeline.
+
+    python benchmarks/bench_logging.py
+    python benchmarks/bench_logging.py --threads 8 --calls 5000 --fsync   # slow storage
+
+The old setup is logging.basicConfig(filename='bot.log'): every call formats and writes on the
+calling thread. The new one (log_pipeline.setup_logging) only queues the record there.
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_dispatch import percentile  # noqa: E402
+from log_pipeline import TEXT_FORMAT, clear_context, set_context, setup_logging  # noqa: E402
+
+
+def add_fsync(handler):
+    """Makes every flush wait for the disk, like a log on network or slow storage."""
+    flush = handler.flush
+
+    def flush_and_sync():
+        flush()
+        if handler.stream is not None:
+            os.fsync(handler.stream.fileno())
+
+    handler.flush = flush_and_sync
+
+
+def configure_old(path, fsync):
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    if fsync:
+        add_fsync(handler)
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    return handler.close
+
+
+def configure_new(path, fsync):
+    listener = setup_logging(path, max_bytes=512 * 1024 * 1024, interval=0)
+    if fsync:
+        add_fsync(listener.handlers[0])
+    return listener.stop
+
+
+def run(configure, path, args):
+    finish = configure(path, args.fsync)
+    timings = []
+    lock = threading.Lock()
+
+    def handler_thread(n):
+        local = []
+        set_context(user='bench', chat_id=1000 + n, command='/download')
+        for i in range(args.calls):
+            started = time.perf_counter()
+            logging.info(f"User 'bench' downloaded file 'report-{i}.pdf'.",
+                         extra={'file': f'report-{i}.pdf', 'bytes': 1048576 + i, 'duration': 0.25})
+            local.append(time.perf_counter() - started)
+            if args.pause_ms:
+                time.sleep(args.pause_ms / 1000)  # the rest of the handler: Bot API calls, disk, SQLite
+        clear_context()
+        with lock:
+            timings.extend(local)
+
+    threads = [threading.Thread(target=handler_thread, args=(n,)) for n in range(args.threads)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    in_handlers = time.perf_counter() - started
+    finish()  # the new pipeline drains its queue here
+    drained = time.perf_counter() - started
+    return timings, in_handlers, drained
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=8, help='handler threads logging at once')
+    parser.add_argument('--calls', type=int, default=2000, help='log calls per thread')
+    parser.add_argument('--pause-ms', type=float, default=0.5, help='time between log calls, 0 to log flat out')
+    parser.add_argument('--fsync', action='store_true', help='sync the file after every record')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='vortxtra-logbench-')
+    print(f"threads={args.threads} calls/thread={args.calls} pause={args.pause_ms}ms fsync={args.fsync}")
+    for label, configure in (('file handler (old)', configure_old), ('queue pipeline (new)', configure_new)):
+        path = os.path.join(directory, label.split()[0] + '.log')
+        timings, in_handlers, drained = run(configure, path, args)
+        print(f"{label}:")
+        print(f"  per call: mean {sum(timings) / len(timings) * 1e6:.1f} us, "
+              f"p50 {percentile(timings, 50) * 1e6:.1f} us, p99 {percentile(timings, 99) * 1e6:.1f} us, "
+              f"max {max(timings) * 1e3:.2f} ms")
+        print(f"  handler threads done after {in_handlers:.2f}s, everything on disk after {drained:.2f}s "
+              f"({os.path.getsize(path) / 1024 / 1024:.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Measures inline search latency over a large catalog, one query per keystroke.
+
+    python benchmarks/bench_search.py --files 100000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_dispatch import percentile  # noqa: E402
+from catalog import FileCatalog  # noqa: E402
+from search import FileSearchIndex  # noqa: E402
+
+WORDS = ['report', 'invoice', 'photo', 'scan', 'backup', 'notes', 'draft', 'final', 'budget', 'holiday',
+         'contract', 'résumé', 'slides', 'export', 'archive', 'meeting', 'q1', 'q2', 'q3', 'q4']
+EXTENSIONS = ['.pdf', '.jpg', '.png', '.docx', '.xlsx', '.zip', '.txt', '.mp4']
+
+
+def fill_catalog(catalog, count, rng, owner='bench'):
+    rows = []
+    for i in range(count):
+        name = '_'.join(rng.sample(WORDS, 2)) + f'_{i}' + rng.choice(EXTENSIONS)
+        rows.append((name, rng.randint(1, 50_000_000), time.time(), owner, f'{i:064x}'))
+    with catalog.write() as conn:
+        conn.executemany("INSERT INTO files (name, size, mtime, owner, sha256) VALUES (?, ?, ?, ?, ?)", rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=200, help='typed queries, each measured keystroke by keystroke')
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    catalog = FileCatalog(os.path.join(tempfile.mkdtemp(prefix='vortxtra-search-'), 'catalog.db'))
+    fill_catalog(catalog, args.files, rng)
+    index = FileSearchIndex(catalog)
+
+    started = time.perf_counter()
+    index.search('warm-up')
+    print(f"files={args.files}: index built in {time.perf_counter() - started:.2f}s")
+
+    timings = []
+    for _ in range(args.queries):
+        typed = rng.choice([rng.choice(WORDS), f'{rng.choice(WORDS)}_{rng.choice(WORDS)}',
+                            str(rng.randrange(args.files)), rng.choice(EXTENSIONS)])
+        for end in range(1, len(typed) + 1):
+            started = time.perf_counter()
+            index.search(typed[:end])
+            timings.append(time.perf_counter() - started)
+    print(f"{len(timings)} keystrokes: p50 {percentile(timings, 50) * 1000:.2f} ms, "
+          f"p99 {percentile(timings, 99) * 1000:.2f} ms, max {max(timings) * 1000:.2f} ms")
+
+    started = time.perf_counter()
+    for i in range(1000):
+        catalog.rename(i + 1, f'renamed_{i}.bin')
+    print(f"incremental update: {(time.perf_counter() - started) / 1000 * 1000:.2f} ms per rename (including SQLite)")
+
+
+if __name__ == '__main__':
+    main()
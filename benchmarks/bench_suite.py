@@ -0,0 +1,329 @@
+"""Runs scripted workloads through the whole bot against the local fake Bot API and reports, headless.
+
+    python benchmarks/bench_suite.py
+    python benchmarks/bench_suite.py --latency-ms 50 --bandwidth-mb 20 --rate-limit 0.02
+    python benchmarks/bench_suite.py --workloads login_storm list_10k --json results.json
+    python benchmarks/bench_suite.py --baseline results.json    # exits with 1 on a regression
+
+Workloads, run in this order in one bot process:
+
+  login_storm        --logins chats send /login at the same moment
+  list_10k           --list-chats chats each send --lists /list commands (sorts and globs) over --files files
+  parallel_uploads   --uploads chats each upload a --size-mb document at the same moment
+  batched_downloads  --download-chats chats each /download --batch of those files, sent as bytes
+
+Each reports throughput, p50/p99/max latency from the update being queued to the bot's
+answer, the 429s the fake API gave out, and the peak RSS and open file descriptors of the
+process while it ran. Latency, bandwidth and 429s are injected by the fake API; the bot's own
+rate limits are lifted unless set in the environment. Exit status: 0 ok, 1 a regression
+against --baseline, 2 a workload had errors or timed out.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import psutil  # noqa: E402
+
+from bench_dispatch import ReplyWaiter, load_bot, percentile  # noqa: E402
+from bench_search import fill_catalog  # noqa: E402
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+WORKLOADS = ('login_storm', 'list_10k', 'parallel_uploads', 'batched_downloads')
+LIST_QUERIES = ['/list', '/list size desc', '/list date', '/list name report*', '/list *.pdf', '/list id desc']
+UPLOADED = re.compile(r'uploaded successfully.*\(ID (\d+)\)')
+# Chat ID ranges per workload, so the replies of one never count towards another
+LOGIN_CHATS, LIST_CHATS, UPLOAD_CHATS, DOWNLOAD_CHATS = 10_000, 20_000, 30_000, 40_000
+
+
+class ResourceSampler:
+    """Samples the process's RSS and open file descriptors in the background, keeping the peaks."""
+
+    def __init__(self, interval=0.02):
+        self.process = psutil.Process()
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.peak_rss = 0
+        self.peak_fds = 0
+        self.thread = None
+
+    def sample(self):
+        self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+        fds = self.process.num_fds() if hasattr(self.process, 'num_fds') else self.process.num_handles()
+        self.peak_fds = max(self.peak_fds, fds)
+
+    def __enter__(self):
+        self.sample()
+        self.thread = threading.Thread(target=self._run, name='sampler', daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+        self.sample()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+
+class Suite:
+    def __init__(self, api, bot, args):
+        self.api = api
+        self.bot = bot
+        self.args = args
+        self.waiter = ReplyWaiter(api)
+        self.logged_in = set()
+        self.uploaded = []  # (file ID, size) of the files parallel_uploads stored
+
+    # -- helpers ---------------------------------------------------------------
+
+    def wait_for(self, chat_id, start, done):
+        """Time of the first reply in chat_id after the first start ones for which done(method, params) holds."""
+        deadline = time.time() + self.args.timeout
+        with self.waiter.cond:
+            index = start
+            while True:
+                replies = self.waiter.replies.get(chat_id, [])
+                for timestamp, method, params in replies[index:]:
+                    if done(method, params):
+                        return timestamp, params
+                index = len(replies)
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.waiter.cond.wait(remaining):
+                    raise TimeoutError(f"no matching reply in chat {chat_id}")
+
+    def ask(self, chat_id, text=None, document=None, done=lambda method, params: True):
+        """Queues a message and waits for the reply done() accepts. Returns (latency, that reply's params)."""
+        seen = self.waiter.count(chat_id)
+        started = time.time()
+        if document is not None:
+            self.api.push_document(chat_id, *document)
+        else:
+            self.api.push_message(chat_id, text)
+        replied_at, params = self.wait_for(chat_id, seen, done)
+        return replied_at - started, params
+
+    def login(self, chats):
+        for chat_id in chats:
+            if chat_id not in self.logged_in:
+                self.ask(chat_id, '/login bench bench')
+                self.logged_in.add(chat_id)
+
+    def in_parallel(self, func, items):
+        """Runs func on every item at once. Returns (results of the calls that worked, number that failed)."""
+        results, errors = [], 0
+        with ThreadPoolExecutor(max_workers=max(1, len(items))) as executor:
+            for future in [executor.submit(func, item) for item in items]:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    print(f"  error: {e}", file=sys.stderr)
+                    errors += 1
+        return results, errors
+
+    # -- workloads -------------------------------------------------------------
+    # Each returns (latencies in seconds, operations, bytes transferred, errors)
+
+    def login_storm(self):
+        chats = [LOGIN_CHATS + i for i in range(self.args.logins)]
+        seen = {chat_id: self.waiter.count(chat_id) for chat_id in chats}
+        pushed = {}
+        for chat_id in chats:
+            pushed[chat_id] = time.time()
+            self.api.push_message(chat_id, '/login bench bench')
+        latencies, errors = [], 0
+        for chat_id in chats:
+            try:
+                replied_at, params = self.wait_for(chat_id, seen[chat_id], lambda method, params: True)
+            except TimeoutError:
+                errors += 1
+                continue
+            if 'Welcome' not in params.get('text', ''):
+                errors += 1
+            latencies.append(replied_at - pushed[chat_id])
+            self.logged_in.add(chat_id)
+        return latencies, len(chats), 0, errors
+
+    def list_10k(self):
+        fill_catalog(self.bot.catalog, self.args.files, random.Random(42), owner=None)  # unowned: every chat lists them
+        self.bot.catalog.files_changed(None, None, None)  # the bulk insert bypassed add(); let the caches know
+        chats = [LIST_CHATS + i for i in range(self.args.list_chats)]
+        self.login(chats)
+
+        def client(chat_id):
+            latencies = []
+            for n in range(self.args.lists):
+                latency, params = self.ask(chat_id, LIST_QUERIES[(chat_id + n) % len(LIST_QUERIES)])
+                if not params.get('text', '').startswith('📁 Uploaded files'):
+                    raise RuntimeError(f"unexpected /list reply: {params.get('text')!r}")
+                latencies.append(latency)
+            return latencies
+
+        results, errors = self.in_parallel(client, chats)
+        latencies = [latency for chat_latencies in results for latency in chat_latencies]
+        return latencies, len(latencies), 0, errors
+
+    def parallel_uploads(self):
+        chats = [UPLOAD_CHATS + i for i in range(self.args.uploads)]
+        self.login(chats)
+        size = int(self.args.size_mb * 1024 * 1024)
+        uploaded = lambda method, params: method == 'sendMessage' and UPLOADED.search(params.get('text', ''))
+
+        def upload(chat_id):
+            latency, params = self.ask(chat_id, document=(f'suite-{chat_id}.bin', f'suite/{chat_id}.bin', size),
+                                       done=uploaded)
+            self.uploaded.append((int(UPLOADED.search(params['text']).group(1)), size))
+            return latency
+
+        latencies, errors = self.in_parallel(upload, chats)
+        return latencies, len(latencies), size * len(latencies), errors
+
+    def batched_downloads(self):
+        if not self.uploaded:
+            self.parallel_uploads()  # something to download; not part of this workload's numbers
+        # Forget Telegram's file_ids so every file is sent as bytes instead of by reference, and share
+        # the uploads (each belongs to the user who sent it) with the download chats
+        with self.bot.catalog.write() as conn:
+            conn.execute("DELETE FROM telegram_file_ids")
+            conn.executemany("UPDATE files SET owner = NULL WHERE id = ?", [(file_id,) for file_id, _ in self.uploaded])
+        chats = [DOWNLOAD_CHATS + i for i in range(self.args.download_chats)]
+        self.login(chats)
+
+        def download(chat_id):
+            start = chat_id % len(self.uploaded)
+            batch = [self.uploaded[(start + i) % len(self.uploaded)] for i in range(self.args.batch)]
+            command = '/download ' + ' '.join(str(file_id) for file_id, _ in batch)
+            finished = f"{len(batch)}/{len(batch)} done"
+            latency, params = self.ask(chat_id, command,
+                                       done=lambda method, params: method == 'editMessageText'
+                                       and finished in params.get('text', ''))
+            if '❌' in params['text']:
+                raise RuntimeError(f"download failed: {params['text']!r}")
+            return latency, sum(size for _, size in batch)
+
+        results, errors = self.in_parallel(download, chats)
+        return [latency for latency, _ in results], len(results), sum(size for _, size in results), errors
+
+    def run(self, name):
+        rate_limited = self.api.rate_limited
+        with ResourceSampler() as sampler:
+            started = time.time()
+            latencies, operations, transferred, errors = getattr(self, name)()
+            elapsed = time.time() - started
+        return {
+            'operations': operations,
+            'errors': errors,
+            'seconds': round(elapsed, 3),
+            'throughput': round(operations / elapsed, 2) if elapsed else 0,
+            'mb_per_second': round(transferred / (1024 * 1024) / elapsed, 2) if elapsed and transferred else None,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+            'max_ms': round(max(latencies, default=0) * 1000, 1),
+            'rate_limited': self.api.rate_limited - rate_limited,
+            'peak_rss_mb': round(sampler.peak_rss / (1024 * 1024), 1),
+            'peak_fds': sampler.peak_fds,
+        }
+
+
+def print_report(results):
+    print(f"{'workload':18} {'ops':>6} {'err':>4} {'secs':>7} {'ops/s':>8} {'MB/s':>7} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'max ms':>8} {'429s':>5} {'RSS MB':>7} {'fds':>5}")
+    for name, r in results.items():
+        mb_s = f"{r['mb_per_second']:7.1f}" if r['mb_per_second'] is not None else f"{'-':>7}"
+        print(f"{name:18} {r['operations']:6} {r['errors']:4} {r['seconds']:7.2f} {r['throughput']:8.1f} {mb_s} "
+              f"{r['p50_ms']:8.1f} {r['p99_ms']:8.1f} {r['max_ms']:8.1f} {r['rate_limited']:5} "
+              f"{r['peak_rss_mb']:7.1f} {r['peak_fds']:5}")
+
+
+def regressions(results, baseline, tolerance):
+    """Lines describing where results are worse than baseline by more than tolerance (a fraction)."""
+    found = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        # Latencies get 5 ms of slack on top, so sub-millisecond jitter does not count
+        if r['p99_ms'] > base['p99_ms'] * (1 + tolerance) + 5:
+            found.append(f"{name}: p99 {r['p99_ms']} ms, baseline {base['p99_ms']} ms")
+        if r['throughput'] < base['throughput'] * (1 - tolerance):
+            found.append(f"{name}: {r['throughput']} ops/s, baseline {base['throughput']} ops/s")
+        if r['mb_per_second'] and base.get('mb_per_second') and r['mb_per_second'] < base['mb_per_second'] * (1 - tolerance):
+            found.append(f"{name}: {r['mb_per_second']} MB/s, baseline {base['mb_per_second']} MB/s")
+        if r['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            found.append(f"{name}: peak RSS {r['peak_rss_mb']} MB, baseline {base['peak_rss_mb']} MB")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workloads', nargs='+', choices=WORKLOADS, default=list(WORKLOADS))
+    parser.add_argument('--latency-ms', type=float, default=0, help='added to every fake Bot API call')
+    parser.add_argument('--bandwidth-mb', type=float, default=0, help='fake file transfer bandwidth in MB/s, 0 for unlimited')
+    parser.add_argument('--rate-limit', type=float, default=0, help='share of sends and edits answered with a 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after of the injected 429s')
+    parser.add_argument('--logins', type=int, default=500)
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--list-chats', type=int, default=8)
+    parser.add_argument('--lists', type=int, default=25, help='/list commands per list chat')
+    parser.add_argument('--uploads', type=int, default=8)
+    parser.add_argument('--size-mb', type=float, default=20)
+    parser.add_argument('--download-chats', type=int, default=4)
+    parser.add_argument('--batch', type=int, default=4, help='files per /download')
+    parser.add_argument('--workers', type=int, default=8, help='WORKER_THREADS for the bot')
+    parser.add_argument('--job-workers', type=int, default=4, help='JOB_WORKERS for the bot')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for any one reply')
+    parser.add_argument('--json', help='write the results here, e.g. to use as a later --baseline')
+    parser.add_argument('--baseline', help='results of an earlier --json run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='how much worse than the baseline counts')
+    args = parser.parse_args()
+
+    api = FakeBotAPI(latency=args.latency_ms / 1000, bandwidth=args.bandwidth_mb * 1024 * 1024 or None,
+                     rate_limit=args.rate_limit, retry_after=args.retry_after).start()
+    os.environ['JOB_WORKERS'] = str(args.job_workers)
+    bot = load_bot(api, args.workers)
+    threading.Thread(target=bot.bot.polling, kwargs={'non_stop': True, 'timeout': 30}, daemon=True).start()
+    suite = Suite(api, bot, args)
+
+    print(f"latency={args.latency_ms}ms bandwidth={args.bandwidth_mb or 'unlimited'}MB/s "
+          f"rate_limit={args.rate_limit} workers={args.workers} job_workers={args.job_workers}")
+    results = {}
+    for name in WORKLOADS:
+        if name in args.workloads:
+            results[name] = suite.run(name)
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+    status = 2 if any(r['errors'] for r in results.values()) else 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        changed = [name for name in ('latency_ms', 'bandwidth_mb', 'rate_limit', 'size_mb', 'workers', 'job_workers')
+                   if baseline['settings'].get(name) != getattr(args, name)]
+        if changed:
+            print(f"warning: the baseline ran with different {', '.join(changed)}")
+        found = regressions(results, baseline['results'], args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found and not status:
+            status = 1
+
+    bot.bot.stop_polling()
+    api.stop()
+    os._exit(status)  # polling and job threads are daemons blocked on sockets
+
+
+if __name__ == '__main__':
+    main()
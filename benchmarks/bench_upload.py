@@ -0,0 +1,96 @@
+"""Compares the old and new upload paths of handle_file against a local HTTP stand-in.
+
+old: a fresh requests.get() per file, 1 KiB iter_content chunks written straight to the target
+new: FileStore.store_download() as the upload jobs run it: the shared retrying session, large
+     chunks, hashed into a temp file that becomes the blob, and the catalog entry added
+
+    python benchmarks/bench_upload.py --size-mb 20 --runs 10
+"""
+import argparse
+import hashlib
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import requests  # noqa: E402
+from requests.adapters import HTTPAdapter  # noqa: E402
+from urllib3.util.retry import Retry  # noqa: E402
+
+from catalog import FileCatalog  # noqa: E402
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from storage import FileStore  # noqa: E402
+from transfer import throughput_mb_s  # noqa: E402
+from usage import UsageTracker  # noqa: E402
+
+
+def old_upload(url, dest_path):
+    started = time.perf_counter()
+    sha256 = hashlib.sha256()
+    file_content = requests.get(url, stream=True)
+    file_content.raise_for_status()
+    with open(dest_path, 'wb') as f:
+        for data in file_content.iter_content(1024):
+            f.write(data)
+            sha256.update(data)
+    return os.path.getsize(dest_path), time.perf_counter() - started
+
+
+def shared_session():
+    # Same settings as bot.get_session_with_retries(), without importing the bot
+    session = requests.Session()
+    retries = Retry(total=5, backoff_factor=1, status_forcelist=[502, 503, 504], allowed_methods=["POST", "GET"])
+    adapter = HTTPAdapter(max_retries=retries, pool_connections=4, pool_maxsize=8)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def report(label, results):
+    sizes = [size for size, _ in results]
+    times = [seconds for _, seconds in results]
+    rates = [throughput_mb_s(size, seconds) for size, seconds in results]
+    print(f"{label:>4}: median {statistics.median(times) * 1000:8.1f} ms  "
+          f"mean {statistics.mean(rates):8.1f} MB/s  ({len(results)} x {sizes[0] / 1024 / 1024:.1f} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=float, default=20)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--chunk-kb', type=int, default=1024, help='chunk size for the new path')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of latency per request')
+    parser.add_argument('--compress-level', type=int, default=0, help="the bot's COMPRESSION_LEVEL for the new path")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(latency=args.latency).start()
+    size = int(args.size_mb * 1024 * 1024)
+    api.add_file('bench.bin', size)
+    url = f"{api.base_url}/file/bot123/bench.bin"
+    workdir = tempfile.mkdtemp(prefix='vortxtra-upload-bench-')
+    dest = os.path.join(workdir, 'bench.bin')
+    session = shared_session()
+    upload_dir = os.path.join(workdir, 'uploads')
+    store = FileStore(upload_dir, FileCatalog(os.path.join(workdir, 'catalog.db')), UsageTracker(upload_dir),
+                      args.compress_level or None)
+
+    old = [old_upload(url, dest) for _ in range(args.runs)]
+    new = []
+    for _ in range(args.runs):
+        started = time.perf_counter()  # the whole call, including moving the blob in and the catalog insert
+        file_id, _, written, _, _ = store.store_download(session, url, 'bench.bin', 'bench', args.chunk_kb * 1024)
+        new.append((written, time.perf_counter() - started))
+        store.delete(file_id)  # so the next run stores the contents again instead of finding a duplicate
+
+    report('old', old)
+    report('new', new)
+    api.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""Regression checks for upload and download jobs, run against the local fake Bot API.
+
+    python benchmarks/check_jobs.py
+
+Prints each check's outcome and exits with 1 if any failed.
+"""
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_dispatch import ReplyWaiter, load_bot  # noqa: E402
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+TIMEOUT = 30
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def wait_for_job(bot, chat_id, description=None, after=None):
+    """Waits for the chat's latest job to finish and returns it.
+
+    With description or after (a job), only a job with that description, or newer than after, counts.
+    """
+    deadline = time.time() + TIMEOUT
+    while time.time() < deadline:
+        recent = bot.jobs.recent(chat_id, 1)
+        if (recent and recent[0]['state'] in ('done', 'failed')
+                and description in (None, recent[0]['description'])
+                and (after is None or recent[0]['id'] > after['id'])):
+            return recent[0]
+        time.sleep(0.05)
+    raise CheckFailed(f"the job of chat {chat_id} did not finish within {TIMEOUT}s")
+
+
+def login(api, waiter, chat_id):
+    seen = waiter.count(chat_id)
+    api.push_message(chat_id, '/login bench bench')
+    waiter.wait(chat_id, seen + 1, TIMEOUT)
+
+
+def check_failed_confirmation_stores_once(api, bot, waiter):
+    """An upload whose "uploaded successfully" message fails is not run (and stored) again."""
+    chat_id = 101
+    login(api, waiter, chat_id)
+    seen = waiter.count(chat_id)
+    api.bandwidth = 1024 * 1024  # a second or two of download, so the failure is armed before the job ends
+    try:
+        api.push_document(chat_id, 'x.txt', 'check/x.txt', 2 * 1024 * 1024)
+        waiter.wait(chat_id, seen + 1, TIMEOUT)  # the "queued" reply
+        api.fail_next('sendMessage', 1, 500)
+        job = wait_for_job(bot, chat_id)
+    finally:
+        api.bandwidth = None
+    time.sleep(0.5)  # JOB_BACKOFF is 0.1s here, so a retry would have started
+    entries = [dict(entry) for entry in bot.catalog.list_files() if entry['name'].startswith('x')]
+    if len(entries) != 1 or job['attempts'] != 1:
+        raise CheckFailed(f"expected one stored x.txt after one attempt, got {[e['name'] for e in entries]} "
+                          f"after {job['attempts']} attempts")
+
+
+def check_queued_reply_comes_first(api, bot, waiter):
+    """The "queued" reply to an upload or /download arrives before anything the job sends."""
+    chats = [200 + i for i in range(20)]
+    for chat_id in chats:
+        login(api, waiter, chat_id)
+    seen = {chat_id: waiter.count(chat_id) for chat_id in chats}
+    for chat_id in chats[:10]:
+        api.push_document(chat_id, f'order-{chat_id}.txt', f'check/order-{chat_id}.txt', 1024)
+    for chat_id in chats[:10]:
+        wait_for_job(bot, chat_id)
+    file_id = bot.catalog.named(f'order-{chats[0]}.txt')[0]['id']
+    for chat_id in chats[10:]:
+        api.push_message(chat_id, f'/download {file_id}')
+    for chat_id in chats[10:]:
+        wait_for_job(bot, chat_id)
+    for chat_id in chats:
+        _, _, params = waiter.wait(chat_id, seen[chat_id] + 1, TIMEOUT)
+        if 'queued' not in params.get('text', ''):
+            raise CheckFailed(f"chat {chat_id} first got {params.get('text')!r} instead of the queued reply")
+
+
+def check_zip_resent_whole_after_429(api, bot, waiter):
+    """A zip whose first send is rate limited goes out again with all its bytes, not an empty reader."""
+    chat_id = 301
+    login(api, waiter, chat_id)
+    for name in ('zip-a.txt', 'zip-b.txt'):
+        api.push_document(chat_id, name, f'check/{name}', 64 * 1024)
+        wait_for_job(bot, chat_id, name)
+    ids = [str(bot.catalog.named(name)[0]['id']) for name in ('zip-a.txt', 'zip-b.txt')]
+    seen = len(api.uploads)
+    api.fail_next('sendDocument', 1, 429, retry_after=0)
+    api.push_message(chat_id, f"/download zip {' '.join(ids)}")
+    wait_for_job(bot, chat_id, '2 files as zip')
+    sizes = [size for method, size in api.uploads[seen:] if method == 'sendDocument']
+    if len(sizes) != 2 or min(sizes) < 128 * 1024:
+        raise CheckFailed(f"expected two full sends of the zip, got bodies of {sizes} bytes")
+
+
+def check_progress_errors_do_not_rerun_download(api, bot, waiter):
+    """A progress edit lost to a connection error does not fail the download job and send its files again."""
+    chat_id = 302
+    login(api, waiter, chat_id)
+    api.push_document(chat_id, 'progress.txt', 'check/progress.txt', 1024)
+    wait_for_job(bot, chat_id, 'progress.txt')
+    file_id = bot.catalog.named('progress.txt')[0]['id']
+    seen = len(api.sent)
+    api.fail_next('editMessageText', 5, None)
+    api.push_message(chat_id, f'/download {file_id}')
+    job = wait_for_job(bot, chat_id, '1 file')
+    time.sleep(0.5)  # JOB_BACKOFF is 0.1s here, so a retry would have started
+    sends = [method for _, method, _ in api.sent[seen:] if method == 'sendDocument']
+    if job['state'] != 'done' or job['attempts'] != 1 or len(sends) != 1:
+        raise CheckFailed(f"expected one send in one attempt, got {len(sends)} sends in {job['attempts']} "
+                          f"attempts ({job['state']})")
+
+
+def check_renamed_upload_not_cached_by_file_id(api, bot, waiter):
+    """An upload renamed to "name (2).ext" on a clash is not cached under its file_id, which keeps the old name."""
+    chat_id = 303
+    login(api, waiter, chat_id)
+    api.push_document(chat_id, 'clash.txt', 'check/clash-1.txt', 1024)
+    first = wait_for_job(bot, chat_id, 'clash.txt')
+    seen = waiter.count(chat_id)
+    api.push_document(chat_id, 'clash.txt', 'check/clash-1.txt', 1024)  # same contents: linked, not fetched
+    waiter.wait(chat_id, seen + 1, TIMEOUT)
+    api.push_document(chat_id, 'clash.txt', 'check/clash-2.txt', 1024)  # new contents: fetched by a job
+    job = wait_for_job(bot, chat_id, 'clash.txt', after=first)
+    names = [entry['name'] for entry in bot.catalog.list_files() if entry['name'].startswith('clash')]
+    cached = [row['file_name'] for row in bot.catalog.connect().execute(
+        "SELECT file_name FROM telegram_file_ids WHERE file_name LIKE 'clash%'")]
+    if len(names) != 3 or cached != ['clash.txt'] or job['state'] != 'done':
+        raise CheckFailed(f"expected three entries and only clash.txt cached, got {names} and {cached}")
+
+
+def main():
+    os.environ['JOB_BACKOFF'] = '0.1'
+    api = FakeBotAPI().start()
+    bot = load_bot(api, 8)
+    waiter = ReplyWaiter(api)
+    threading.Thread(target=bot.bot.polling, kwargs={'non_stop': True, 'timeout': 30}, daemon=True).start()
+
+    checks = [check_failed_confirmation_stores_once, check_queued_reply_comes_first,
+              check_zip_resent_whole_after_429, check_progress_errors_do_not_rerun_download,
+              check_renamed_upload_not_cached_by_file_id]
+    failed = 0
+    for check in checks:
+        try:
+            check(api, bot, waiter)
+            print(f"ok      {check.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"FAILED  {check.__name__}: {e}")
+
+    bot.bot.stop_polling()
+    api.stop()
+    os._exit(1 if failed else 0)  # polling and job threads are daemons blocked on sockets
+
+
+if __name__ == '__main__':
+    main()
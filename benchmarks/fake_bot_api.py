@@ -0,0 +1,301 @@
+"""A small local stand-in for the Telegram Bot API and file endpoint, used by the benchmarks."""
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+TOKEN = '123456:FAKE-TOKEN'
+
+
+class FakeBotAPI:
+    """Serves getUpdates from a local queue and records every reply the bot sends."""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, bandwidth=None, rate_limit=0.0, retry_after=1, seed=0):
+        self.latency = latency        # seconds added to every API call
+        self.bandwidth = bandwidth    # bytes/second for file transfers, None for unlimited
+        self.rate_limit = rate_limit  # share of send*/edit* calls answered with a 429
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.rate_limited = 0         # 429s given out by rate_limit
+        self.files = {}               # file_path -> size in bytes
+        self.file_ids = set()         # file_ids sendDocument accepts instead of an upload
+        self.failures = {}            # method -> [error_code, retry_after] for each upcoming call to fail
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.sent = []                # (timestamp, method, params) for every outgoing call
+        self.uploads = []             # (method, bytes) for every multipart body, failed calls included
+        self.webhook = None           # params of the last setWebhook, None when polling
+        self.reply_listeners = []
+        self.cond = threading.Condition()
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+            def do_GET(self):
+                api._handle(self)
+
+            def do_POST(self):
+                api._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def install(self):
+        """Points telebot's apihelper at this server."""
+        from telebot import apihelper
+        apihelper.API_URL = self.base_url + '/bot{0}/{1}'
+        apihelper.FILE_URL = self.base_url + '/file/bot{0}/{1}'
+
+    # -- scripting -------------------------------------------------------------
+
+    def add_file(self, file_path, size):
+        self.files[file_path] = size
+
+    def push_message(self, chat_id, text=None, document=None):
+        """Queues an incoming message and returns its message_id."""
+        with self.cond:
+            update = self.make_update(chat_id, text, document)
+            self.updates.append(update)
+            self.cond.notify_all()
+        return update['message']['message_id']
+
+    def make_update(self, chat_id, text=None, document=None):
+        """Builds an incoming message update without queueing it, e.g. to POST it to a webhook."""
+        with self.cond:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            update_id = self.next_update_id
+            self.next_update_id += 1
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+        }
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                command = text.split()[0]
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        if document is not None:
+            message['document'] = document
+        return {'update_id': update_id, 'message': message}
+
+    def push_updates(self, updates):
+        """Queues already built updates for getUpdates."""
+        with self.cond:
+            self.updates.extend(updates)
+            self.cond.notify_all()
+
+    def push_callback(self, chat_id, data, message_id):
+        """Queues a press of an inline button with callback_data data on the bot's message message_id."""
+        with self.cond:
+            update_id = self.next_update_id
+            self.next_update_id += 1
+            self.updates.append({'update_id': update_id, 'callback_query': {
+                'id': str(update_id),
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+                'message': {'message_id': message_id, 'date': int(time.time()),
+                            'chat': {'id': chat_id, 'type': 'private'}},
+                'chat_instance': str(chat_id),
+                'data': data,
+            }})
+            self.cond.notify_all()
+
+    def push_inline_query(self, user_id, query, offset=''):
+        """Queues an inline query, as typed after the bot's @username."""
+        with self.cond:
+            update_id = self.next_update_id
+            self.next_update_id += 1
+            self.updates.append({'update_id': update_id, 'inline_query': {
+                'id': str(update_id),
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+                'query': query,
+                'offset': offset,
+            }})
+            self.cond.notify_all()
+
+    def push_document(self, chat_id, file_name, file_path, size):
+        self.add_file(file_path, size)
+        self.file_ids.add(f'id-{file_path}')
+        document = {
+            'file_id': f'id-{file_path}',
+            'file_unique_id': f'uid-{file_path}',
+            'file_name': file_name,
+            'file_size': size,
+        }
+        return self.push_message(chat_id, document=document)
+
+    def fail_next(self, method, count=1, error_code=500, retry_after=1):
+        """Makes the next count calls of method fail, with a 500, a 429 carrying retry_after, or (None) a dropped connection."""
+        with self.cond:
+            self.failures.setdefault(method, []).extend([(error_code, retry_after)] * count)
+
+    def on_reply(self, callback):
+        """Calls callback(timestamp, method, params) for every outgoing call from the bot."""
+        self.reply_listeners.append(callback)
+
+    # -- request handling ------------------------------------------------------
+
+    def _handle(self, request):
+        url = urlparse(request.path)
+        parts = url.path.strip('/').split('/', 2)
+        length = int(request.headers.get('Content-Length') or 0)
+        # Uploaded documents are read and dropped, so they do not count towards the RSS the benchmarks report
+        keep = not request.headers.get('Content-Type', '').startswith('multipart/')
+        body = self._read_body(request, length, keep)
+        if not keep:
+            self.uploads.append((parts[1] if len(parts) > 1 else '', length))
+
+        if parts[0] == 'file':
+            self._serve_file(request, parts[2] if len(parts) > 2 else '')
+            return
+
+        method = parts[1] if len(parts) > 1 else ''
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if body and request.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            params.update({k: v[-1] for k, v in parse_qs(body.decode()).items()})
+
+        if self.latency and method != 'getUpdates':
+            time.sleep(self.latency)
+
+        with self.cond:
+            pending = self.failures.get(method)
+            failure = pending.pop(0) if pending else None
+            if (failure is None and self.rate_limit and method.startswith(('send', 'edit'))
+                    and self.random.random() < self.rate_limit):
+                failure = (429, self.retry_after)
+                self.rate_limited += 1
+        if failure is not None:
+            error_code, retry_after = failure
+            if error_code is None:
+                request.close_connection = True  # no response at all: the client sees a connection error
+            elif error_code == 429:
+                self._respond(request, 429, {'ok': False, 'error_code': 429,
+                                             'description': f'Too Many Requests: retry after {retry_after}',
+                                             'parameters': {'retry_after': retry_after}})
+            else:
+                self._respond(request, error_code, {'ok': False, 'error_code': error_code,
+                                                    'description': 'Internal Server Error'})
+            return
+
+        if method == 'getUpdates':
+            result = self._get_updates(params)
+        elif method == 'getMe':
+            result = {'id': int(TOKEN.split(':')[0]), 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        elif method == 'setWebhook':
+            self.webhook = params
+            result = True
+        elif method == 'deleteWebhook':
+            self.webhook = None
+            result = True
+        elif method == 'getFile':
+            file_path = params['file_id'].removeprefix('id-')
+            result = {'file_id': params['file_id'], 'file_unique_id': f'uid-{file_path}',
+                      'file_size': self.files.get(file_path, 0), 'file_path': file_path}
+        elif method == 'sendDocument' and 'document' in params and params['document'] not in self.file_ids:
+            self._respond(request, 400, {'ok': False, 'error_code': 400,
+                                         'description': 'Bad Request: wrong file identifier/HTTP URL specified'})
+            return
+        else:
+            result = self._record(method, params)
+
+        self._respond(request, 200, {'ok': True, 'result': result})
+
+    def _read_body(self, request, length, keep=True):
+        # Uploads are throttled the same way as downloads so sendDocument costs real time
+        chunks = []
+        remaining = length
+        while remaining > 0:
+            chunk = request.rfile.read(min(remaining, 256 * 1024))
+            if not chunk:
+                break
+            if keep:
+                chunks.append(chunk)
+            remaining -= len(chunk)
+            self._throttle(len(chunk))
+        return b''.join(chunks)
+
+    def _throttle(self, size):
+        if self.bandwidth:
+            time.sleep(size / self.bandwidth)
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset', 0))
+        timeout = float(params.get('timeout', 0))
+        deadline = time.time() + timeout
+        with self.cond:
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            while not self.updates and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            return list(self.updates)
+
+    def _record(self, method, params):
+        now = time.time()
+        self.sent.append((now, method, params))
+        for callback in self.reply_listeners:
+            callback(now, method, params)
+        with self.cond:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        chat_id = int(params.get('chat_id', 0) or 0)
+        message = {'message_id': message_id, 'date': int(now),
+                   'chat': {'id': chat_id, 'type': 'private'}}
+        if method in ('sendMessage', 'editMessageText'):
+            message['text'] = params.get('text', '')
+        if method == 'sendDocument':
+            message['document'] = {'file_id': f'sent-{message_id}', 'file_unique_id': f'sent-{message_id}'}
+            self.file_ids.add(f'sent-{message_id}')
+        if method.startswith(('send', 'edit')):
+            return message
+        return True
+
+    def _serve_file(self, request, file_path):
+        size = self.files.get(file_path)
+        if size is None:
+            self._respond(request, 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/octet-stream')
+        request.send_header('Content-Length', str(size))
+        request.end_headers()
+        # Contents differ from file to file, so stored copies are not all deduplicated into one
+        block = hashlib.sha256(file_path.encode()).digest() * (256 * 1024 // 32)
+        remaining = size
+        while remaining > 0:
+            chunk = block[:min(remaining, len(block))]
+            request.wfile.write(chunk)
+            remaining -= len(chunk)
+            self._throttle(len(chunk))
+
+    def _respond(self, request, status, payload):
+        data = json.dumps(payload).encode()
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
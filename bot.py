@@ -1,41 +1,142 @@
+import time
+IMPORT_STARTED = time.perf_counter()  # for --profile-startup
 import os
+import sys
+import argparse
 import logging
-from dotenv import load_dotenv
 import telebot
-import shutil
-import psutil
+from telebot import apihelper
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-import time
-from keep_alive import keep_alive
-
-# Load environment variables from .env file
-load_dotenv()
+import json
+import tempfile
+import threading
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from log_pipeline import set_context, setup_logging
+from dispatcher import DispatchingTeleBot
+from ratelimit import ChatRateLimiter, SendScheduler, GLOBAL_SEND_RATE, CHAT_SEND_RATE, CHAT_SEND_BURST
+from catalog import FileCatalog
+from usage import ContentTotals, UsageTracker, scan_directory_size
+from storage import FileStore
+from eviction import DEFAULT_HIGH_WATER, DEFAULT_INTERVAL, DEFAULT_LOW_WATER, DEFAULT_MIN_AGE, Evictor
+from file_id_cache import TelegramFileIdCache
+from search import FileSearchIndex
+from listing import CALLBACK_PREFIX as LIST_CALLBACK_PREFIX, FileListing, ListQuery
+from sessions import DEFAULT_MAX_SESSIONS, DEFAULT_TTL, MemorySessionStore, SQLiteSessionStore
+from jobs import JobFailed, JobQueue
+from batch import BatchProgress, send_batch, with_retry_after, write_zip
+import metrics
+from chunked import PART_NAME, DEFAULT_PART_SIZE, FileRange, PartAssembler, build_manifest, part_name, plan_parts
+from transfer import throughput_mb_s, DEFAULT_CHUNK_SIZE, MultipartStream, SizedFile
+
+
+def find_env_file():
+    """The .env to load: ENV_FILE if set, else the first .env found from bot.py's directory upwards.
+
+    That is where python-dotenv's find_dotenv() looks (from the working directory in a frozen
+    build), without importing python-dotenv to look.
+    """
+    if os.getenv('ENV_FILE'):
+        return os.environ['ENV_FILE']
+    directory = os.getcwd() if getattr(sys, 'frozen', False) else os.path.dirname(os.path.abspath(__file__))
+    while True:
+        path = os.path.join(directory, '.env')
+        if os.path.isfile(path):
+            return path
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+# Load environment variables from a .env file; python-dotenv is only imported when there is one
+ENV_FILE = find_env_file()
+if ENV_FILE and os.path.exists(ENV_FILE):
+    from dotenv import load_dotenv
+    load_dotenv(ENV_FILE)
 BOT_TOKEN = os.getenv('TOKEN')
 print(f"Oyeeee! I'm working!! 🤖")
 
-# Configure logging
-logging.basicConfig(
-    filename='bot.log',
+# Configure logging: handlers only queue records, a background thread writes and rotates the file
+setup_logging(
+    os.getenv('LOG_FILE', 'bot.log'),
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
+    max_bytes=int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+    backup_count=int(os.getenv('LOG_BACKUPS', '7')),
+    interval=int(os.getenv('LOG_ROTATE_INTERVAL', str(24 * 3600))),  # seconds; 0 rotates by size only
+    json_lines=os.getenv('LOG_FORMAT', 'json') == 'json',
 )
 
-bot = telebot.TeleBot(BOT_TOKEN)
+# Handlers run on a worker pool; updates from the same chat are still handled one at a time, in order
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', '8'))
+
+# Commands per second each chat may send (with bursts up to COMMAND_BURST); extra ones are dropped
+COMMAND_RATE = float(os.getenv('COMMAND_RATE', '1'))
+COMMAND_BURST = int(os.getenv('COMMAND_BURST', '5'))
+# Outgoing messages are paced to Telegram's limits instead of running into 429s
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', str(GLOBAL_SEND_RATE)))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', str(CHAT_SEND_RATE)))
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', str(CHAT_SEND_BURST)))
+
+bot = DispatchingTeleBot(
+    BOT_TOKEN,
+    num_workers=WORKER_THREADS,
+    command_limiter=ChatRateLimiter(COMMAND_RATE, COMMAND_BURST),
+    send_scheduler=SendScheduler(SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST),
+)
+
+
+def warn_throttled(message):
+    bot.reply_to(message, "⏳ Too many commands at once. Please wait a moment before sending more.")
+    logging.warning(f"Throttled commands from chat {message.chat.id}.")
+
+
+bot.on_throttled = warn_throttled
+
+# 'polling' keeps a getUpdates long-poll open; 'webhook' has Telegram POST updates to the keep-alive server
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # public https URL of the keep-alive server, without the path
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)  # a fresh one each start if unset
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+# The keep-alive server (health checks, /metrics) is started in polling mode only if this is '1'; webhooks need it
+KEEP_ALIVE = os.getenv('KEEP_ALIVE', '1') == '1'
+webhook_registered = threading.Event()
+
+STARTED_AT = time.time()
+HEALTH_MAX_POLL_AGE = int(os.getenv('HEALTH_MAX_POLL_AGE', '90'))  # seconds without a successful getUpdates before /healthz fails
 
-UPLOAD_LIMIT_GB = 1  # 1 GB limit for the uploads directory
 
-def get_directory_size(directory):
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(directory):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            if os.path.exists(fp):
-                total_size += os.path.getsize(fp)
-    return total_size
+def check_liveness():
+    if UPDATE_MODE == 'webhook':
+        # Updates are pushed to us, so a quiet bot is not a stuck one
+        return True, "webhook mode"
+    # getUpdates long-polls for up to 20 seconds, so a working loop succeeds well within the limit
+    age = time.time() - (bot.last_updates_at or STARTED_AT)
+    if age > HEALTH_MAX_POLL_AGE:
+        return False, f"no successful getUpdates for {age:.0f}s"
+    return True, f"last getUpdates {age:.0f}s ago"
+
+
+def check_readiness():
+    if UPDATE_MODE == 'webhook':
+        if not webhook_registered.is_set():
+            return False, "waiting for setWebhook"
+        return True, "webhook registered"
+    if bot.last_updates_at is None:
+        return False, "waiting for the first getUpdates"
+    return check_liveness()
+
+UPLOAD_LIMIT_GB = 1  # 1 GB limit for the uploads directory
+UPLOAD_LIMIT_BYTES = UPLOAD_LIMIT_GB * 1024 ** 3
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(DEFAULT_CHUNK_SIZE)))  # bytes per write while receiving a file
+USAGE_SCAN_INTERVAL = int(os.getenv('USAGE_SCAN_INTERVAL', '600'))  # seconds between usage checks against the disk
 
 def get_storage_info():
+    import psutil  # only /storage needs it, so it stays out of startup
+
     # Get disk usage for the current directory
     current_directory = os.getcwd()
     disk_usage = psutil.disk_usage(current_directory)
@@ -56,13 +157,25 @@ def send_storage_info(message):
     # Get disk storage info
     total, used, free, current_directory = get_storage_info()
 
-    # Calculate the size of files in the uploads directory
-    uploads_size_bytes = get_directory_size(UPLOAD_DIR)
+    # Size of files in the uploads directory, kept up to date by the upload and delete handlers
+    uploads_size_bytes = usage.total()
     uploads_size_gb = uploads_size_bytes / (1024 ** 3)  # Convert to GB
+    totals = content_totals.snapshot()  # running totals, like the usage counter
+    stored_gb = totals['size'] / (1024 ** 3)  # what the stored contents would take uncompressed
+    saved_gb = (totals['compressed_size'] - totals['compressed_stored']) / (1024 ** 3)
 
     # Get the remaining space in the uploads directory
     remaining_upload_space_gb = UPLOAD_LIMIT_GB - uploads_size_gb
 
+    cache_stats = file_ids.stats()
+    eviction_stats = evictor.stats()
+    if evictor.enabled:
+        eviction_status = f"{EVICTION_POLICY}, from {EVICTION_HIGH_WATER:.0%} down to {EVICTION_LOW_WATER:.0%} of the limit"
+    else:
+        eviction_status = "off, uploads are refused once the limit is reached"
+    last_pass = (time.strftime('%Y-%m-%d %H:%M', time.localtime(eviction_stats['last_pass']))
+                 if eviction_stats['last_pass'] else "never")
+
     # Format the storage information message
     storage_message = f"""
 💾 Storage Information:
@@ -72,21 +185,76 @@ def send_storage_info(message):
 - Free Disk Space: {free:.2f} GB
 
 🗂️ Uploads Directory:
-- Uploads Size: {uploads_size_gb:.2f} GB
+- Uploads Size: {uploads_size_gb:.2f} GB on disk ({stored_gb:.2f} GB of contents)
+- Compressed: {totals['compressed_count']} files, saving {saved_gb:.2f} GB{'' if COMPRESSION_LEVEL else ' (compression is off)'}
 - Remaining Upload Space: {remaining_upload_space_gb:.2f} GB (out of {UPLOAD_LIMIT_GB} GB)
+
+📨 Telegram File Cache:
+- Sent Without Re-uploading: {cache_stats['hits']}
+- Uploaded In Full: {cache_stats['misses']}
+- Stale IDs Replaced: {cache_stats['stale']}
+
+🧹 Eviction: {eviction_status}
+- Evicted Since Start: {eviction_stats['files']} files, {eviction_stats['bytes'] / (1024 ** 3):.2f} GB
+- Passes: {eviction_stats['passes']} (last: {last_pass}), {eviction_stats['short_passes']} stopped short by pinned or new files
+- Pinned Files: {totals['pinned']}
 """
 
     bot.reply_to(message, storage_message)
     logging.info(f"User '{user_sessions[message.chat.id]}' requested storage information.")
 
-# Create a directory to store uploaded files
+# Uploaded files are stored here (created with the first upload, not at import)
 UPLOAD_DIR = "uploads"
-if not os.path.exists(UPLOAD_DIR):
-    os.makedirs(UPLOAD_DIR)
-
-user_sessions = {}
 
-user_sessions.clear()
+# Index of the uploaded files; /list shows the catalog IDs and the other commands take them
+CATALOG_DB = os.getenv('CATALOG_DB', 'catalog.db')
+catalog = FileCatalog(CATALOG_DB)
+
+# Contents are stored once per distinct hash; the catalog maps names onto them
+usage = UsageTracker(UPLOAD_DIR)
+# gzip level (1-9) for new contents that are not compressed already; 0 stores them as they are.
+# Level 1 saves nearly as much as 6 on text for a quarter of the CPU (benchmarks/bench_compression.py)
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', '0'))
+content_totals = ContentTotals()  # sizes and counts /storage shows besides usage
+store = FileStore(UPLOAD_DIR, catalog, usage, COMPRESSION_LEVEL or None, content_totals)  # reconciled in start_services()
+
+# What happens as uploads near UPLOAD_LIMIT_GB: 'off' refuses new ones once full; 'lru' (least recently
+# downloaded), 'oldest' or 'largest' delete unpinned files in that order, from EVICTION_HIGH_WATER of
+# the limit down to EVICTION_LOW_WATER
+EVICTION_POLICY = os.getenv('EVICTION_POLICY', 'off')
+EVICTION_HIGH_WATER = float(os.getenv('EVICTION_HIGH_WATER', str(DEFAULT_HIGH_WATER)))
+EVICTION_LOW_WATER = float(os.getenv('EVICTION_LOW_WATER', str(DEFAULT_LOW_WATER)))
+EVICTION_MIN_AGE = int(os.getenv('EVICTION_MIN_AGE', str(DEFAULT_MIN_AGE)))  # seconds new uploads are never evicted
+EVICTION_INTERVAL = int(os.getenv('EVICTION_INTERVAL', str(DEFAULT_INTERVAL)))  # seconds between background checks
+evictor = Evictor(store, usage, UPLOAD_LIMIT_BYTES, EVICTION_POLICY, EVICTION_HIGH_WATER, EVICTION_LOW_WATER,
+                  EVICTION_MIN_AGE)
+
+# Parts of split uploads (name.001, name.002, ...) waiting for /merge
+assembler = PartAssembler(os.path.join(UPLOAD_DIR, '.parts'))
+
+# /list pages come from sorted views of the catalog that are rebuilt only after it changes
+listing = FileListing(catalog)
+LIST_PAGE_SIZE = int(os.getenv('LIST_PAGE_SIZE', '30'))
+LIST_NAME_WIDTH = 80  # longer names are cut so a page stays under Telegram's 4096 characters
+
+# Inline mode searches file names as the user types
+search_index = FileSearchIndex(catalog)
+INLINE_PAGE_SIZE = 50  # the most results Telegram takes per answer
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '10'))  # seconds Telegram may reuse an answer
+
+# Telegram file_ids of stored files, so /download can re-send them without uploading the bytes again
+file_ids = TelegramFileIdCache(catalog)
+
+# Logged-in chats. 'sqlite' keeps them across restarts and shares them between bot processes on one host
+SESSION_STORE = os.getenv('SESSION_STORE', 'sqlite')
+SESSION_DB = os.getenv('SESSION_DB', 'sessions.db')
+SESSION_TTL = int(os.getenv('SESSION_TTL', str(DEFAULT_TTL)))  # seconds after the last command before a session ends
+MAX_SESSIONS = int(os.getenv('MAX_SESSIONS', str(DEFAULT_MAX_SESSIONS)))
+SESSION_SWEEP_INTERVAL = int(os.getenv('SESSION_SWEEP_INTERVAL', '300'))
+if SESSION_STORE == 'memory':
+    user_sessions = MemorySessionStore(SESSION_TTL, MAX_SESSIONS)
+else:
+    user_sessions = SQLiteSessionStore(SESSION_DB, SESSION_TTL, MAX_SESSIONS)
 
 def main_menu():
     markup = telebot.types.InlineKeyboardMarkup()
@@ -117,13 +285,18 @@ def send_welcome(message):
 
 - /login <username> <password> - Log in to your account.
 - /upload - Upload a file.
-- /list - See your uploaded files.
-- /download <file_name> - Download a file.
-- /rename <old_name> <new_name> - Rename a file.
-- /delete <file_name> - Delete a file.
+- /list [id|name|size|date] [asc|desc] [pattern] - See your uploaded files, sorted and filtered.
+- /download <file_id> ... - Download files (/download zip <file_id> ... sends them as one zip).
+- /rename <file_id> <new_name> - Rename a file.
+- /delete <file_id> - Delete a file.
 - /logout - Log out from your account.
-- /metadata <file_name> - Get metadata of a file.
+- /metadata <file_id> - Get metadata of a file.
 - /storage - Check how much storage is left.
+- /merge <file_name> - Join an upload sent as parts (<file_name>.001, .002, ...).
+- /jobs - See your queued and running uploads and downloads.
+- /pin <file_id> ... - Keep files from being evicted when storage runs low (/unpin to undo).
+
+Type the bot's @username and part of a file name in any chat to search your files and send one.
 
 Use the menu below:
 """, reply_markup=main_menu())
@@ -131,16 +304,20 @@ Use the menu below:
 
 @bot.callback_query_handler(func=lambda call: True)
 def handle_callback_query(call):
+    if (call.data or '').startswith(f"{LIST_CALLBACK_PREFIX}:"):
+        handle_list_page(call)
+        return
+
     # Define responses for each button click
     suggestions = {
         "suggest_login": "Please use the command: /login <username> <password>",
         "suggest_upload": "Please use the command: /upload to attach a file.",
-        "suggest_list_files": "Please use the command: /list to see your files.",
-        "suggest_download": "Please use the command: /download <file_name>",
-        "suggest_rename": "Please use the command: /rename <old_name> <new_name>",
-        "suggest_delete": "Please use the command: /delete <file_name>",
+        "suggest_list_files": "Please use the command: /list [id|name|size|date] [asc|desc] [pattern] to see your files.",
+        "suggest_download": "Please use the command: /download <file_id>",
+        "suggest_rename": "Please use the command: /rename <file_id> <new_name>",
+        "suggest_delete": "Please use the command: /delete <file_id>",
         "suggest_logout": "You can logout using: /logout",
-        "suggest_metadata": "Please use the command: /metadata <file_name> to get file metadata.",
+        "suggest_metadata": "Please use the command: /metadata <file_id> to get file metadata.",
         "suggest_storage": "Please use the command: /storage to check available storage."
     }
 
@@ -151,66 +328,101 @@ def handle_callback_query(call):
     bot.send_message(call.message.chat.id, suggestion_message)
 
 
+# Shown to users who are not logged in; built once instead of on every keystroke
+INLINE_COMMANDS = [
+    telebot.types.InlineQueryResultArticle(
+        id='1',
+        title='Login',
+        input_message_content=telebot.types.InputTextMessageContent('/login <username> <password>'),
+        description='Log in to your account.'
+    ),
+    telebot.types.InlineQueryResultArticle(
+        id='2',
+        title='Upload',
+        input_message_content=telebot.types.InputTextMessageContent('/upload'),
+        description='Upload a file.'
+    ),
+    telebot.types.InlineQueryResultArticle(
+        id='3',
+        title='List Files',
+        input_message_content=telebot.types.InputTextMessageContent('/list'),
+        description='See your uploaded files.'
+    ),
+    telebot.types.InlineQueryResultArticle(
+        id='4',
+        title='Download',
+        input_message_content=telebot.types.InputTextMessageContent('/download <file_id>'),
+        description='Download a file.'
+    ),
+    telebot.types.InlineQueryResultArticle(
+        id='5',
+        title='Rename',
+        input_message_content=telebot.types.InputTextMessageContent('/rename <file_id> <new_name>'),
+        description='Rename a file.'
+    ),
+    telebot.types.InlineQueryResultArticle(
+        id='6',
+        title='Delete',
+        input_message_content=telebot.types.InputTextMessageContent('/delete <file_id>'),
+        description='Delete a file.'
+    ),
+    telebot.types.InlineQueryResultArticle(
+        id='7',
+        title='Logout',
+        input_message_content=telebot.types.InputTextMessageContent('/logout'),
+        description='Log out from your account.'
+    ),
+    telebot.types.InlineQueryResultArticle(
+        id='8',
+        title='Metadata',
+        input_message_content=telebot.types.InputTextMessageContent('/metadata <file_id>'),
+        description='Get file metadata.'
+    ),
+    telebot.types.InlineQueryResultArticle(
+        id='9',
+        title='Storage Check',
+        input_message_content=telebot.types.InputTextMessageContent('/storage'),
+        description='Check how much storage is left.'
+    )
+]
+
+
 @bot.inline_handler(func=lambda query: True)
 def handle_inline_query(inline_query):
-    commands = [
-        telebot.types.InlineQueryResultArticle(
-            id='1',
-            title='Login',
-            input_message_content=telebot.types.InputTextMessageContent('/login <username> <password>'),
-            description='Log in to your account.'
-        ),
-        telebot.types.InlineQueryResultArticle(
-            id='2',
-            title='Upload',
-            input_message_content=telebot.types.InputTextMessageContent('/upload'),
-            description='Upload a file.'
-        ),
-        telebot.types.InlineQueryResultArticle(
-            id='3',
-            title='List Files',
-            input_message_content=telebot.types.InputTextMessageContent('/list'),
-            description='See your uploaded files.'
-        ),
-        telebot.types.InlineQueryResultArticle(
-            id='4',
-            title='Download',
-            input_message_content=telebot.types.InputTextMessageContent('/download <file_name>'),
-            description='Download a file.'
-        ),
-        telebot.types.InlineQueryResultArticle(
-            id='5',
-            title='Rename',
-            input_message_content=telebot.types.InputTextMessageContent('/rename <old_name> <new_name>'),
-            description='Rename a file.'
-        ),
-        telebot.types.InlineQueryResultArticle(
-            id='6',
-            title='Delete',
-            input_message_content=telebot.types.InputTextMessageContent('/delete <file_name>'),
-            description='Delete a file.'
-        ),
-        telebot.types.InlineQueryResultArticle(
-            id='7',
-            title='Logout',
-            input_message_content=telebot.types.InputTextMessageContent('/logout'),
-            description='Log out from your account.'
-        ),
-        telebot.types.InlineQueryResultArticle(
-            id='8',
-            title='Metadata',
-            input_message_content=telebot.types.InputTextMessageContent('/metadata <file_name>'),
-            description='Get file metadata.'
-        ),
-        telebot.types.InlineQueryResultArticle(
-            id='9',
-            title='Storage Check',
-            input_message_content=telebot.types.InputTextMessageContent('/storage'),
-            description='Check how much storage is left.'
-        )
-    ]
+    # Inline queries carry no chat; in a private chat with the bot the chat id is the user id
+    username = user_sessions.get(inline_query.from_user.id)
+    if username is None:
+        bot.answer_inline_query(inline_query.id, INLINE_COMMANDS, cache_time=INLINE_CACHE_TIME, is_personal=True)
+        return
 
-    bot.answer_inline_query(inline_query.id, commands)
+    owner = file_owner(inline_query.from_user)
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    file_ids_found, total = search_index.search(inline_query.query, offset, INLINE_PAGE_SIZE, owner=owner)
+    entries = (store.get(file_id, owner) for file_id in file_ids_found)
+    results = [inline_result(entry) for entry in entries if entry is not None]
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < total else ''
+    bot.answer_inline_query(inline_query.id, results, cache_time=INLINE_CACHE_TIME, is_personal=True,
+                            next_offset=next_offset)
+
+
+def inline_result(entry):
+    description = f"ID {entry['id']} • {entry['size'] / (1024 * 1024):.2f} MB"
+    telegram_file_id = catalog.get_telegram_file_id(entry['sha256'], entry['name'])
+    if telegram_file_id is not None:
+        # Choosing it sends Telegram's own copy of the document, nothing is uploaded
+        return telebot.types.InlineQueryResultCachedDocument(
+            id=str(entry['id']),
+            document_file_id=telegram_file_id,
+            title=entry['name'],
+            description=description
+        )
+    # Telegram has never seen these bytes as a document, so let /download upload them
+    return telebot.types.InlineQueryResultArticle(
+        id=str(entry['id']),
+        title=entry['name'],
+        input_message_content=telebot.types.InputTextMessageContent(f"/download {entry['id']}"),
+        description=f"{description} • sends /download {entry['id']}"
+    )
 
 
 # The rest of your existing command handlers go here...
@@ -231,6 +443,7 @@ def handle_login(message):
 
     if authenticate_user(username, password):
         user_sessions[message.chat.id] = username
+        set_context(user=username)
         bot.reply_to(message, f"✅ Welcome, {username}! You are now logged in.")
         logging.info(f"User '{username}' logged in.")
     else:
@@ -240,17 +453,25 @@ def handle_login(message):
 
 @bot.message_handler(commands=['logout'])
 def handle_logout(message):
-    if message.chat.id in user_sessions:
-        username = user_sessions[message.chat.id]
-        del user_sessions[message.chat.id]
+    username = user_sessions.pop(message.chat.id)
+    if username is not None:
         bot.reply_to(message, "✅ You have been logged out.")
         logging.info(f"User '{username}' logged out.")
     else:
         bot.reply_to(message, "❌ You are not logged in.")
 
 
+def file_owner(user):
+    """Owner of the files a Telegram user uploads: their user id, as everyone logs in with the same username."""
+    return str(user.id)
+
+
 def is_authenticated(message):
-    return message.chat.id in user_sessions
+    username = user_sessions.get(message.chat.id)
+    if username is None:
+        return False
+    set_context(user=username)  # log lines from the rest of the handler carry the user
+    return True
 
 
 @bot.message_handler(commands=['upload'])
@@ -259,15 +480,18 @@ def handle_upload_command(message):
         bot.reply_to(message, "❌ You need to log in first. Please use the /login command.")
         return
 
-    current_time = time.time()
-    last_command_time = user_command_time.get(message.chat.id, 0) # type: ignore
+    bot.reply_to(message, "📁 Please attach a file with the /upload command.")
 
-    if current_time - last_command_time < 5:
-        bot.reply_to(message, "⏳ Please wait before using the command again.")
-        return
 
-    user_command_time[message.chat.id] = current_time # type: ignore
-    bot.reply_to(message, "📁 Please attach a file with the /upload command.")
+def attached_file(message):
+    """(file object, file name, size) of the document, photo or video in a message, or None."""
+    if message.document:
+        return message.document, message.document.file_name, message.document.file_size
+    if message.photo:
+        return message.photo[-1], "photo.jpg", message.photo[-1].file_size
+    if message.video:
+        return message.video, "video.mp4", message.video.file_size
+    return None
 
 
 @bot.message_handler(content_types=['document', 'photo', 'video'])
@@ -276,42 +500,168 @@ def handle_file(message):
         bot.reply_to(message, "❌ You need to log in first. Please use the /login command.")
         return
 
-    if message.document:
-        file_size = message.document.file_size
-        file_info = message.document
-        file_name = message.document.file_name
-    elif message.photo:
-        file_size = message.photo[-1].file_size
-        file_info = message.photo[-1]
-        file_name = "photo.jpg"
-    elif message.video:
-        file_size = message.video.file_size
-        file_info = message.video
-        file_name = "video.mp4"
-    else:
+    attached = attached_file(message)
+    if attached is None:
         bot.reply_to(message, "❌ Please attach a document, photo, or video with the /upload command.")
         return
+    file_info, file_name, file_size = attached
 
     if file_size > 20 * 1024 * 1024:
-        bot.reply_to(message, "🚫 Unsuccessful transfer! Maximum file size is 20MB.")
+        bot.reply_to(message, f"🚫 Unsuccessful transfer! Maximum file size is 20MB. Split larger files into parts named {file_name}.001, {file_name}.002, ... and send /merge {file_name} once all parts are uploaded.")
         logging.warning(f"File upload failed for user '{user_sessions[message.chat.id]}': File size exceeds 20MB.")
         return
 
-    bot.send_message(message.chat.id, "📤 File upload started...")
+    if not (message.document and PART_NAME.match(file_name)):
+        # Content we already hold under this file_unique_id is linked without fetching it again
+        linked = store.link_unique_id(file_info.file_unique_id, file_name, file_owner(message.from_user))
+        if linked is not None:
+            file_id, file_name = linked
+            remember_uploaded_file_id(message, file_id)
+            bot.reply_to(message, f"✅ File uploaded successfully! You can access it as: {file_name} (ID {file_id})")
+            logging.info(f"File '{file_name}' uploaded by user '{user_sessions[message.chat.id]}' (already stored, fetch skipped).")
+            return
+
+    # Checked again with a reservation when the job runs; this only saves queueing a hopeless one
+    if not evictor.enabled and usage.total() + file_size > UPLOAD_LIMIT_BYTES:
+        bot.reply_to(message, f"🚫 Unsuccessful transfer! The uploads directory is full ({UPLOAD_LIMIT_GB} GB limit).")
+        logging.warning(f"File upload failed for user '{user_sessions[message.chat.id]}': Upload limit of {UPLOAD_LIMIT_GB} GB reached.")
+        return
+
+    # Acknowledged before it is queued, so the job's own messages can never arrive ahead of this one
+    bot.reply_to(message, f"📤 Upload of {file_name} queued. Use /jobs to follow it.")
+    jobs.enqueue('upload', message.chat.id, file_name, {'message': message.json, 'user': user_sessions[message.chat.id]})
+
+
+def run_upload_job(job):
+    message = job_message(job)
+    username = job['payload']['user']
+    set_context(user=username)
+    file_info, file_name, file_size = attached_file(message)
+    part = PART_NAME.match(file_name) if message.document else None
+
+    if not reserve_space(file_size):
+        logging.warning(f"File upload failed for user '{username}': Upload limit of {UPLOAD_LIMIT_GB} GB reached.")
+        raise JobFailed(f"the uploads directory is full ({UPLOAD_LIMIT_GB} GB limit)")
     try:
         file_info_full = bot.get_file(file_info.file_id)
-        file_content = requests.get(f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info_full.file_path}", stream=True)
-        file_content.raise_for_status()
+        url = get_file_url(file_info_full.file_path)
+        if part:
+            save_file_part(message, username, url, part.group('base'), int(part.group('index')))
+        else:
+            save_upload(message, username, file_info, file_name, url)
+    finally:
+        usage.release(file_size)
+
 
-        with open(os.path.join(UPLOAD_DIR, file_name), 'wb') as f:
-            for data in file_content.iter_content(1024):
-                f.write(data)
+def send_job_result(send, *args, **kwargs):
+    """Sends the message that ends a job whose work is already committed, such as a stored upload.
 
-        bot.send_message(message.chat.id, f"✅ File uploaded successfully! You can access it as: {file_name}")
-        logging.info(f"File '{file_name}' uploaded by user '{user_sessions[message.chat.id]}'.")
+    A failure is logged instead of raised: the job queue would retry a transient one, running
+    the whole transfer again and storing the file a second time.
+    """
+    try:
+        return send(*args, **kwargs)
     except Exception as e:
-        bot.send_message(message.chat.id, "❌ An error occurred during file upload.")
-        logging.error(f"Error uploading file for user '{user_sessions[message.chat.id]}': {str(e)}")
+        logging.error(f"Could not send the result of a finished job: {describe_send_error(e)}")
+
+
+def reserve_space(size):
+    """Reserves room for an upload of size bytes, evicting files for it if the eviction policy allows."""
+    if usage.reserve(size, UPLOAD_LIMIT_BYTES):
+        evictor.wake()  # past the high-water mark, a background pass frees space while this upload runs
+        return True
+    return evictor.make_room(size) and usage.reserve(size, UPLOAD_LIMIT_BYTES)
+
+
+def save_upload(message, username, file_info, file_name, url):
+    # Stream through the shared session, hashing on the way; duplicate contents are not stored twice
+    file_id, file_name, size, seconds, deduplicated = store.store_download(
+        http_session, url, file_name, file_owner(message.from_user), UPLOAD_CHUNK_SIZE, file_info.file_unique_id
+    )
+    remember_uploaded_file_id(message, file_id)
+    metrics.record_transfer('upload', size, seconds)
+
+    send_job_result(bot.send_message, message.chat.id, f"✅ File uploaded successfully! You can access it as: {file_name} (ID {file_id})")
+    logging.info(f"File '{file_name}' uploaded by user '{username}' ({size} bytes in {seconds:.2f}s, {throughput_mb_s(size, seconds):.2f} MB/s{', duplicate content' if deduplicated else ''}).",
+                 extra={'file': file_name, 'bytes': size, 'duration': seconds})
+
+
+def save_file_part(message, username, url, base, index):
+    size, replaced, seconds = assembler.save_part(message.chat.id, base, index, http_session, url, UPLOAD_CHUNK_SIZE)
+    usage.add(size - replaced)
+    metrics.record_transfer('upload', size, seconds)
+
+    received = len(assembler.list_parts(message.chat.id, base))
+    missing = assembler.missing(message.chat.id, base)
+    missing_note = f", still missing: {', '.join(f'{i:03d}' for i in missing)}" if missing else ""
+    send_job_result(bot.reply_to, message, f"🧩 Part {index:03d} of {base} received ({received} parts so far{missing_note}). Send /merge {base} once all parts are uploaded.")
+    logging.info(f"Part {index:03d} of '{base}' uploaded by user '{username}' ({size} bytes in {seconds:.2f}s, {throughput_mb_s(size, seconds):.2f} MB/s).",
+                 extra={'file': part_name(base, index - 1), 'bytes': size, 'duration': seconds})
+
+
+@bot.message_handler(commands=['merge'])
+def handle_merge(message):
+    if not is_authenticated(message):
+        bot.reply_to(message, "❌ You need to log in first. Please use the /login command.")
+        return
+
+    text_split = message.text.split(maxsplit=1)
+    if len(text_split) < 2:
+        pending = assembler.pending(message.chat.id)
+        if pending:
+            pending_list = "\n".join(f"- {base} ({len(assembler.list_parts(message.chat.id, base))} parts)" for base in pending)
+            bot.reply_to(message, f"🧩 Split uploads waiting to be merged:\n{pending_list}\n\nUse /merge <file_name> to join one.")
+        else:
+            bot.reply_to(message, "❓ No split uploads waiting. Upload parts named <file_name>.001, <file_name>.002, ... and then use /merge <file_name>.")
+        return
+
+    base = text_split[1].strip()
+    parts = assembler.list_parts(message.chat.id, base)
+    if not parts:
+        bot.reply_to(message, f"❌ No parts of {base} have been uploaded.")
+        return
+    missing = assembler.missing(message.chat.id, base)
+    if missing:
+        bot.reply_to(message, f"❌ Can't merge {base} yet, missing parts: {', '.join(f'{i:03d}' for i in missing)}.")
+        return
+
+    # The merged copy exists next to the parts until they are removed
+    total_size = sum(parts.values())
+    if not reserve_space(total_size):
+        bot.reply_to(message, f"🚫 Not enough room to merge {base} ({UPLOAD_LIMIT_GB} GB limit).")
+        return
+
+    try:
+        bot.reply_to(message, f"🧩 Merging {len(parts)} parts of {base}...")
+        temp_path, size, sha256, compressed = assembler.merge(message.chat.id, base, store.temp_dir(), UPLOAD_CHUNK_SIZE,
+                                                              store.compress_level)
+        file_id, name, _ = store.add_file(temp_path, base, file_owner(message.from_user), size, sha256, compressed)
+        usage.add(-assembler.discard(message.chat.id, base))
+        bot.reply_to(message, f"✅ File merged successfully! You can access it as: {name} (ID {file_id}, {size} bytes)")
+        logging.info(f"User '{user_sessions[message.chat.id]}' merged {len(parts)} parts into '{name}' ({size} bytes).",
+                     extra={'file': name, 'bytes': size})
+    except Exception as e:
+        bot.reply_to(message, f"❌ Failed to merge {base}: {str(e)}")
+        logging.error(f"Error merging '{base}' for user '{user_sessions[message.chat.id]}': {str(e)}")
+    finally:
+        usage.release(total_size)
+
+
+def remember_uploaded_file_id(message, file_id):
+    # Only documents: a photo or video file_id cannot be sent back with send_document
+    if message.document:
+        entry = catalog.get(file_id)
+        # Telegram's copy keeps the name it was sent with, so it only stands for an entry of that name
+        # (not the "name (2).ext" a clash gave the entry)
+        if entry['name'] == message.document.file_name:
+            file_ids.put(entry['sha256'], entry['name'], message.document.file_id)
+
+
+def get_file_url(file_path):
+    # Honour telebot's FILE_URL override so a local Bot API server (or the benchmarks' fake one) works too
+    if apihelper.FILE_URL:
+        return apihelper.FILE_URL.format(BOT_TOKEN, file_path)
+    return f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
 
 
 def get_session_with_retries():
@@ -322,12 +672,118 @@ def get_session_with_retries():
         status_forcelist=[502, 503, 504],  # Retry on these HTTP statuses
         allowed_methods=["POST", "GET"]  # Apply retry logic to these methods
     )
-    adapter = HTTPAdapter(max_retries=retries)
+    # Keep a connection per job worker alive (uploads are fetched on those) so they skip the TLS handshake
+    adapter = HTTPAdapter(max_retries=retries, pool_connections=4, pool_maxsize=JOB_WORKERS)
     session.mount("https://", adapter)
     session.mount("http://", adapter)
     return session
 
 
+def send_api_request(method, url, params=None, files=None, timeout=None, proxies=None):
+    """Sends telebot's Bot API requests, streaming a document that knows its size (SizedFile, FileRange).
+
+    With files=, requests builds the whole multipart body in memory first: up to 50 MB per
+    /download being sent, on top of the file itself if it had to be decompressed.
+    """
+    session = apihelper._get_req_session()
+    if files and len(files) == 1:
+        field, document = next(iter(files.items()))
+        file_name, document = document if isinstance(document, tuple) else (None, document)
+        if hasattr(document, 'read') and hasattr(document, '__len__'):
+            body = MultipartStream(field, file_name or os.path.basename(getattr(document, 'name', None) or field), document)
+            return session.request(method, url, params=params, data=body, headers={'Content-Type': body.content_type},
+                                   timeout=timeout, proxies=proxies)
+    return session.request(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+
+
+apihelper.CUSTOM_REQUEST_SENDER = send_api_request
+
+
+# Parts of the descriptions Telegram gives a 400 for a file_id it no longer accepts ("wrong file
+# identifier/HTTP URL specified", "wrong remote file identifier specified", "file reference expired")
+STALE_FILE_ID_ERRORS = ('file identifier', 'file reference', 'file_id')
+
+
+def is_stale_file_id(e):
+    description = (e.description or '').lower()
+    return e.error_code == 400 and any(part in description for part in STALE_FILE_ID_ERRORS)
+
+
+def send_stored_file(chat_id, entry):
+    # Telegram already has the bytes if we have a file_id for them, so sending takes no upload at all
+    cached_file_id = file_ids.get(entry['sha256'], entry['name'])
+    if cached_file_id is not None:
+        try:
+            return bot.send_document(chat_id, cached_file_id, timeout=180)
+        except apihelper.ApiTelegramException as e:
+            if not is_stale_file_id(e):
+                raise  # e.g. chat not found: an upload would fail the same way
+            # The file_id has gone stale, fall back to uploading the file
+            file_ids.invalidate(entry['sha256'], entry['name'])
+            logging.warning(f"Cached file_id for '{entry['name']}' was rejected ({e.description}), re-uploading.")
+
+    started = time.perf_counter()
+    with store.open(entry) as f:
+        # Streamed from the reader as it is sent; the size tells how long the decompressed contents are
+        sent = bot.send_document(chat_id, SizedFile(f, entry['size']), visible_file_name=entry['name'], timeout=180)  # Increase timeout for larger files
+    metrics.record_transfer('download', entry['size'], time.perf_counter() - started)
+    if sent.document:
+        file_ids.put(entry['sha256'], entry['name'], sent.document.file_id)
+    return sent
+
+
+MAX_DOWNLOAD_SIZE = 50 * 1024 * 1024  # 50 MB limit for Telegram uploads
+PART_SIZE = int(os.getenv('PART_SIZE', str(DEFAULT_PART_SIZE)))  # larger files are sent as parts of this size
+DOWNLOAD_PARALLELISM = int(os.getenv('DOWNLOAD_PARALLELISM', '4'))  # documents being sent at once, across all chats
+
+# Shared by every /download so a few large batches cannot open unbounded parallel uploads to Telegram
+download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_PARALLELISM, thread_name_prefix='download')
+
+
+def describe_send_error(e):
+    if isinstance(e, requests.exceptions.Timeout):
+        return "timed out, please try again"
+    if isinstance(e, requests.exceptions.ConnectionError):
+        return "connection error, please try again later"
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        # The message would include the file URL, which contains the bot token
+        return f"Telegram's file server answered {e.response.status_code}"
+    return str(e)
+
+
+# Uploads and downloads run as jobs on their own workers, kept in SQLite so a restart picks them up again
+JOBS_DB = os.getenv('JOBS_DB', 'jobs.db')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '5'))  # like the HTTP session's Retry(total=5, backoff_factor=1)
+JOB_BACKOFF = float(os.getenv('JOB_BACKOFF', '1'))  # seconds before the first retry, doubling after each attempt
+JOB_RETENTION = int(os.getenv('JOB_RETENTION', str(7 * 24 * 3600)))  # seconds finished jobs stay listed in /jobs
+JOBS_SHOWN = 10
+
+# Shared by every upload instead of a fresh requests.get() per file
+http_session = get_session_with_retries()
+
+
+def is_transient(e):
+    """Errors worth retrying a job for: the network, or Telegram's side having trouble."""
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                      requests.exceptions.ChunkedEncodingError, requests.exceptions.RetryError)):
+        return True
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and e.response.status_code >= 500
+    if isinstance(e, apihelper.ApiTelegramException):
+        return e.error_code == 429 or e.error_code >= 500
+    return False
+
+
+jobs = JobQueue(JOBS_DB, JOB_WORKERS, JOB_MAX_ATTEMPTS, JOB_BACKOFF, retryable=is_transient,
+                describe=describe_send_error)
+
+
+def job_message(job):
+    # The message that asked for the job, so the job's replies thread under it as before
+    return telebot.types.Message.de_json(job['payload']['message'])
+
+
 @bot.message_handler(commands=['download'])
 def handle_download(message):
     if not is_authenticated(message):
@@ -335,52 +791,164 @@ def handle_download(message):
         return
 
     text_split = message.text.split()
-    if len(text_split) < 2:
-        bot.reply_to(message, "❓ Please provide file indices after the /download command (e.g., /download 1 2).")
+    as_zip = len(text_split) > 1 and text_split[1].lower() == 'zip'
+    if as_zip:
+        text_split.pop(1)
+    requested_ids = [int(i) for i in text_split[1:] if i.isdigit()]
+    if not requested_ids:
+        bot.reply_to(message, "❓ Please provide file IDs after the /download command (e.g., /download 1 2, or /download zip 1 2 for a single zip).")
         return
 
-    file_indices = [int(i) - 1 for i in text_split[1:] if i.isdigit()]
-    files = os.listdir(UPLOAD_DIR)
+    description = f"{len(requested_ids)} file{'s' if len(requested_ids) != 1 else ''}{' as zip' if as_zip else ''}"
+    bot.reply_to(message, f"📥 Download of {description} queued. Use /jobs to follow it.")  # before the job's progress message
+    jobs.enqueue('download', message.chat.id, description, {
+        'message': message.json, 'user': user_sessions[message.chat.id], 'file_ids': requested_ids, 'zip': as_zip,
+    })
+
+
+def run_download_job(job):
+    username = job['payload']['user']
+    set_context(user=username)
+    send_files(job_message(job), username, job['payload']['file_ids'], job['payload']['zip'])
+
+
+def send_files(message, username, requested_ids, as_zip):
     too_large_files = []
-    downloaded_files = []
     not_found_files = []
-
-    for index in file_indices:
-        if 0 <= index < len(files):  # Validate index
-            file_name = files[index]
-            file_path = os.path.join(UPLOAD_DIR, file_name)
-            if os.path.exists(file_path):
-                try:
-                    file_size = os.path.getsize(file_path)
-                    max_file_size = 50 * 1024 * 1024  # 50 MB limit for Telegram uploads
-
-                    if file_size > max_file_size:
-                        too_large_files.append(file_name)
-                        logging.warning(f"File '{file_name}' is too large to upload for user '{user_sessions[message.chat.id]}'.")
-                    else:
-                        with open(file_path, 'rb') as f:
-                            bot.send_document(message.chat.id, f, timeout=180)  # Increase timeout for larger files
-                            downloaded_files.append(file_name)
-                            logging.info(f"User '{user_sessions[message.chat.id]}' downloaded file '{file_name}'.")
-                except requests.exceptions.Timeout:
-                    bot.reply_to(message, f"⏳ The download request for '{file_name}' timed out. Please try again.")
-                except requests.exceptions.ConnectionError as e:
-                    bot.reply_to(message, f"❌ Connection error while downloading '{file_name}': {str(e)}. Please try again later.")
-                except Exception as e:
-                    bot.reply_to(message, f"❌ An unexpected error occurred while downloading '{file_name}': {str(e)}.")
-                    logging.error(f"Error downloading file '{file_name}': {str(e)}")
-            else:
-                not_found_files.append(file_name)
+    entries = []
+    split_entries = []  # (entry, hashes of the parts already sent to this chat)
+
+    for file_id in requested_ids:
+        entry = store.get(file_id, file_owner(message.from_user))
+        if entry is None:  # Validate ID
+            not_found_files.append(str(file_id))
+        elif not store.exists(entry):
+            not_found_files.append(entry['name'])
+        elif entry['size'] > MAX_DOWNLOAD_SIZE and as_zip:
+            too_large_files.append(entry['name'])
+            logging.warning(f"File '{entry['name']}' is too large to upload for user '{username}'.")
+        elif entry['size'] > MAX_DOWNLOAD_SIZE:
+            split_entries.append((entry, parts_already_sent(message.chat.id, entry)))
         else:
-            not_found_files.append(str(index + 1))
+            entries.append(entry)
 
-    # Response messages
-    if downloaded_files:
-        bot.reply_to(message, f"✅ Successfully downloaded files:\n- {', '.join(downloaded_files)}.")
+    if as_zip and sum(entry['size'] for entry in entries) > MAX_DOWNLOAD_SIZE:
+        bot.reply_to(message, "❌ Those files add up to more than 50 MB, which is too large for one zip. Please download them separately.")
+        return
+
+    # Each split file counts its remaining parts plus the manifest
+    total = 1 if as_zip and entries else len(entries)
+    total += sum(len(plan_parts(entry['size'], PART_SIZE)) - len(sent) + 1 for entry, sent in split_entries)
+    progress = BatchProgress(bot, message, "Zipping files" if as_zip else "Sending files", total)
     if too_large_files:
-        bot.reply_to(message, f"❌ Files too large to download: {', '.join(too_large_files)}.")
+        progress.add_note(f"❌ Files too large to download: {', '.join(too_large_files)}.")
     if not_found_files:
-        bot.reply_to(message, f"❌ Invalid indices or files not found: {', '.join(not_found_files)}.")
+        progress.add_note(f"❌ Invalid IDs or files not found: {', '.join(not_found_files)}.")
+
+    if as_zip and entries:
+        send_zip(message, username, entries, progress)
+    elif entries:
+        def on_done(entry, error):
+            if error is None:
+                record_download(entry)
+                logging.info(f"User '{username}' downloaded file '{entry['name']}'.",
+                             extra={'file': entry['name'], 'bytes': entry['size']})
+            else:
+                logging.error(f"Error downloading file '{entry['name']}': {str(error)}")
+            progress.done(entry['name'], None if error is None else describe_send_error(error))
+
+        send_batch(download_pool, entries, lambda entry: send_stored_file(message.chat.id, entry), on_done)
+
+    for entry, sent in split_entries:
+        send_in_parts(message, username, entry, sent, progress)
+
+    progress.refresh(force=True)
+
+
+def record_download(entry):
+    # Only feeds the lru eviction policy; failing here must not fail (and re-run) a transfer that went out
+    try:
+        catalog.record_download(entry['id'], time.time())
+    except Exception as e:
+        logging.error(f"Could not record the download of '{entry['name']}': {str(e)}")
+
+
+def parts_already_sent(chat_id, entry):
+    state = catalog.get_part_transfer(chat_id, entry['id'])
+    if state is None or state['sha256'] != entry['sha256'] or state['part_size'] != PART_SIZE:
+        return []
+    return json.loads(state['part_hashes'])
+
+
+def send_in_parts(message, username, entry, part_hashes, progress):
+    # Parts go out one after another so an interruption can resume right after the last one that arrived
+    chat_id = message.chat.id
+    parts = plan_parts(entry['size'], PART_SIZE)
+    if part_hashes:
+        progress.add_note(f"↪️ Resuming {entry['name']} from part {len(part_hashes) + 1:03d}.")
+
+    def send_part(blob, index):
+        offset, length = parts[index]
+        started = time.perf_counter()
+        with FileRange(blob, offset, length, part_name(entry['name'], index)) as part:
+            bot.send_document(chat_id, part, visible_file_name=part.name, timeout=180)
+        metrics.record_transfer('download', length, time.perf_counter() - started)
+        return part.sha256.hexdigest()
+
+    # One reader for all the parts, so a compressed file is decompressed once rather than up to each part
+    with store.open(entry) as blob:
+        for index in range(len(part_hashes), len(parts)):
+            name = part_name(entry['name'], index)
+            try:
+                part_hashes.append(download_pool.submit(with_retry_after, send_part, blob, index).result())
+            except Exception as e:
+                progress.done(name, describe_send_error(e))
+                progress.add_note(f"↪️ Send /download {entry['id']} again to continue {entry['name']} from part {index + 1:03d}.")
+                logging.error(f"Error sending part {index + 1} of '{entry['name']}': {str(e)}")
+                return
+            catalog.save_part_transfer(chat_id, entry['id'], entry['sha256'], PART_SIZE, part_hashes)
+            progress.done(name)
+
+    manifest_name = f"{entry['name']}.manifest.json"
+    manifest = build_manifest(entry['name'], entry['size'], entry['sha256'], PART_SIZE, part_hashes)
+    try:
+        download_pool.submit(with_retry_after, bot.send_document, chat_id, manifest, visible_file_name=manifest_name).result()
+    except Exception as e:
+        progress.done(manifest_name, describe_send_error(e))
+        logging.error(f"Error sending manifest of '{entry['name']}': {str(e)}")
+        return
+    catalog.finish_part_transfer(chat_id, entry['id'])
+    record_download(entry)
+    progress.done(manifest_name)
+    logging.info(f"User '{username}' downloaded file '{entry['name']}' in {len(parts)} parts.",
+                 extra={'file': entry['name'], 'bytes': entry['size']})
+
+
+def send_zip(message, username, entries, progress):
+    zip_name = f"files_{time.strftime('%Y%m%d_%H%M%S')}.zip"
+    fd, zip_path = tempfile.mkstemp(suffix='.zip')
+    os.close(fd)
+    try:
+        write_zip(zip_path, [(lambda entry=entry: store.open(entry), entry['name']) for entry in entries])
+
+        def send(path):
+            # Opened on every attempt: a retry after a 429 must not get the reader the first attempt used up
+            with open(path, 'rb') as f:
+                bot.send_document(message.chat.id, SizedFile(f, os.path.getsize(path)), visible_file_name=zip_name, timeout=180)
+
+        started = time.perf_counter()
+        download_pool.submit(with_retry_after, send, zip_path).result()
+        metrics.record_transfer('download', os.path.getsize(zip_path), time.perf_counter() - started)
+        progress.done(f"{zip_name} ({len(entries)} files)")
+        for entry in entries:
+            record_download(entry)
+        logging.info(f"User '{username}' downloaded {len(entries)} files as '{zip_name}'.",
+                     extra={'file': zip_name, 'bytes': os.path.getsize(zip_path)})
+    except Exception as e:
+        progress.done(zip_name, describe_send_error(e))
+        logging.error(f"Error sending zip '{zip_name}': {str(e)}")
+    finally:
+        os.remove(zip_path)
 
 
 @bot.message_handler(commands=['rename'])
@@ -391,23 +959,24 @@ def handle_rename(message):
 
     text_split = message.text.split()
     if len(text_split) < 3 or not text_split[1].isdigit():
-        bot.reply_to(message, "❓ Please provide a file index and the new file name after the /rename command.")
+        bot.reply_to(message, "❓ Please provide a file ID and the new file name after the /rename command.")
         return
 
-    file_index = int(text_split[1]) - 1  # Convert to zero-based index
+    file_id = int(text_split[1])
     new_file_name = text_split[2]
-    files = os.listdir(UPLOAD_DIR)
+    entry = store.get(file_id, file_owner(message.from_user))
 
-    if 0 <= file_index < len(files):  # Validate file index
-        old_file_name = files[file_index]
-        old_file_path = os.path.join(UPLOAD_DIR, old_file_name)
-        new_file_path = os.path.join(UPLOAD_DIR, new_file_name)
+    if entry is not None:  # Validate file ID
+        old_file_name = entry['name']
 
-        if os.path.exists(old_file_path):
+        if store.get_by_name(new_file_name, entry['owner']) is not None:
+            bot.reply_to(message, f"❌ A file named {new_file_name} already exists.")
+        elif store.exists(entry):
             try:
-                os.rename(old_file_path, new_file_path)
+                store.rename(file_id, new_file_name)
                 bot.reply_to(message, f"✏️ File renamed successfully from {old_file_name} to {new_file_name}.")
-                logging.info(f"User '{user_sessions[message.chat.id]}' renamed file '{old_file_name}' to '{new_file_name}'.")
+                logging.info(f"User '{user_sessions[message.chat.id]}' renamed file '{old_file_name}' to '{new_file_name}'.",
+                             extra={'file': new_file_name})
             except Exception as e:
                 bot.reply_to(message, f"❌ Failed to rename file: {str(e)}")
                 logging.error(f"Error renaming file for user '{user_sessions[message.chat.id]}': {str(e)}")
@@ -415,7 +984,7 @@ def handle_rename(message):
             bot.reply_to(message, f"❌ File '{old_file_name}' not found.")
             logging.warning(f"File '{old_file_name}' not found for user '{user_sessions[message.chat.id]}'.")
     else:
-        bot.reply_to(message, "❌ Invalid file index.")
+        bot.reply_to(message, "❌ Invalid file ID.")
 
 
 @bot.message_handler(commands=['delete'])
@@ -426,33 +995,32 @@ def handle_delete(message):
 
     text_split = message.text.split()
     if len(text_split) < 2:
-        bot.reply_to(message, "❓ Please provide file indices after the /delete command (e.g., /delete 1 3 5).")
+        bot.reply_to(message, "❓ Please provide file IDs after the /delete command (e.g., /delete 1 3 5).")
         return
 
-    file_indices = [int(i) - 1 for i in text_split[1:] if i.isdigit()]
-    files = os.listdir(UPLOAD_DIR)
+    requested_ids = [int(i) for i in text_split[1:] if i.isdigit()]
     deleted_files = []
     not_found_files = []
 
-    for index in file_indices:
-        if 0 <= index < len(files):  # Check if index is valid
-            file_name = files[index]
-            file_path = os.path.join(UPLOAD_DIR, file_name)
+    for file_id in requested_ids:
+        entry = store.get(file_id, file_owner(message.from_user))
+        if entry is not None:  # Check if ID is valid
+            file_name = entry['name']
             try:
-                os.remove(file_path)
+                store.delete(file_id)
                 deleted_files.append(file_name)
-                logging.info(f"User '{user_sessions[message.chat.id]}' deleted file '{file_name}'.")
+                logging.info(f"User '{user_sessions[message.chat.id]}' deleted file '{file_name}'.", extra={'file': file_name})
             except Exception as e:
                 bot.reply_to(message, f"❌ Failed to delete file '{file_name}': {str(e)}")
                 logging.error(f"Error deleting file for user '{user_sessions[message.chat.id]}': {str(e)}")
         else:
-            not_found_files.append(str(index + 1))
+            not_found_files.append(str(file_id))
 
     # Response messages
     if deleted_files:
         bot.reply_to(message, f"✅ Successfully deleted files:\n- {', '.join(deleted_files)}.")
     if not_found_files:
-        bot.reply_to(message, f"❌ Invalid indices: {', '.join(not_found_files)}.")
+        bot.reply_to(message, f"❌ Invalid IDs: {', '.join(not_found_files)}.")
 
 
 @bot.message_handler(commands=['list'])
@@ -461,13 +1029,64 @@ def handle_list(message):
         bot.reply_to(message, "❌ You need to log in first. Please use the /login command.")
         return
 
-    files = os.listdir(UPLOAD_DIR)
-    if not files:
-        bot.reply_to(message, "📁 No files uploaded yet.")
-    else:
-        file_list = "\n".join([f"{i + 1}. {file}" for i, file in enumerate(files)])  # Add index
-        bot.reply_to(message, f"📁 Uploaded files:\n{file_list}")
-        logging.info(f"User '{user_sessions[message.chat.id]}' requested file list.")
+    try:
+        query = ListQuery.parse(message.text.split()[1:])
+    except ValueError as e:
+        bot.reply_to(message, f"❓ {str(e).capitalize()}. Use: /list [id|name|size|date] [asc|desc] [pattern]")
+        return
+
+    text, markup = render_list_page(query, 1, file_owner(message.from_user))
+    bot.reply_to(message, text, reply_markup=markup)
+    logging.info(f"User '{user_sessions[message.chat.id]}' requested file list.")
+
+
+def render_list_page(query, page, owner):
+    """Text and Prev/Next keyboard for one page of owner's /list."""
+    entries, page, pages, total = listing.page(query, page, LIST_PAGE_SIZE, owner)
+    if not total:
+        if query.pattern:
+            return f"📁 No files match {query.pattern}.", None
+        return "📁 No files uploaded yet.", None
+
+    lines = []
+    for entry in entries:
+        name = entry['name'] if len(entry['name']) <= LIST_NAME_WIDTH else entry['name'][:LIST_NAME_WIDTH - 1] + "…"
+        if query.sort == 'size':
+            name += f" ({entry['size'] / (1024 * 1024):.2f} MB)"
+        elif query.sort == 'date':
+            name += f" ({time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['mtime']))})"
+        lines.append(f"{entry['id']}. {name}")
+    header = "📁 Uploaded files" if query.key() == ListQuery().key() else f"📁 Uploaded files {query.describe()}"
+    text = f"{header} (page {page}/{pages}, {total} file{'s' if total != 1 else ''}):\n" + "\n".join(lines)
+
+    if pages == 1:
+        return text, None
+    markup = telebot.types.InlineKeyboardMarkup()
+    buttons = []
+    if page > 1:
+        buttons.append(telebot.types.InlineKeyboardButton(text='⬅️ Prev', callback_data=listing.callback_data(query, page - 1)))
+    if page < pages:
+        buttons.append(telebot.types.InlineKeyboardButton(text='Next ➡️', callback_data=listing.callback_data(query, page + 1)))
+    markup.row(*buttons)
+    return text, markup
+
+
+def handle_list_page(call):
+    bot.answer_callback_query(call.id)
+    if not is_authenticated(call.message):
+        bot.send_message(call.message.chat.id, "❌ You need to log in first. Please use the /login command.")
+        return
+    parsed = listing.parse_callback(call.data)
+    if parsed is None:
+        bot.send_message(call.message.chat.id, "⌛ This list has expired. Please send /list again.")
+        return
+    query, page = parsed
+    text, markup = render_list_page(query, page, file_owner(call.from_user))
+    try:
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    except telebot.apihelper.ApiTelegramException as e:
+        if 'message is not modified' not in e.description:  # the same page tapped twice
+            raise
 
 
 @bot.message_handler(commands=['metadata'])
@@ -478,31 +1097,36 @@ def handle_metadata(message):
 
     text_split = message.text.split()
     if len(text_split) < 2 or not text_split[1].isdigit():
-        bot.reply_to(message, "❓ Please provide a valid file index after the /metadata command.")
+        bot.reply_to(message, "❓ Please provide a valid file ID after the /metadata command.")
         return
 
-    file_index = int(text_split[1]) - 1  # Convert to zero-based index
-    files = os.listdir(UPLOAD_DIR)
+    file_id = int(text_split[1])
+    entry = store.get(file_id, file_owner(message.from_user))
 
-    if 0 <= file_index < len(files):  # Validate file index
-        file_name = files[file_index]
-        file_path = os.path.join(UPLOAD_DIR, file_name)
+    if entry is not None:  # Validate file ID
+        file_name = entry['name']
+        file_path = store.path(entry)
 
         if os.path.exists(file_path):
-            file_size = os.path.getsize(file_path)
             file_creation_time = os.path.getctime(file_path)
-            file_modification_time = os.path.getmtime(file_path)
 
             # Format the timestamps
             creation_time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(file_creation_time))
-            modification_time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(file_modification_time))
+            modification_time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry['mtime']))
+            last_download_str = (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry['last_download']))
+                                 if entry['last_download'] else "never")
 
             metadata_info = f"""
 📄 File Metadata:
+- ID: {entry['id']}
 - Name: {file_name}
-- Size: {file_size} bytes
+- Size: {entry['size']} bytes ({store.disk_size(entry)} bytes on disk)
 - Created: {creation_time_str}
 - Modified: {modification_time_str}
+- Uploaded by: {f"Telegram user {entry['owner']}" if entry['owner'] else 'unknown'}
+- Last Downloaded: {last_download_str}
+- Pinned: {'yes, never evicted' if entry['pinned'] else 'no'}
+- SHA-256: {entry['sha256'] or 'not computed'}
 """
             bot.reply_to(message, metadata_info)
             logging.info(f"User '{user_sessions[message.chat.id]}' requested metadata for file '{file_name}'.")
@@ -510,10 +1134,194 @@ def handle_metadata(message):
             bot.reply_to(message, f"❌ File '{file_name}' not found.")
             logging.warning(f"File '{file_name}' not found for user '{user_sessions[message.chat.id]}'.")
     else:
-        bot.reply_to(message, "❌ Invalid file index.")
-     
+        bot.reply_to(message, "❌ Invalid file ID.")
+
+
+@bot.message_handler(commands=['pin', 'unpin'])
+def handle_pin(message):
+    if not is_authenticated(message):
+        bot.reply_to(message, "❌ You need to log in first. Please use the /login command.")
+        return
+
+    text_split = message.text.split()
+    pin = text_split[0].split('@')[0].lower() == '/pin'
+    if len(text_split) < 2:
+        bot.reply_to(message, f"❓ Please provide file IDs after the /{'pin' if pin else 'unpin'} command (e.g., /{'pin' if pin else 'unpin'} 1 3).")
+        return
+
+    changed_files = []
+    not_found_files = []
+    for file_id in (int(i) for i in text_split[1:] if i.isdigit()):
+        entry = store.get(file_id, file_owner(message.from_user))
+        if entry is None:
+            not_found_files.append(str(file_id))
+            continue
+        store.set_pinned(file_id, pin)
+        changed_files.append(entry['name'])
+        logging.info(f"User '{user_sessions[message.chat.id]}' {'pinned' if pin else 'unpinned'} file '{entry['name']}'.",
+                     extra={'file': entry['name']})
+
+    if changed_files:
+        if pin:
+            bot.reply_to(message, f"📌 Pinned, these will not be evicted when storage runs low:\n- {', '.join(changed_files)}.")
+        else:
+            bot.reply_to(message, f"✅ Unpinned:\n- {', '.join(changed_files)}.")
+    if not_found_files:
+        bot.reply_to(message, f"❌ Invalid IDs: {', '.join(not_found_files)}.")
+
+JOB_STATE_ICONS = {'queued': '⏳', 'running': '🔄', 'done': '✅', 'failed': '❌'}
+
+
+@bot.message_handler(commands=['jobs'])
+def handle_jobs(message):
+    if not is_authenticated(message):
+        bot.reply_to(message, "❌ You need to log in first. Please use the /login command.")
+        return
+
+    counts = jobs.stats()
+    lines = [f"🧾 Transfer queue: {counts['queued']} queued, {counts['running']} running, "
+             f"{counts['done']} done, {counts['failed']} failed."]
+    recent = jobs.recent(message.chat.id, JOBS_SHOWN)
+    if recent:
+        lines.append("\nYour latest jobs:")
+    else:
+        lines.append("\nYou have no uploads or downloads queued.")
+    for job in recent:
+        line = f"{JOB_STATE_ICONS[job['state']]} {job['id']}. {job['kind']} {job['description']}: {job['state']}"
+        if job['state'] == 'queued' and job['attempts']:
+            line += f" (attempt {job['attempts'] + 1} of {JOB_MAX_ATTEMPTS} after: {job['error']})"
+        elif job['state'] == 'failed':
+            line += f" ({job['error']})"
+        lines.append(line)
+    bot.reply_to(message, "\n".join(lines))
+    logging.info(f"User '{user_sessions[message.chat.id]}' requested the job queue.")
+
+
+def report_failed_job(job, error):
+    bot.reply_to(job_message(job), f"❌ Job {job['id']} ({job['kind']} of {job['description']}) failed: {describe_send_error(error)}")
+
+
+jobs.register('upload', run_upload_job)
+jobs.register('download', run_download_job)
+jobs.on_failed = report_failed_job
+
+
+def start_jobs():
+    """Queues again the jobs the last run left unfinished, telling their chats, and starts the job workers."""
+    for job in jobs.recover():
+        try:
+            bot.reply_to(job_message(job), f"🔁 The bot restarted during job {job['id']} ({job['kind']} of {job['description']}); it has been queued again.")
+        except Exception as e:
+            logging.warning(f"Could not tell chat {job['chat_id']} about requeued job {job['id']}: {str(e)}")
+    removed = jobs.prune(JOB_RETENTION)
+    if removed:
+        logging.info(f"Pruned {removed} finished jobs.")
+    jobs.start()
+
+
+def start_services(run_jobs=True):
+    """Brings storage in line with the catalog and starts the background workers. Run before taking updates.
+
+    Without run_jobs (--profile-startup), jobs the last run left unfinished stay as they are and no job worker starts.
+    """
+    store.reconcile()
+    usage.add(scan_directory_size(assembler.parts_dir))
+    usage.start_background_scan(USAGE_SCAN_INTERVAL)
+    evictor.start(EVICTION_INTERVAL)
+    user_sessions.start_sweeper(SESSION_SWEEP_INTERVAL)
+    if run_jobs:
+        start_jobs()
+
+
+def start_webhook():
+    """Serves the webhook on the keep-alive server and points Telegram at it."""
+    from keep_alive import keep_alive
+
+    if not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL must be set when UPDATE_MODE is webhook")
+    server = keep_alive(check_liveness, check_readiness, webhook_handler=bot.process_webhook_update,
+                        webhook_path=WEBHOOK_PATH, webhook_secret=WEBHOOK_SECRET)
+    bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                    max_connections=WEBHOOK_MAX_CONNECTIONS)
+    webhook_registered.set()
+    logging.info(f"Receiving updates by webhook at {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}.")
+    return server
+
+
+def start_polling(first_updates_only=False):
+    """Starts the keep-alive server if enabled and runs the getUpdates loop on a daemon thread.
+
+    With first_updates_only (--profile-startup), makes a single getUpdates instead and returns None.
+    Its updates are neither handled nor confirmed, so the next real start still receives them.
+    """
+    if KEEP_ALIVE:
+        from keep_alive import keep_alive
+        keep_alive(check_liveness, check_readiness)
+    # polling() asks for getMe only to log the bot's name; fetch it while the webhook is being removed
+    get_me = threading.Thread(target=lambda: bot.user, name='get-me', daemon=True)
+    get_me.start()
+    bot.remove_webhook()  # getUpdates is refused while a webhook is set
+    get_me.join()
+    if first_updates_only:
+        bot.get_updates(limit=1, timeout=0)  # no offset confirms nothing; timeout=0 answers without long-polling
+        return None
+    thread = threading.Thread(target=bot.polling, name='polling', daemon=True)
+    thread.start()
+    return thread
+
+
+# Imported by the feature that needs them rather than at startup; --profile-startup lists the ones loaded
+DEFERRED_MODULES = ('dotenv', 'psutil', 'keep_alive', 'http.server')
+
+
+def report_startup(phases):
+    """Prints and logs --profile-startup's report of (label, seconds) phases."""
+    deferred_loaded = [name for name in DEFERRED_MODULES if name in sys.modules]
+    import psutil
+
+    # The process's age minus the time since bot.py's first line; psutil's start time is only good to 10 ms or so
+    before_import = (time.time() - psutil.Process().create_time()) - (time.perf_counter() - IMPORT_STARTED)
+    lines = ["⏱️ Startup profile:", f"- Interpreter start until bot.py runs: {before_import * 1000:.0f} ms"]
+    total = before_import
+    for label, seconds in phases:
+        lines.append(f"- {label}: {seconds * 1000:.0f} ms")
+        total += seconds
+    lines.append(f"- Total since the process started: {total * 1000:.0f} ms")
+    lines.append(f"Deferred modules loaded so far: {', '.join(deferred_loaded) or 'none'}")
+    lines.append("For a per-module breakdown run: python -X importtime bot.py --profile-startup")
+    print("\n".join(lines))
+    logging.info(" ".join(lines))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VortXtra, a Telegram bot that stores files.")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="report how long imports, setup and the first getUpdates take, then exit without "
+                             "handling updates or running jobs")
+    args = parser.parse_args()
+
+    phases = [("Imports and module setup", time.perf_counter() - IMPORT_STARTED)]
+    started = time.perf_counter()
+    start_services(run_jobs=not args.profile_startup)
+    phases.append(("Storage check and background workers", time.perf_counter() - started))
+
+    if args.profile_startup:
+        # Nothing may reach the handlers: a webhook is not registered, and the one getUpdates is left unhandled
+        if UPDATE_MODE != 'webhook':
+            started = time.perf_counter()
+            start_polling(first_updates_only=True)
+            phases.append(("Keep-alive server, getMe, deleteWebhook and the first getUpdates",
+                           time.perf_counter() - started))
+        report_startup(phases)
+        return
+
+    if UPDATE_MODE == 'webhook':
+        start_webhook()
+        threading.Event().wait()  # updates arrive on the keep-alive server's threads from here on
+    else:
+        # Polling only ends if getUpdates fails for good; the process exits then and the host restarts it
+        start_polling().join()
 
-keep_alive()
 
-# Start the bot
-bot.polling()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# -*- mode: python ; coding: utf-8 -*-
+# PyInstaller build profile for a frozen bot that starts quickly:
+#
+#     pip install pyinstaller
+#     pyinstaller bot.spec
+#     dist/vortxtra/vortxtra --profile-startup
+#
+# It builds a folder rather than --onefile: a one-file binary unpacks itself into a temp
+# directory on every start, which takes longer than the rest of startup put together. UPX is
+# off for the same reason (every start would decompress the libraries again). The modules the
+# bot imports lazily (psutil, dotenv, keep_alive) are still found by the analysis; packages it
+# never uses are left out to keep the archive small.
+
+a = Analysis(
+    ['bot.py'],
+    pathex=[],
+    binaries=[],
+    datas=[],
+    hiddenimports=[],
+    hookspath=[],
+    runtime_hooks=[],
+    excludes=[
+        'tkinter', 'unittest', 'doctest', 'pydoc', 'pdb', 'lib2to3', 'xmlrpc', 'test',
+        'setuptools', 'pkg_resources', 'distutils', 'pip',
+        'rich', 'tqdm', 'PIL', 'aiohttp', 'ujson', 'coloredlogs', 'redis', 'flask', 'werkzeug',
+    ],
+    noarchive=False,
+    optimize=1,  # bytecode compiled once at build time, without asserts
+)
+pyz = PYZ(a.pure)
+
+exe = EXE(
+    pyz,
+    a.scripts,
+    [],
+    exclude_binaries=True,
+    name='vortxtra',
+    debug=False,
+    bootloader_ignore_signals=False,
+    strip=False,
+    upx=False,
+    console=True,
+)
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=False,
+    name='vortxtra',
+)
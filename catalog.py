@@ -0,0 +1,410 @@
+import itertools
+import json
+import os
+
+from sqlite_db import SQLiteDatabase
+
+SCHEMA = """
+-- Names are unique per owner, the uploader's Telegram user id; entries without an owner predate per-user
+-- namespaces and are visible to everyone.
+-- last_download and pinned steer the eviction policy
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    owner TEXT,
+    sha256 TEXT,
+    last_download REAL,
+    pinned INTEGER NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX IF NOT EXISTS files_owner_name ON files (IFNULL(owner, ''), name);
+CREATE INDEX IF NOT EXISTS files_owner ON files (owner);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+
+-- Stored contents, shared by every file entry with the same hash. size is the contents' own size,
+-- stored_size what they take on disk (NULL: the same), compressed whether they are kept gzipped
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refcount INTEGER NOT NULL,
+    stored_size INTEGER,
+    compressed INTEGER NOT NULL DEFAULT 0
+);
+
+-- Telegram's file_unique_id of content we already have, so re-uploads skip the fetch
+CREATE TABLE IF NOT EXISTS unique_ids (
+    file_unique_id TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL
+);
+
+-- Telegram file_ids that can re-send a blob under a given file name without uploading it
+CREATE TABLE IF NOT EXISTS telegram_file_ids (
+    sha256 TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    PRIMARY KEY (sha256, file_name)
+);
+
+-- Progress of files sent to a chat in parts, so an interrupted /download resumes after the last part
+CREATE TABLE IF NOT EXISTS part_transfers (
+    chat_id INTEGER NOT NULL,
+    file_id INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    part_size INTEGER NOT NULL,
+    part_hashes TEXT NOT NULL,
+    PRIMARY KEY (chat_id, file_id)
+);
+"""
+
+# ORDER BY clauses of the eviction policies over eviction_candidates' columns
+EVICTION_ORDERS = {
+    'lru': "last_used, added",
+    'oldest': "added, last_used",
+    'largest': "stored_size DESC, last_used",
+}
+
+
+# PRAGMA user_version from which owners are Telegram user ids rather than the login username
+OWNER_IDS_VERSION = 1
+
+
+def visible_to(entry, owner):
+    """Whether owner can see an entry: their own, or one from before per-user names (no owner)."""
+    return entry['owner'] is None or entry['owner'] == owner
+
+
+class FileCatalog:
+    """SQLite index of the stored files, addressed by stable file IDs."""
+
+    def __init__(self, db_path):
+        self.db = SQLiteDatabase(db_path, self._setup)  # opened, created and migrated on first use
+        self.versions = itertools.count(1)
+        self.version = 0  # changes whenever a file entry is added, renamed or removed in this process
+        self.listeners = []  # called with (file ID, new name or None if removed, owner) after each such change
+
+    def _setup(self, conn):
+        self._drop_global_name_constraint(conn)
+        conn.executescript(SCHEMA)
+        self._add_missing_columns(conn)
+        if conn.execute("PRAGMA user_version").fetchone()[0] < OWNER_IDS_VERSION:
+            self._unown_login_names()
+
+    def connect(self):
+        return self.db.connect()
+
+    def write(self):
+        return self.db.write()
+
+    # -- file entries ----------------------------------------------------------
+
+    def add(self, name, size, mtime, owner, sha256, replace=False, stored_size=None, compressed=False):
+        """Adds an entry for the blob sha256 under owner's name.
+
+        If owner already has a file with that name, the new one is called "name (2).ext" (or the
+        next free number) instead, unless replace is set, in which case the existing entry is
+        pointed at the new blob and keeps its ID. stored_size and compressed describe a blob
+        added by this call; an existing blob keeps its own.
+
+        Returns (file ID, name given, released) where released is the (sha256, size on disk, size,
+        compressed) of a blob nothing refers to any more, or None.
+        """
+        with self.write() as conn:
+            old = self._by_name(conn, name, owner)
+            released = None
+            if old is not None and replace:
+                conn.execute("UPDATE files SET size = ?, mtime = ?, sha256 = ? WHERE id = ?",
+                             (size, mtime, sha256, old['id']))
+                file_id = old['id']
+            else:
+                if old is not None:
+                    name = self._free_name(conn, name, owner)
+                file_id = conn.execute("INSERT INTO files (name, size, mtime, owner, sha256) VALUES (?, ?, ?, ?, ?)",
+                                       (name, size, mtime, owner, sha256)).lastrowid
+            conn.execute(
+                "INSERT INTO blobs (sha256, size, refcount, stored_size, compressed) VALUES (?, ?, 1, ?, ?) "
+                "ON CONFLICT(sha256) DO UPDATE SET refcount = refcount + 1",
+                (sha256, size, stored_size, int(compressed))
+            )
+            if old is not None and replace:
+                released = self._decref(conn, old['sha256'])
+        self.files_changed(file_id, name, owner)
+        return file_id, name, released
+
+    def get(self, file_id):
+        return self.connect().execute("SELECT * FROM files WHERE id = ?", (file_id,)).fetchone()
+
+    def get_by_name(self, name, owner):
+        return self._by_name(self.connect(), name, owner)
+
+    def named(self, name):
+        """Every entry called name, whoever owns it."""
+        return self.connect().execute("SELECT * FROM files WHERE name = ? ORDER BY id", (name,)).fetchall()
+
+    def list_files(self):
+        return self.connect().execute("SELECT * FROM files ORDER BY id").fetchall()
+
+    def count(self):
+        return self.connect().execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def rename(self, file_id, new_name):
+        """Raises sqlite3.IntegrityError if the owner already has a file called new_name."""
+        with self.write() as conn:
+            conn.execute("UPDATE files SET name = ? WHERE id = ?", (new_name, file_id))
+            row = conn.execute("SELECT owner FROM files WHERE id = ?", (file_id,)).fetchone()
+        self.files_changed(file_id, new_name, row['owner'] if row else None)
+
+    def _unown_login_names(self):
+        """Makes entries owned by a login username unowned again, like those from before per-user names.
+
+        Every user logs in with the same username, so it never told them apart; whose files these
+        are is unknown, and migrate_uploads.py can give them to someone.
+        """
+        with self.write() as conn:
+            for row in conn.execute("SELECT id, name FROM files WHERE owner GLOB '*[^0-9]*' OR owner = '' "
+                                    "ORDER BY id").fetchall():
+                name = row['name']
+                if self._by_name(conn, name, None) is not None:
+                    name = self._free_name(conn, name, None)
+                conn.execute("UPDATE files SET owner = NULL, name = ? WHERE id = ?", (name, row['id']))
+            conn.execute(f"PRAGMA user_version = {OWNER_IDS_VERSION}")
+
+    def claim_unowned(self, owner):
+        """Gives every entry without an owner to owner, renaming it if owner already has that name.
+
+        Returns (number of entries claimed, [(old name, new name)] of the renamed ones).
+        """
+        claimed = []
+        renamed = []
+        with self.write() as conn:
+            for row in conn.execute("SELECT id, name FROM files WHERE owner IS NULL ORDER BY id").fetchall():
+                name = row['name']
+                if self._by_name(conn, name, owner) is not None:
+                    name = self._free_name(conn, name, owner)
+                    renamed.append((row['name'], name))
+                conn.execute("UPDATE files SET owner = ?, name = ? WHERE id = ?", (owner, name, row['id']))
+                claimed.append((row['id'], name))
+        for file_id, name in claimed:
+            self.files_changed(file_id, name, owner)
+        return len(claimed), renamed
+
+    def remove(self, file_id):
+        """Deletes an entry. Returns its blob as add() does for released if nothing else refers to it, else None."""
+        with self.write() as conn:
+            row = conn.execute("SELECT sha256 FROM files WHERE id = ?", (file_id,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+            released = self._decref(conn, row['sha256'])
+        self.files_changed(file_id, None, None)
+        return released
+
+    def record_download(self, file_id, when):
+        with self.write() as conn:
+            conn.execute("UPDATE files SET last_download = ? WHERE id = ?", (when, file_id))
+
+    def set_pinned(self, file_id, pinned):
+        """Pinned entries, and the contents they point at, are never evicted. Returns whether the entry changed."""
+        with self.write() as conn:
+            return conn.execute("UPDATE files SET pinned = ? WHERE id = ? AND pinned != ?",
+                                (int(pinned), file_id, int(pinned))).rowcount > 0
+
+    def pinned_count(self):
+        return self.connect().execute("SELECT COUNT(*) FROM files WHERE pinned").fetchone()[0]
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+
+    def files_changed(self, file_id, name, owner):
+        # next() on a count is atomic, so concurrent writers never hand out the same version
+        self.version = next(self.versions)
+        for callback in self.listeners:
+            callback(file_id, name, owner)
+
+    @staticmethod
+    def _by_name(conn, name, owner):
+        # Spelled like the files_owner_name index so the lookup uses it
+        return conn.execute("SELECT * FROM files WHERE IFNULL(owner, '') = IFNULL(?, '') AND name = ?",
+                            (owner, name)).fetchone()
+
+    def _free_name(self, conn, name, owner):
+        stem, ext = os.path.splitext(name)
+        for n in itertools.count(2):
+            candidate = f"{stem} ({n}){ext}"
+            if self._by_name(conn, candidate, owner) is None:
+                return candidate
+
+    # Columns added since the first catalogs; older ones get them with these defaults
+    ADDED_COLUMNS = (
+        ('blobs', 'stored_size', 'INTEGER'),  # NULL: stored as is
+        ('blobs', 'compressed', 'INTEGER NOT NULL DEFAULT 0'),
+        ('files', 'last_download', 'REAL'),
+        ('files', 'pinned', 'INTEGER NOT NULL DEFAULT 0'),
+    )
+
+    def _add_missing_columns(self, conn):
+        for table, column, definition in self.ADDED_COLUMNS:
+            if column not in {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    @staticmethod
+    def _drop_global_name_constraint(conn):
+        """Rebuilds a files table from before per-user names, whose name column was UNIQUE across everyone."""
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'files'").fetchone()
+        if row is None or 'name TEXT NOT NULL UNIQUE' not in row[0]:
+            return
+        conn.executescript("""
+            BEGIN IMMEDIATE;
+            ALTER TABLE files RENAME TO files_global_names;
+            CREATE TABLE files (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                owner TEXT,
+                sha256 TEXT
+            );
+            INSERT INTO files (id, name, size, mtime, owner, sha256)
+                SELECT id, name, size, mtime, owner, sha256 FROM files_global_names;
+            DELETE FROM sqlite_sequence WHERE name = 'files';
+            UPDATE sqlite_sequence SET name = 'files' WHERE name = 'files_global_names';  -- IDs are never reused
+            DROP TABLE files_global_names;
+            COMMIT;
+        """)
+
+    # -- blobs -----------------------------------------------------------------
+
+    def get_blob(self, sha256):
+        return self.connect().execute("SELECT * FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+
+    def blob_hashes(self):
+        return {row[0] for row in self.connect().execute("SELECT sha256 FROM blobs")}
+
+    def stored_size(self):
+        """Bytes the blobs take up on disk."""
+        return self.connect().execute("SELECT COALESCE(SUM(IFNULL(stored_size, size)), 0) FROM blobs").fetchone()[0]
+
+    def logical_size(self):
+        """Bytes of distinct content stored, before compression."""
+        return self.connect().execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def compression_stats(self):
+        """(compressed blobs, their size, their size on disk)."""
+        row = self.connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(stored_size), 0) FROM blobs WHERE compressed"
+        ).fetchone()
+        return tuple(row)
+
+    def sha256_for_unique_id(self, file_unique_id):
+        row = self.connect().execute(
+            "SELECT u.sha256 FROM unique_ids u JOIN blobs b ON b.sha256 = u.sha256 WHERE u.file_unique_id = ?",
+            (file_unique_id,)
+        ).fetchone()
+        return row['sha256'] if row else None
+
+    def remember_unique_id(self, file_unique_id, sha256):
+        with self.write() as conn:
+            conn.execute("INSERT OR REPLACE INTO unique_ids (file_unique_id, sha256) VALUES (?, ?)",
+                         (file_unique_id, sha256))
+
+    def get_telegram_file_id(self, sha256, file_name):
+        row = self.connect().execute(
+            "SELECT file_id FROM telegram_file_ids WHERE sha256 = ? AND file_name = ?", (sha256, file_name)
+        ).fetchone()
+        return row['file_id'] if row else None
+
+    def set_telegram_file_id(self, sha256, file_name, file_id):
+        with self.write() as conn:
+            conn.execute("INSERT OR REPLACE INTO telegram_file_ids (sha256, file_name, file_id) VALUES (?, ?, ?)",
+                         (sha256, file_name, file_id))
+
+    def forget_telegram_file_id(self, sha256, file_name):
+        with self.write() as conn:
+            conn.execute("DELETE FROM telegram_file_ids WHERE sha256 = ? AND file_name = ?", (sha256, file_name))
+
+    # -- chunked transfers -----------------------------------------------------
+
+    def get_part_transfer(self, chat_id, file_id):
+        return self.connect().execute(
+            "SELECT * FROM part_transfers WHERE chat_id = ? AND file_id = ?", (chat_id, file_id)
+        ).fetchone()
+
+    def save_part_transfer(self, chat_id, file_id, sha256, part_size, part_hashes):
+        with self.write() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO part_transfers (chat_id, file_id, sha256, part_size, part_hashes) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (chat_id, file_id, sha256, part_size, json.dumps(part_hashes))
+            )
+
+    def finish_part_transfer(self, chat_id, file_id):
+        with self.write() as conn:
+            conn.execute("DELETE FROM part_transfers WHERE chat_id = ? AND file_id = ?", (chat_id, file_id))
+
+    def repair_refcounts(self):
+        """Recounts blob references from the file entries. Returns the blobs left unreferenced."""
+        with self.write() as conn:
+            conn.execute("UPDATE blobs SET refcount = (SELECT COUNT(*) FROM files WHERE files.sha256 = blobs.sha256)")
+            released = [(row['sha256'], row['size']) for row in conn.execute(
+                "SELECT sha256, IFNULL(stored_size, size) AS size FROM blobs WHERE refcount <= 0").fetchall()]
+            conn.execute("DELETE FROM blobs WHERE refcount <= 0")
+            conn.execute("DELETE FROM unique_ids WHERE sha256 NOT IN (SELECT sha256 FROM blobs)")
+            conn.execute("DELETE FROM telegram_file_ids WHERE sha256 NOT IN (SELECT sha256 FROM blobs)")
+        return released
+
+    def eviction_candidates(self, order, added_before, limit):
+        """Up to limit blobs that may be evicted, first to go first.
+
+        order is one of EVICTION_ORDERS. A blob qualifies if none of its entries is pinned or
+        was added after added_before. Each row has sha256, stored_size, last_used (latest download,
+        or upload if never downloaded, over its entries) and added (latest upload).
+        """
+        return self.connect().execute(
+            "SELECT b.sha256, IFNULL(b.stored_size, b.size) AS stored_size, "
+            "MAX(IFNULL(f.last_download, f.mtime)) AS last_used, MAX(f.mtime) AS added "
+            "FROM blobs b JOIN files f ON f.sha256 = b.sha256 GROUP BY b.sha256 "
+            f"HAVING MAX(f.pinned) = 0 AND MAX(f.mtime) < ? ORDER BY {EVICTION_ORDERS[order]} LIMIT ?",
+            (added_before, limit)
+        ).fetchall()
+
+    def evictable_size(self, added_before):
+        """Bytes on disk of every blob eviction_candidates() would offer for the same added_before."""
+        return self.connect().execute(
+            "SELECT IFNULL(SUM(stored_size), 0) FROM (SELECT IFNULL(b.stored_size, b.size) AS stored_size "
+            "FROM blobs b JOIN files f ON f.sha256 = b.sha256 GROUP BY b.sha256 "
+            "HAVING MAX(f.pinned) = 0 AND MAX(f.mtime) < ?)",
+            (added_before,)
+        ).fetchone()[0]
+
+    def remove_blob(self, sha256, added_before):
+        """Deletes every entry pointing at the blob sha256, and the blob, if it still qualifies for eviction.
+
+        Returns (the removed entries, the blob as add() returns released) or ([], None).
+        """
+        with self.write() as conn:
+            entries = conn.execute("SELECT * FROM files WHERE sha256 = ?", (sha256,)).fetchall()
+            if not entries or any(entry['pinned'] or entry['mtime'] >= added_before for entry in entries):
+                return [], None  # pinned or re-uploaded since it was picked
+            conn.execute("DELETE FROM files WHERE sha256 = ?", (sha256,))
+            conn.execute("UPDATE blobs SET refcount = 0 WHERE sha256 = ?", (sha256,))
+            released = self._drop_if_unreferenced(conn, sha256)
+        for entry in entries:
+            self.files_changed(entry['id'], None, None)
+        return entries, released
+
+    def _decref(self, conn, sha256):
+        if sha256 is None:
+            return None
+        conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = ?", (sha256,))
+        return self._drop_if_unreferenced(conn, sha256)
+
+    @staticmethod
+    def _drop_if_unreferenced(conn, sha256):
+        row = conn.execute("SELECT IFNULL(stored_size, size) AS stored_size, size, compressed, refcount FROM blobs "
+                           "WHERE sha256 = ?", (sha256,)).fetchone()
+        if row is None or row['refcount'] > 0:
+            return None
+        conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+        conn.execute("DELETE FROM unique_ids WHERE sha256 = ?", (sha256,))
+        conn.execute("DELETE FROM telegram_file_ids WHERE sha256 = ?", (sha256,))
+        return sha256, row['stored_size'], row['size'], bool(row['compressed'])
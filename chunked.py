@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+
+from compression import CompressingWriter
+from transfer import DEFAULT_CHUNK_SIZE, download_to_temp, remove_quietly
+
+DEFAULT_PART_SIZE = 49 * 1024 * 1024  # stays under Telegram's 50 MB limit for bots sending documents
+
+# Parts of a split upload: archive.zip.001, archive.zip.002, ... (the naming 7-Zip and split(1) -d use)
+PART_NAME = re.compile(r'^(?P<base>.+)\.(?P<index>\d{3})$')
+
+
+def plan_parts(size, part_size):
+    """Returns (offset, length) for each part of a file of the given size."""
+    return [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)] or [(0, 0)]
+
+
+def part_name(name, index):
+    return f"{name}.{index + 1:03d}"
+
+
+class FileRange:
+    """Read-only file object over length bytes of an open file starting at offset, hashing what is read.
+
+    Lets a part be sent straight from the stored file instead of being copied out first. The
+    file stays open when the range is closed, so consecutive parts can share one reader (a
+    seek to where the last part ended costs nothing, even on a decompressing reader).
+    """
+
+    def __init__(self, file, offset, length, name):
+        self.name = name
+        self.remaining = length
+        self.sha256 = hashlib.sha256()
+        self.file = file
+        if file.tell() != offset:
+            file.seek(offset)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        self.sha256.update(data)
+        return data
+
+    def __len__(self):
+        return self.remaining  # lets the part be streamed (transfer.MultipartStream)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def build_manifest(name, size, sha256, part_size, part_hashes):
+    """JSON manifest sent after the parts so the receiver can check and rejoin them."""
+    parts = [
+        {'name': part_name(name, index), 'offset': offset, 'size': length, 'sha256': part_hashes[index]}
+        for index, (offset, length) in enumerate(plan_parts(size, part_size))
+    ]
+    manifest = {
+        'name': name,
+        'size': size,
+        'sha256': sha256,
+        'part_size': part_size,
+        'parts': parts,
+        'join': f"cat {name}.[0-9][0-9][0-9] > {name}  (or: copy /b {name}.001+{name}.002+... {name})",
+    }
+    return json.dumps(manifest, indent=2).encode()
+
+
+class PartAssembler:
+    """Holds the parts of split uploads per chat until they are merged into one file.
+
+    Parts are kept as plain files under <parts_dir>/<chat id>/<base name>/<NNN>, so an
+    interrupted batch can be continued after a restart by sending just the missing parts.
+    """
+
+    def __init__(self, parts_dir):
+        self.parts_dir = parts_dir  # created with the first part
+
+    def set_dir(self, chat_id, base):
+        # The base name is user input; keep it to a single path component
+        return os.path.join(self.parts_dir, str(chat_id), base.replace(os.sep, '_').lstrip('.') or '_')
+
+    def save_part(self, chat_id, base, index, session, url, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Streams one part into place, replacing an earlier copy. Returns (size, size of the replaced copy, seconds)."""
+        directory = self.set_dir(chat_id, base)
+        os.makedirs(directory, exist_ok=True)
+        temp_path, size, _, seconds, _ = download_to_temp(session, url, directory, chunk_size)
+        path = os.path.join(directory, f"{index:03d}")
+        replaced = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(temp_path, path)
+        return size, replaced, seconds
+
+    def list_parts(self, chat_id, base):
+        """Returns {index: size} of the parts received so far."""
+        directory = self.set_dir(chat_id, base)
+        if not os.path.isdir(directory):
+            return {}
+        with os.scandir(directory) as entries:
+            return {int(entry.name): entry.stat().st_size for entry in entries
+                    if entry.name.isdigit() and entry.is_file()}
+
+    def pending(self, chat_id):
+        """Base names with parts waiting to be merged for a chat."""
+        directory = os.path.join(self.parts_dir, str(chat_id))
+        if not os.path.isdir(directory):
+            return []
+        with os.scandir(directory) as entries:
+            return sorted(entry.name for entry in entries if entry.is_dir())
+
+    def missing(self, chat_id, base):
+        parts = self.list_parts(chat_id, base)
+        return [index for index in range(1, max(parts, default=0) + 1) if index not in parts]
+
+    def merge(self, chat_id, base, temp_dir, chunk_size=DEFAULT_CHUNK_SIZE, compress_level=None):
+        """Appends the parts in order into a temp file in temp_dir, streaming and hashing.
+
+        With a compress_level the result is gzipped as it is written, as in download_to_temp().
+        Returns (temp_path, size, sha256, compressed); the caller owns the temp file.
+        """
+        directory = self.set_dir(chat_id, base)
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=temp_dir, prefix='.merge-', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f_out:
+                out = CompressingWriter(f_out, compress_level) if compress_level else f_out
+                for index in sorted(self.list_parts(chat_id, base)):
+                    with open(os.path.join(directory, f"{index:03d}"), 'rb') as f:
+                        for data in iter(lambda: f.read(chunk_size), b''):
+                            out.write(data)
+                            sha256.update(data)
+                            size += len(data)
+                if compress_level:
+                    out.finish()
+        except BaseException:
+            remove_quietly(temp_path)
+            raise
+        return temp_path, size, sha256.hexdigest(), bool(compress_level) and out.compressed
+
+    def discard(self, chat_id, base):
+        """Removes the parts of a set. Returns the bytes freed."""
+        freed = sum(self.list_parts(chat_id, base).values())
+        shutil.rmtree(self.set_dir(chat_id, base), ignore_errors=True)
+        return freed
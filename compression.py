@@ -0,0 +1,86 @@
+"""Compression at rest: stored contents are gzipped as they stream in, unless they are compressed already."""
+import gzip
+import zlib
+
+# Leading bytes of formats that are compressed already; gzipping them again costs CPU and saves nothing
+COMPRESSED_MAGIC = (
+    b'\x1f\x8b',                  # gzip, .tgz
+    b'PK\x03\x04',                # zip, docx/xlsx/pptx, odt, jar, apk, epub
+    b'Rar!\x1a\x07',              # rar
+    b'7z\xbc\xaf\x27\x1c',        # 7-Zip
+    b'BZh',                       # bzip2
+    b'\xfd7zXZ\x00',              # xz
+    b'\x28\xb5\x2f\xfd',          # zstd
+    b'\x04\x22\x4d\x18',          # lz4
+    b'\xff\xd8\xff',              # jpeg
+    b'\x89PNG\r\n\x1a\n',         # png
+    b'GIF8',                      # gif
+    b'\x1a\x45\xdf\xa3',          # mkv, webm
+    b'OggS',                      # ogg, opus
+    b'fLaC',                      # flac
+    b'ID3',                       # mp3 with ID3 tags
+    b'\xff\xfb', b'\xff\xf3',     # mp3 frames
+)
+
+SNIFF_SIZE = 64 * 1024  # bytes looked at before deciding
+MIN_SAVING = 0.1  # a sample must shrink by at least this much for the file to be compressed
+
+
+def is_compressed_format(head):
+    if head.startswith(COMPRESSED_MAGIC):
+        return True
+    if head[4:8] == b'ftyp':  # mp4, mov, m4a, 3gp, heic/avif
+        return True
+    return head[:4] == b'RIFF' and head[8:12] == b'WEBP'
+
+
+def worth_compressing(head):
+    """Decides from the first bytes of a file whether gzipping it pays off."""
+    if not head or is_compressed_format(head):
+        return False
+    # Catches what the magic numbers miss (encrypted or random data) at the cost of one fast pass over the sample
+    sample = head[:SNIFF_SIZE]
+    return len(zlib.compress(sample, 1)) <= len(sample) * (1 - MIN_SAVING)
+
+
+class CompressingWriter:
+    """Writes to a binary file, gzipped if the first SNIFF_SIZE bytes say the data is worth compressing.
+
+    Only those first bytes are buffered; call finish() after the last write.
+    """
+
+    def __init__(self, f, level):
+        self.f = f
+        self.level = level
+        self.head = b''  # bytes held back until there are enough to decide on; None once decided
+        self.compressor = None
+
+    @property
+    def compressed(self):
+        return self.compressor is not None
+
+    def write(self, data):
+        if self.head is not None:
+            self.head += data
+            if len(self.head) < SNIFF_SIZE:
+                return
+            data = self._decide()
+        self.f.write(self.compressor.compress(data) if self.compressor is not None else data)
+
+    def finish(self):
+        if self.head is not None:
+            data = self._decide()
+            self.f.write(self.compressor.compress(data) if self.compressor is not None else data)
+        if self.compressor is not None:
+            self.f.write(self.compressor.flush())
+
+    def _decide(self):
+        data, self.head = self.head, None
+        if worth_compressing(data):
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip framing
+        return data
+
+
+def open_blob(path, compressed):
+    """Opens stored contents for reading, decompressing on the fly if they were stored gzipped."""
+    return gzip.open(path, 'rb') if compressed else open(path, 'rb')
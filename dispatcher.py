@@ -0,0 +1,204 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import telebot
+
+import metrics
+from log_pipeline import clear_context, set_context
+
+
+def chat_key(update):
+    """Returns the chat (or user) id an update belongs to, or None if it has none."""
+    chat = getattr(update, 'chat', None)
+    if chat is not None:
+        return chat.id
+    message = getattr(update, 'message', None)  # callback queries
+    if message is not None and getattr(message, 'chat', None) is not None:
+        return message.chat.id
+    from_user = getattr(update, 'from_user', None)  # inline queries, callbacks without a message
+    if from_user is not None:
+        return from_user.id
+    return None
+
+
+def is_command(update):
+    text = getattr(update, 'text', None)
+    return isinstance(text, str) and text.startswith('/')
+
+
+def command_name(update):
+    """'/list' for '/list@VortXtraBot 2', None if the update is not a command."""
+    return update.text.split()[0].split('@')[0].lower() if is_command(update) else None
+
+
+class ChatDispatcher:
+    """Runs tasks on a thread pool while keeping tasks for the same chat in arrival order."""
+
+    def __init__(self, num_workers=8):
+        self.num_workers = num_workers
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='dispatch')
+        self.lock = threading.Lock()
+        self.pending = {}  # chat key -> deque of tasks waiting behind the running one
+        self.waiting = 0  # tasks handed to the executor that no worker has started yet
+
+    def submit(self, key, func, *args, **kwargs):
+        if key is None:
+            # Nothing to order against, run it as soon as a worker is free
+            self._submit(self._run, func, args, kwargs)
+            return
+
+        with self.lock:
+            queue = self.pending.get(key)
+            if queue is not None:
+                # A task for this chat is already running; its worker picks this one up next
+                queue.append((func, args, kwargs))
+                return
+            self.pending[key] = deque()
+
+        self._submit(self._drain, key, func, args, kwargs)
+
+    def queue_depth(self):
+        """Number of tasks not started yet: waiting for a free worker, or behind a running task of the same chat."""
+        with self.lock:
+            return self.waiting + sum(len(queue) for queue in self.pending.values())
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def _submit(self, target, *args):
+        with self.lock:
+            self.waiting += 1
+        self.executor.submit(self._start, target, args)
+
+    def _start(self, target, args):
+        with self.lock:
+            self.waiting -= 1
+        target(*args)
+
+    def _drain(self, key, func, args, kwargs):
+        while True:
+            self._run(func, args, kwargs)
+            with self.lock:
+                queue = self.pending[key]
+                if not queue:
+                    del self.pending[key]
+                    return
+                func, args, kwargs = queue.popleft()
+
+    def _run(self, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            logging.error(f"Unhandled error in handler {getattr(func, '__name__', func)}: {str(e)}")
+
+
+class RecentUpdates:
+    """The last few thousand update_ids seen, so an update Telegram delivers twice is handled once."""
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.order = deque()
+
+    def add(self, update_id):
+        """Records update_id. Returns False if it was already seen."""
+        with self.lock:
+            if update_id in self.seen:
+                return False
+            self.seen.add(update_id)
+            self.order.append(update_id)
+            if len(self.order) > self.size:
+                self.seen.discard(self.order.popleft())
+            return True
+
+
+class DispatchingTeleBot(telebot.TeleBot):
+    """TeleBot that hands every handler to a ChatDispatcher instead of running it on the polling thread."""
+
+    def __init__(self, token, num_workers=8, command_limiter=None, send_scheduler=None, **kwargs):
+        # threaded=False keeps telebot's own worker pool out of the way, the dispatcher replaces it
+        super().__init__(token, threaded=False, **kwargs)
+        self.dispatcher = ChatDispatcher(num_workers)
+        self.command_limiter = command_limiter  # ChatRateLimiter for incoming commands, or None
+        self.send_scheduler = send_scheduler    # SendScheduler pacing outgoing messages, or None
+        self.on_throttled = None                # called with a command dropped by the limiter, once per burst
+        self.last_updates_at = None  # time of the last successful getUpdates, for the liveness check
+        self.recent_updates = RecentUpdates()
+        metrics.QUEUE_DEPTH.callback = self.dispatcher.queue_depth
+
+    def get_updates(self, *args, **kwargs):
+        updates = super().get_updates(*args, **kwargs)
+        self.last_updates_at = time.time()
+        metrics.mark_updates_received()
+        return updates
+
+    def process_webhook_update(self, body):
+        """Queues the handlers for one webhook POST body. Returns False if the update was a redelivery.
+
+        Only parsing and handler matching happen on the caller's thread, so the webhook can be
+        acknowledged straight away; raises ValueError if the body is not an update.
+        """
+        try:
+            update = telebot.types.Update.de_json(json.loads(body))
+        except (KeyError, TypeError, ValueError) as e:
+            metrics.WEBHOOK_UPDATES.inc(result='invalid')
+            raise ValueError(f"not a Telegram update: {e}")
+        if not self.recent_updates.add(update.update_id):
+            metrics.WEBHOOK_UPDATES.inc(result='duplicate')
+            return False
+        metrics.WEBHOOK_UPDATES.inc(result='accepted')
+        self.process_new_updates([update])
+        return True
+
+    def _exec_task(self, task, *args, **kwargs):
+        key = chat_key(args[0]) if args else None
+        if key is not None and self.command_limiter is not None and is_command(args[0]):
+            if not self.command_limiter.allow(key):
+                if self.on_throttled is not None and self.command_limiter.take_warning(key):
+                    self.dispatcher.submit(key, self.on_throttled, args[0])
+                return
+        self.dispatcher.submit(key, self._run_task, task, args, kwargs)
+
+    # Outgoing messages go through the send scheduler; reply_to ends up in send_message
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        send = super().send_message
+        if self.send_scheduler is None:
+            return send(chat_id, text, *args, **kwargs)
+        return self.send_scheduler.call(chat_id, send, (chat_id, text) + args, kwargs)
+
+    def send_document(self, chat_id, document, *args, **kwargs):
+        send = super().send_document
+        if self.send_scheduler is None:
+            return send(chat_id, document, *args, **kwargs)
+        # A file object is read by the first attempt, so only a file_id can be resent as is
+        return self.send_scheduler.call(chat_id, send, (chat_id, document) + args, kwargs,
+                                        retry=isinstance(document, str))
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, *args, **kwargs):
+        edit = super().edit_message_text
+        if self.send_scheduler is None:
+            return edit(text, chat_id, message_id, *args, **kwargs)
+        return self.send_scheduler.call(chat_id, edit, (text, chat_id, message_id) + args, kwargs,
+                                        coalesce_key=(chat_id, message_id) if message_id is not None else None)
+
+    def _run_task(self, task, args, kwargs):
+        handler = getattr(task, '__name__', 'unknown')
+        if args:
+            metrics.record_command(args[0])
+            set_context(chat_id=chat_key(args[0]), command=command_name(args[0]))
+        started = time.perf_counter()
+        try:
+            task(*args, **kwargs)
+        except Exception as e:
+            metrics.HANDLER_ERRORS.inc(handler=handler)
+            if not self._handle_exception(e):
+                raise
+        finally:
+            metrics.HANDLER_SECONDS.observe(time.perf_counter() - started, handler=handler)
+            clear_context()
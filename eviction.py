@@ -0,0 +1,154 @@
+"""Frees space in the upload store by deleting files once usage passes a high-water mark.
+
+A background thread checks usage every interval and whenever an upload reserves space; past
+the high-water mark it deletes unpinned files, one at a time in the policy's order, until
+usage is back under the low-water mark. An upload that does not fit even then makes room
+for itself the same way, so uploads do not wait for someone to /delete; one that would not
+fit with every evictable file gone is refused without evicting anything.
+"""
+import logging
+import threading
+import time
+
+from catalog import EVICTION_ORDERS
+import metrics
+
+OFF = 'off'
+POLICIES = tuple(EVICTION_ORDERS)  # lru (by last download), oldest (by upload), largest
+
+DEFAULT_HIGH_WATER = 0.9  # fractions of the upload limit
+DEFAULT_LOW_WATER = 0.8
+DEFAULT_MIN_AGE = 3600  # seconds a new upload is safe from eviction, so a large one cannot evict itself
+DEFAULT_INTERVAL = 60
+CANDIDATE_BATCH = 20  # blobs picked per catalog query; each is checked again as it is evicted
+
+
+class Evictor:
+    """Eviction engine for a FileStore whose usage must stay under limit bytes.
+
+    Files with the same contents share one blob, and deleting only some of them frees nothing,
+    so a blob is evicted with every entry pointing at it, and kept if any of them is pinned or
+    younger than min_age. Evicting never touches parts of split uploads waiting for /merge.
+    """
+
+    def __init__(self, store, usage, limit, policy=OFF, high_water=DEFAULT_HIGH_WATER, low_water=DEFAULT_LOW_WATER,
+                 min_age=DEFAULT_MIN_AGE):
+        if policy != OFF and policy not in POLICIES:
+            raise ValueError(f"unknown eviction policy {policy!r}, expected {OFF} or one of {', '.join(POLICIES)}")
+        if not 0 < low_water < high_water <= 1:
+            raise ValueError("eviction water marks must satisfy 0 < low < high <= 1")
+        self.store = store
+        self.usage = usage
+        self.limit = limit
+        self.policy = policy
+        self.high_water = high_water
+        self.low_water = low_water
+        self.min_age = min_age
+        self.lock = threading.Lock()  # one eviction pass at a time
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.files_evicted = 0
+        self.bytes_evicted = 0
+        self.passes = 0
+        self.last_pass = None
+        self.short_passes = 0  # passes that ran out of files they could evict before reaching their target
+
+    @property
+    def enabled(self):
+        return self.policy != OFF
+
+    def wake(self):
+        """Asks the background thread to check usage now, e.g. after an upload reserved space."""
+        self.wakeup.set()
+
+    def make_room(self, size):
+        """Evicts until an upload of size bytes fits under the limit. Returns whether it does."""
+        if not self.enabled:
+            return False
+        # Pinned and recent files and parts stay whatever is evicted; if size does not fit next to them, evict nothing
+        kept = self.usage.in_use() - self.store.catalog.evictable_size(time.time() - self.min_age)
+        if kept + size > self.limit:
+            logging.warning(f"Not evicting for an upload of {size} bytes: {kept} of the {self.limit} bytes in use "
+                            f"are pinned, uploaded in the last {self.min_age}s or parts of split uploads.")
+            return False
+        self.evict_to(min(self.limit * self.low_water, self.limit - size))
+        return self.usage.in_use() + size <= self.limit
+
+    def evict_to(self, target):
+        """Evicts files in policy order until usage (with reservations) is at most target bytes.
+
+        Returns the bytes freed.
+        """
+        with self.lock:
+            freed = 0
+            evicted = 0
+            while self.usage.in_use() > target:
+                added_before = time.time() - self.min_age
+                candidates = self.store.catalog.eviction_candidates(self.policy, added_before, CANDIDATE_BATCH)
+                progress = False
+                for candidate in candidates:
+                    if self.usage.in_use() <= target:
+                        break
+                    entries, size = self.store.evict(candidate['sha256'], added_before)
+                    if not entries:
+                        continue  # pinned or uploaded again since the query
+                    self._log_eviction(candidate, entries, size)
+                    freed += size
+                    evicted += len(entries)
+                    progress = True
+                if not progress:
+                    break
+
+            self.passes += 1
+            self.last_pass = time.time()
+            self.files_evicted += evicted
+            self.bytes_evicted += freed
+            if self.usage.in_use() > target:
+                self.short_passes += 1
+                logging.warning(f"Eviction ({self.policy}) freed {freed} bytes but uploads still take "
+                                f"{self.usage.in_use()} bytes, over the {target:.0f} aimed for: the rest is pinned "
+                                f"or uploaded in the last {self.min_age}s.")
+            elif evicted:
+                logging.info(f"Eviction ({self.policy}) removed {evicted} files, freeing {freed} bytes; uploads now "
+                             f"take {self.usage.in_use()} of {self.limit} bytes.")
+            return freed
+
+    def check(self):
+        """Runs a pass down to the low-water mark if usage is over the high-water mark."""
+        if self.enabled and self.usage.in_use() > self.limit * self.high_water:
+            self.evict_to(self.limit * self.low_water)
+
+    def start(self, interval=DEFAULT_INTERVAL):
+        """Starts the background thread (not when eviction is off)."""
+        if not self.enabled:
+            return
+
+        def run():
+            while True:
+                self.wakeup.wait(interval)
+                self.wakeup.clear()
+                try:
+                    self.check()
+                except Exception as e:
+                    logging.error(f"Eviction pass failed: {str(e)}")
+
+        self.thread = threading.Thread(target=run, name='eviction', daemon=True)
+        self.thread.start()
+
+    def stats(self):
+        return {
+            'files': self.files_evicted,
+            'bytes': self.bytes_evicted,
+            'passes': self.passes,
+            'last_pass': self.last_pass,
+            'short_passes': self.short_passes,
+        }
+
+    def _log_eviction(self, candidate, entries, size):
+        names = ', '.join(f"'{entry['name']}' ({entry['owner'] or 'no owner'}, ID {entry['id']})" for entry in entries)
+        last_used = time.strftime('%Y-%m-%d %H:%M', time.localtime(candidate['last_used']))
+        logging.info(f"Evicted {names}: {size} bytes on disk, last used {last_used}, picked by the {self.policy} "
+                     f"policy with uploads at {self.usage.in_use() + size} of {self.limit} bytes.",
+                     extra={'file': entries[0]['name'], 'bytes': size})
+        metrics.EVICTIONS.inc(policy=self.policy)
+        metrics.EVICTED_BYTES.inc(size, policy=self.policy)
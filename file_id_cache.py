@@ -0,0 +1,38 @@
+import threading
+
+
+class TelegramFileIdCache:
+    """Maps stored contents to Telegram file_ids so a file Telegram already has can be re-sent without its bytes.
+
+    Entries are kept per (sha256, file name) because a document sent by file_id keeps the name
+    it was uploaded under. The entries live in the catalog; the counters are per process.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def get(self, sha256, file_name):
+        file_id = self.catalog.get_telegram_file_id(sha256, file_name)
+        with self.lock:
+            if file_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return file_id
+
+    def put(self, sha256, file_name, file_id):
+        self.catalog.set_telegram_file_id(sha256, file_name, file_id)
+
+    def invalidate(self, sha256, file_name):
+        """Drops a file_id Telegram no longer accepts."""
+        self.catalog.forget_telegram_file_id(sha256, file_name)
+        with self.lock:
+            self.stale += 1
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'stale': self.stale}
@@ -0,0 +1,219 @@
+"""Transfer jobs kept in SQLite and run by a pool of worker threads.
+
+Handlers enqueue a job and return; a worker picks it up, retries it with exponential backoff
+if it fails with a transient error, and records the outcome. Jobs that were running when the
+process stopped are queued again at the next start (recover()).
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from log_pipeline import clear_context, set_context
+import metrics
+from sqlite_db import SQLiteDatabase
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+STATES = (QUEUED, RUNNING, DONE, FAILED)
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF_FACTOR = 1    # seconds before the first retry, doubling after that (like urllib3's Retry)
+DEFAULT_BACKOFF_MAX = 300
+DEFAULT_RETENTION = 7 * 24 * 3600  # finished jobs older than this are pruned at start
+IDLE_POLL = 5  # seconds an idle worker sleeps before looking for due retries again
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    description TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    run_after REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, run_after);
+CREATE INDEX IF NOT EXISTS jobs_chat ON jobs (chat_id, id);
+"""
+
+
+class JobFailed(Exception):
+    """Raised by a job handler to fail the job at once, without retrying. The message is shown to the user."""
+
+
+class JobQueue:
+    """Durable queue of transfer jobs (kind, chat, JSON payload) with states queued, running, done and failed.
+
+    register() a handler per kind; it gets the job as a dict and succeeds by returning. An
+    exception for which retryable(e) is true puts the job back in the queue after a backoff,
+    until max_attempts; anything else fails it and calls on_failed(job, error). describe(e) gives
+    the error text kept with the job (and shown to users), str(e) by default.
+    """
+
+    def __init__(self, db_path, workers=DEFAULT_WORKERS, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR, backoff_max=DEFAULT_BACKOFF_MAX, retryable=None,
+                 describe=str):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.retryable = retryable or (lambda e: True)
+        self.describe = describe
+        self.handlers = {}
+        self.on_failed = None
+        self.threads = []
+        self.wakeup = threading.Condition()
+        self.db = SQLiteDatabase(db_path, lambda conn: conn.executescript(SCHEMA))  # created on first use
+
+    def connect(self):
+        return self.db.connect()
+
+    def write(self):
+        return self.db.write()
+
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def enqueue(self, kind, chat_id, description, payload):
+        """Adds a job and wakes a worker. Returns the job ID."""
+        now = time.time()
+        with self.write() as conn:
+            job_id = conn.execute(
+                "INSERT INTO jobs (kind, chat_id, description, payload, state, created_at, updated_at, run_after) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, chat_id, description, json.dumps(payload), QUEUED, now, now, now),
+            ).lastrowid
+        with self.wakeup:
+            self.wakeup.notify()
+        return job_id
+
+    def recover(self):
+        """Queues again the jobs a previous run left running. Call before start(); returns those jobs."""
+        with self.write() as conn:
+            rows = conn.execute("SELECT * FROM jobs WHERE state = ?", (RUNNING,)).fetchall()
+            conn.execute("UPDATE jobs SET state = ?, run_after = ?, updated_at = ? WHERE state = ?",
+                         (QUEUED, time.time(), time.time(), RUNNING))
+        if rows:
+            logging.warning(f"Requeued {len(rows)} transfer jobs interrupted by the last shutdown.")
+        return [self._job(row) for row in rows]
+
+    def prune(self, older_than=DEFAULT_RETENTION):
+        """Removes finished jobs last updated more than older_than seconds ago. Returns how many."""
+        with self.write() as conn:
+            return conn.execute("DELETE FROM jobs WHERE state IN (?, ?) AND updated_at < ?",
+                                (DONE, FAILED, time.time() - older_than)).rowcount
+
+    def start(self):
+        """Starts the worker threads."""
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'job-{n}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stats(self):
+        """Returns {state: number of jobs} over the whole queue."""
+        counts = dict.fromkeys(STATES, 0)
+        for state, count in self.connect().execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"):
+            counts[state] = count
+        return counts
+
+    def recent(self, chat_id, limit=10):
+        """A chat's latest jobs, newest first."""
+        rows = self.connect().execute("SELECT * FROM jobs WHERE chat_id = ? ORDER BY id DESC LIMIT ?",
+                                      (chat_id, limit)).fetchall()
+        return [self._job(row) for row in rows]
+
+    def backoff(self, attempts):
+        return min(self.backoff_factor * 2 ** (attempts - 1), self.backoff_max)
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                logging.error(f"Could not read the job queue: {str(e)}")
+                job = None
+            if job is None:
+                with self.wakeup:
+                    self.wakeup.wait(self._idle_time())
+                continue
+            self._run(job)
+
+    def _claim(self):
+        now = time.time()
+        with self.write() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE state = ? AND run_after <= ? ORDER BY run_after, id LIMIT 1",
+                               (QUEUED, now)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE jobs SET state = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                         (RUNNING, now, row['id']))
+        job = self._job(row)
+        job['attempts'] += 1
+        job['state'] = RUNNING
+        return job
+
+    def _idle_time(self):
+        try:
+            row = self.connect().execute("SELECT MIN(run_after) FROM jobs WHERE state = ?", (QUEUED,)).fetchone()
+        except sqlite3.Error:
+            return IDLE_POLL
+        if row[0] is None:
+            return IDLE_POLL
+        return min(max(row[0] - time.time(), 0.01), IDLE_POLL)
+
+    def _run(self, job):
+        set_context(chat_id=job['chat_id'], command=f"job:{job['kind']}")
+        started = time.perf_counter()
+        try:
+            handler = self.handlers.get(job['kind'])
+            if handler is None:
+                raise JobFailed(f"no handler for {job['kind']} jobs")
+            handler(job)
+        except Exception as e:
+            error = self.describe(e)
+            if isinstance(e, JobFailed) or not self.retryable(e) or job['attempts'] >= self.max_attempts:
+                self._finish(job, FAILED, error)
+                metrics.JOBS.inc(kind=job['kind'], result=FAILED)
+                logging.error(f"Job {job['id']} ({job['kind']} {job['description']}) failed after "
+                              f"{job['attempts']} attempts: {error}")
+                if self.on_failed is not None:
+                    try:
+                        self.on_failed(job, e)
+                    except Exception as notify_error:
+                        logging.error(f"Could not report failed job {job['id']}: {str(notify_error)}")
+            else:
+                delay = self.backoff(job['attempts'])
+                self._retry_later(job, error, delay)
+                metrics.JOBS.inc(kind=job['kind'], result='retried')
+                logging.warning(f"Job {job['id']} ({job['kind']} {job['description']}) attempt {job['attempts']} "
+                                f"failed, retrying in {delay:.0f}s: {error}")
+        else:
+            self._finish(job, DONE, None)
+            metrics.JOBS.inc(kind=job['kind'], result=DONE)
+            metrics.JOB_SECONDS.observe(time.perf_counter() - started, kind=job['kind'])
+        finally:
+            clear_context()
+
+    def _finish(self, job, state, error):
+        with self.write() as conn:
+            conn.execute("UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE id = ?",
+                         (state, error, time.time(), job['id']))
+
+    def _retry_later(self, job, error, delay):
+        now = time.time()
+        with self.write() as conn:
+            conn.execute("UPDATE jobs SET state = ?, error = ?, updated_at = ?, run_after = ? WHERE id = ?",
+                         (QUEUED, error, now, now + delay, job['id']))
+
+    @staticmethod
+    def _job(row):
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        return job
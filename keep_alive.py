@@ -1,21 +1,118 @@
+import hmac
+import logging
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from threading import Thread
-from flask import Flask
 
-app = Flask(__name__)
+import metrics
 
-@app.route('/')
-def index():
-    return "I'm Alive!"  # More informative message
+HOST = os.getenv('KEEP_ALIVE_HOST', '0.0.0.0')
+PORT = int(os.getenv('PORT', '8080'))
 
-def keep_alive():
-    """Starts a background thread to run the Flask app."""
-    thread = Thread(target=run)
+MAX_WEBHOOK_BODY = 1024 * 1024  # updates are a few KB; anything this big is not from Telegram
+
+# Callables returning (ok, detail); set by keep_alive()
+checks = {'live': None, 'ready': None}
+
+# Set by keep_alive() when updates arrive by webhook instead of getUpdates
+webhook = {'path': None, 'secret': None, 'handler': None}
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """Serves the health, metrics and webhook endpoints. Each request gets its own thread."""
+    protocol_version = 'HTTP/1.1'
+    server_version = 'VortXtra'
+    disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/':
+            self.respond(200, "I'm Alive!")
+        elif path == '/healthz':
+            self.respond_check('live')
+        elif path == '/readyz':
+            self.respond_check('ready')
+        elif path == '/metrics':
+            self.respond(200, metrics.render(), 'text/plain; version=0.0.4; charset=utf-8')
+        else:
+            self.respond(404, "Not Found")
+
+    def do_POST(self):
+        path = self.path.split('?', 1)[0]
+        if webhook['handler'] is None or path != webhook['path']:
+            self.close_connection = True  # the body is left unread
+            self.respond(404, "Not Found")
+            return
+
+        # send_error closes the connection, so an unread body can't be taken for the next request
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            self.send_error(400, "Bad Content-Length")
+            return
+        if length < 0:
+            self.send_error(400, "Bad Content-Length")
+            return
+        if length > MAX_WEBHOOK_BODY:
+            self.send_error(413)
+            return
+        body = self.rfile.read(length)
+
+        # Telegram echoes the secret_token given to setWebhook in this header
+        token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode(), webhook['secret'].encode()):
+            logging.warning(f"Rejected a webhook request from {self.client_address[0]} with a wrong secret token.")
+            self.respond(403, "Forbidden")
+            return
+
+        try:
+            webhook['handler'](body)
+        except ValueError as e:
+            logging.warning(f"Rejected a webhook request: {str(e)}")
+            self.respond(400, "Bad Request")
+            return
+        # Handlers run on the dispatcher's pool; answering now keeps Telegram from retrying
+        self.respond(200, "ok")
+
+    def respond_check(self, name):
+        check = checks[name]
+        ok, detail = check() if check else (True, "ok")
+        self.respond(200 if ok else 503, detail)
+
+    def respond(self, status, body, content_type='text/plain; charset=utf-8'):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # Health probes every few seconds would drown bot.log
+
+
+def keep_alive(liveness=None, readiness=None, webhook_handler=None, webhook_path='/webhook', webhook_secret=None):
+    """Starts a background thread serving /, /healthz, /readyz and /metrics.
+
+    With a webhook_handler, POSTs to webhook_path carrying webhook_secret are passed to it as raw bodies.
+    """
+    if webhook_handler is not None and not webhook_secret:
+        raise ValueError("a webhook needs a secret token")
+    checks['live'] = liveness
+    checks['ready'] = readiness
+    webhook.update(path=webhook_path, secret=webhook_secret, handler=webhook_handler)
+    server = ThreadingHTTPServer((HOST, PORT), KeepAliveHandler)
+    server.daemon_threads = True
+    thread = Thread(target=run, args=(server,), name='keep-alive')
     thread.daemon = True  # Ensures thread exits with main program
     thread.start()
+    return server
+
+
+def run(server):
+    """Serves requests until the process exits."""
+    server.serve_forever()
 
-def run():
-    """Runs the Flask app in a separate thread."""
-    app.run(host='0.0.0.0', port=8080)  # Expose app externally
 
 if __name__ == '__main__':
-    keep_alive()  # Start keep-alive thread before any logic
\ No newline at end of file
+    run(ThreadingHTTPServer((HOST, PORT), KeepAliveHandler))
@@ -0,0 +1,140 @@
+import fnmatch
+import itertools
+import threading
+from collections import OrderedDict
+
+from catalog import visible_to
+
+SORTS = ('id', 'name', 'size', 'date')
+DEFAULT_ORDER = {'id': 'asc', 'name': 'asc', 'size': 'desc', 'date': 'desc'}
+MAX_VIEWS = 32         # sorted/filtered views kept between catalog changes
+MAX_QUERY_TOKENS = 1000
+
+# Page buttons carry the query in callback_data, which Telegram caps at 64 bytes; longer
+# queries are kept here and referred to by a token
+CALLBACK_PREFIX = 'list'
+MAX_CALLBACK_DATA = 64
+
+
+class ListQuery:
+    """How /list sorts and filters: /list [id|name|size|date] [asc|desc] [glob]."""
+
+    def __init__(self, sort='id', order=None, pattern=None):
+        self.sort = sort
+        self.order = order or DEFAULT_ORDER[sort]
+        self.pattern = pattern
+
+    @classmethod
+    def parse(cls, words):
+        """Reads the words after /list. Raises ValueError for more than one glob."""
+        sort, order, patterns = 'id', None, []
+        for word in words:
+            lowered = word.lower()
+            if lowered in SORTS:
+                sort = lowered
+            elif lowered in ('asc', 'desc'):
+                order = lowered
+            else:
+                patterns.append(word)
+        if len(patterns) > 1:
+            raise ValueError("only one name pattern can be given")
+        return cls(sort, order, patterns[0] if patterns else None)
+
+    def key(self):
+        return (self.sort, self.order, self.pattern)
+
+    def describe(self):
+        text = f"by {self.sort}, {'descending' if self.order == 'desc' else 'ascending'}"
+        if self.pattern:
+            text += f", matching {self.pattern}"
+        return text
+
+
+class FileListing:
+    """Sorted, filtered views of the catalog for /list, cached until a file is added, renamed or removed.
+
+    The catalog is read once per change; each distinct owner and sort/filter is computed once
+    from that snapshot and paged by slicing.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.lock = threading.Lock()
+        self.version = None
+        self.snapshot = []
+        self.views = OrderedDict()  # (owner, ListQuery.key()) -> list of entries, least recently used first
+        self.tokens = OrderedDict()  # token -> ListQuery, for queries too long for callback_data
+        self.token_ids = itertools.count(1)
+
+    def view(self, query, owner=None):
+        """The entries owner may see (all of them if owner is None), filtered and sorted by query."""
+        with self.lock:
+            self._refresh()
+            key = (owner, query.key())
+            entries = self.views.get(key)
+            if entries is None:
+                entries = self.views[key] = self._build(query, owner)
+                if len(self.views) > MAX_VIEWS:
+                    self.views.popitem(last=False)
+            else:
+                self.views.move_to_end(key)
+            return entries
+
+    def page(self, query, page, page_size, owner=None):
+        """Returns (entries on the page, page clamped to the valid range, number of pages, total matches)."""
+        entries = self.view(query, owner)
+        pages = max(1, -(-len(entries) // page_size))
+        page = min(max(page, 1), pages)
+        start = (page - 1) * page_size
+        return entries[start:start + page_size], page, pages, len(entries)
+
+    def callback_data(self, query, page):
+        data = f"{CALLBACK_PREFIX}:{page}:{query.sort}:{query.order}:{query.pattern or ''}"
+        if len(data.encode()) <= MAX_CALLBACK_DATA:
+            return data
+        with self.lock:
+            token = next(self.token_ids)
+            self.tokens[token] = query
+            if len(self.tokens) > MAX_QUERY_TOKENS:
+                self.tokens.popitem(last=False)
+        return f"{CALLBACK_PREFIX}:{page}:#{token}"
+
+    def parse_callback(self, data):
+        """Returns (query, page) from callback_data, or None if it is not a /list page or has expired."""
+        parts = data.split(':', 4)
+        if parts[0] != CALLBACK_PREFIX or len(parts) < 3 or not parts[1].isdigit():
+            return None
+        page = int(parts[1])
+        if parts[2].startswith('#'):
+            with self.lock:
+                query = self.tokens.get(int(parts[2][1:])) if parts[2][1:].isdigit() else None
+            return (query, page) if query is not None else None
+        if len(parts) != 5 or parts[2] not in SORTS or parts[3] not in ('asc', 'desc'):
+            return None
+        return ListQuery(parts[2], parts[3], parts[4] or None), page
+
+    def _refresh(self):
+        version = self.catalog.version
+        if version != self.version:
+            # Version first, rows second: a change in between makes the next call reload again
+            self.version = version
+            self.snapshot = self.catalog.list_files()
+            self.views.clear()
+
+    def _build(self, query, owner):
+        entries = self.snapshot
+        if owner is not None:
+            entries = [entry for entry in entries if visible_to(entry, owner)]
+        if query.pattern:
+            pattern = query.pattern.lower()
+            if not any(char in pattern for char in '*?['):
+                pattern = f"*{pattern}*"  # a plain word matches anywhere in the name
+            entries = [entry for entry in entries if fnmatch.fnmatchcase(entry['name'].lower(), pattern)]
+        reverse = query.order == 'desc'
+        if query.sort == 'name':
+            return sorted(entries, key=lambda entry: (entry['name'].lower(), entry['id']), reverse=reverse)
+        if query.sort == 'size':
+            return sorted(entries, key=lambda entry: (entry['size'], entry['id']), reverse=reverse)
+        if query.sort == 'date':
+            return sorted(entries, key=lambda entry: (entry['mtime'], entry['id']), reverse=reverse)
+        return list(reversed(entries)) if reverse else list(entries)  # list_files() is already in ID order
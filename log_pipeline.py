@@ -0,0 +1,136 @@
+"""Logging that never writes to disk on a handler thread.
+
+Handlers log into a queue (QueueHandler); a QueueListener thread formats the records and
+writes them to a file that is rotated by size and by age, with old files gzipped.
+"""
+import atexit
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Fields a log call can pass with extra={...}; they become keys of the JSON line
+STRUCTURED_FIELDS = ('user', 'chat_id', 'command', 'file', 'bytes', 'duration')
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Per-thread fields added to every record logged while a handler runs (see set_context)
+_context = threading.local()
+
+
+def set_context(**fields):
+    """Adds fields (user, command, ...) to every record logged from this thread until clear_context()."""
+    current = getattr(_context, 'fields', None)
+    if current is None:
+        current = _context.fields = {}
+    current.update((name, value) for name, value in fields.items() if value is not None)
+
+
+def clear_context():
+    _context.fields = None
+
+
+class ContextFilter(logging.Filter):
+    """Copies the thread's context onto records. Runs on the thread that logs, before the record is queued."""
+
+    def filter(self, record):
+        for name, value in (getattr(_context, 'fields', None) or {}).items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level and message plus whichever structured fields are set."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for name in STRUCTURED_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = round(value, 3) if isinstance(value, float) else value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class CompressingRotatingFileHandler(RotatingFileHandler):
+    """Rotates when the file reaches max_bytes or interval seconds after it was opened or last rotated.
+
+    Rotated files are gzipped and numbered like RotatingFileHandler's (bot.log.1.gz is the newest).
+    """
+
+    def __init__(self, filename, max_bytes=0, backup_count=0, interval=0, encoding='utf-8'):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding=encoding)
+        self.interval = interval
+        self.rollover_at = self._next_rollover()
+        try:
+            if interval and os.path.getsize(filename) and os.path.getmtime(filename) + interval < time.time():
+                self.rollover_at = time.time()  # left over from a run that ended more than an interval ago
+        except OSError:
+            pass
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self._compress
+
+    def shouldRollover(self, record):
+        if self.interval and time.time() >= self.rollover_at:
+            return True
+        # The base class formats every record a second time to measure it; the file position is enough
+        return bool(self.maxBytes) and self.stream is not None and self.stream.tell() >= self.maxBytes
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = self._next_rollover()
+
+    def _next_rollover(self):
+        return time.time() + self.interval if self.interval else float('inf')
+
+    @staticmethod
+    def _compress(source, dest):
+        with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+
+class LogWriter(QueueListener):
+    """The background thread writing queued records; stop() may be called again at exit."""
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+def setup_logging(path, level=logging.INFO, max_bytes=10 * 1024 * 1024, backup_count=7, interval=24 * 3600,
+                  json_lines=True):
+    """Routes the root logger through a queue to a rotating file written by a background thread.
+
+    Returns the LogWriter; it is stopped (and the queue flushed) at exit.
+    """
+    file_handler = CompressingRotatingFileHandler(path, max_bytes, backup_count, interval)
+    file_handler.setFormatter(JsonFormatter() if json_lines else logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = LogWriter(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,165 @@
+"""Process-wide counters in the Prometheus text format, served on /metrics by keep_alive."""
+import threading
+import time
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180)
+THROUGHPUT_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 20, 50, 100, 250)
+
+REGISTRY = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in items]
+
+
+class Gauge(Metric):
+    """A value set directly, or read from a callback at scrape time."""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labels=(), callback=None):
+        super().__init__(name, help_text, labels)
+        self.values = {}
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def samples(self):
+        if self.callback is not None:
+            try:
+                return [f"{self.name} {self.callback()}"]
+            except Exception:
+                return []
+        with self.lock:
+            items = sorted(self.values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in items]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, list(state)) for key, state in self.values.items())
+        lines = []
+        for key, state in items:
+            for bound, count in zip(self.buckets, state):
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', bound)])} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', '+Inf')])} {state[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {state[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {state[-1]}")
+        return lines
+
+
+def render():
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+_process = None
+
+
+def process():
+    """psutil's view of this process. psutil is imported on the first scrape, not at startup."""
+    global _process
+    if _process is None:
+        import psutil
+        _process = psutil.Process()
+    return _process
+
+
+COMMANDS = Counter('vortxtra_commands_total', 'Commands received, by command.', ['command'])
+HANDLER_SECONDS = Histogram('vortxtra_handler_duration_seconds', 'Time spent in each handler.', ['handler'])
+HANDLER_ERRORS = Counter('vortxtra_handler_errors_total', 'Handlers that raised, by handler.', ['handler'])
+TRANSFER_BYTES = Counter('vortxtra_transfer_bytes_total', 'Bytes transferred, by direction.', ['direction'])
+TRANSFER_THROUGHPUT = Histogram('vortxtra_transfer_throughput_mb_per_second', 'Throughput of single transfers in MB/s.',
+                                ['direction'], buckets=THROUGHPUT_BUCKETS)
+LAST_UPDATES = Gauge('vortxtra_last_get_updates_timestamp_seconds', 'Unix time of the last successful getUpdates.')
+WEBHOOK_UPDATES = Counter('vortxtra_webhook_updates_total', 'Updates received on the webhook, by result.', ['result'])
+THROTTLED = Counter('vortxtra_throttled_total', 'Rate limiting events: inbound commands dropped, outbound sends '
+                    'delayed (outbound_wait), 429s received (retry_after) and edits coalesced.', ['kind'])
+JOBS = Counter('vortxtra_jobs_total', 'Transfer jobs finished or retried, by kind and result.', ['kind', 'result'])
+JOB_SECONDS = Histogram('vortxtra_job_duration_seconds', 'Run time of successful transfer jobs.', ['kind'])
+EVICTIONS = Counter('vortxtra_evictions_total', 'Stored contents evicted to stay under the upload limit, by policy.',
+                    ['policy'])
+EVICTED_BYTES = Counter('vortxtra_evicted_bytes_total', 'Bytes freed on disk by eviction, by policy.', ['policy'])
+QUEUE_DEPTH = Gauge('vortxtra_dispatch_queue_depth',
+                    'Updates not handled yet: waiting for a free worker or behind an update of the same chat.')
+PROCESS_RSS = Gauge('process_resident_memory_bytes', 'Resident memory of the bot process.',
+                    callback=lambda: process().memory_info().rss)
+PROCESS_START = Gauge('process_start_time_seconds', 'Unix time the bot process started.',
+                      callback=lambda: process().create_time())
+
+
+def record_command(message):
+    text = getattr(message, 'text', None)
+    if text and text.startswith('/'):
+        COMMANDS.inc(command=text.split()[0].split('@')[0].lower())
+
+
+def record_transfer(direction, size, seconds):
+    TRANSFER_BYTES.inc(size, direction=direction)
+    if seconds > 0:
+        TRANSFER_THROUGHPUT.observe(size / (1024 * 1024) / seconds, direction=direction)
+
+
+def mark_updates_received():
+    LAST_UPDATES.set(time.time())
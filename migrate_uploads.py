@@ -0,0 +1,67 @@
+"""Moves an old flat uploads directory into the per-user layout and gives unowned files to a user.
+
+    python migrate_uploads.py --owner 123456789 --dry-run
+    python migrate_uploads.py --owner 123456789
+
+Loose files in the upload directory are moved into the content-addressed blob store, and
+every catalog entry without an owner (loose files, and entries from before per-user names)
+is given to --owner, a Telegram user id; names that clash with the owner's files get a " (2)"
+style suffix.
+Run it while the bot is stopped. Without it the bot imports loose files at startup itself,
+but leaves them visible to every user.
+"""
+import argparse
+import os
+import pathlib
+import sqlite3
+
+from catalog import FileCatalog
+from storage import FileStore, loose_files
+from usage import UsageTracker
+
+
+def count_unowned(db_path):
+    """Catalog entries without an owner, read without touching the catalog (opening a FileCatalog migrates it)."""
+    if not os.path.exists(db_path):
+        return 0
+    # Read-only still creates the -wal and -shm files of a WAL database; without a -wal file there is
+    # nothing uncommitted to read either, so it can be opened as immutable, which creates nothing
+    mode = 'mode=ro' if os.path.exists(db_path + '-wal') else 'immutable=1'
+    conn = sqlite3.connect(f"{pathlib.Path(db_path).absolute().as_uri()}?{mode}", uri=True)
+    try:
+        # Entries owned by a login username are made unowned when the catalog is opened (FileCatalog._unown_login_names)
+        return conn.execute("SELECT COUNT(*) FROM files WHERE owner IS NULL OR owner GLOB '*[^0-9]*' OR owner = ''").fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0  # no files table yet
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--owner', required=True, help='Telegram user id to give files without an owner to')
+    parser.add_argument('--upload-dir', default=os.getenv('UPLOAD_DIR', 'uploads'))
+    parser.add_argument('--catalog', default=os.getenv('CATALOG_DB', 'catalog.db'))
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be done')
+    args = parser.parse_args()
+    if not args.owner.isdigit():
+        parser.error("--owner must be a Telegram user id; files are no longer owned by the login username")
+
+    # Counted before anything is opened for writing, so a dry run changes neither the catalog nor the disk
+    print(f"{len(loose_files(args.upload_dir))} loose files in {args.upload_dir}, "
+          f"{count_unowned(args.catalog)} catalog entries without an owner.")
+    if args.dry_run:
+        return
+
+    catalog = FileCatalog(args.catalog)  # opening it also lifts the old global name uniqueness
+    store = FileStore(args.upload_dir, catalog, UsageTracker(args.upload_dir))
+    imported = store.import_loose_files(args.owner)
+    claimed, renamed = catalog.claim_unowned(args.owner)
+    store.reconcile()
+    print(f"Imported {imported} files; {claimed} entries now belong to {args.owner}.")
+    for old_name, new_name in renamed:
+        print(f"  {old_name} -> {new_name} (the name was taken)")
+
+
+if __name__ == '__main__':
+    main()
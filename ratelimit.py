@@ -0,0 +1,200 @@
+import logging
+import threading
+import time
+
+from telebot import apihelper
+
+import metrics
+
+# Telegram's documented limits: about 30 messages a second overall, one a second in a
+# private chat (short bursts are tolerated) and 20 a minute in a group
+GLOBAL_SEND_RATE = 30
+CHAT_SEND_RATE = 1
+CHAT_SEND_BURST = 3
+GROUP_SEND_RATE = 20 / 60
+MAX_SEND_ATTEMPTS = 5
+
+
+class TokenBucket:
+    """Allows rate events a second on average and up to capacity at once. Not thread-safe on its own."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if now > self.updated:  # now may have been read before the bucket was created
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available, 0 if one is available now."""
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def idle(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class ChatRateLimiter:
+    """A token bucket per chat for inbound commands, so one chat cannot flood the worker pool."""
+
+    PRUNE_EVERY = 1000  # drop the buckets of quiet chats after this many checks
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = {}  # chat id -> TokenBucket
+        self.warned = set()  # chats told to slow down since their last allowed command
+        self.checks = 0
+
+    def allow(self, chat_id):
+        """Takes a token for chat_id. Returns False if the chat is over its rate."""
+        now = time.monotonic()
+        with self.lock:
+            self.checks += 1
+            if self.checks % self.PRUNE_EVERY == 0:
+                self._prune(now)
+            bucket = self.buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.buckets[chat_id] = TokenBucket(self.rate, self.burst)
+            if bucket.wait_time(now) > 0:
+                metrics.THROTTLED.inc(kind='inbound')
+                return False
+            bucket.take()
+            self.warned.discard(chat_id)
+            return True
+
+    def take_warning(self, chat_id):
+        """True the first time a chat is throttled after an allowed command, so it is told only once."""
+        with self.lock:
+            if chat_id in self.warned:
+                return False
+            self.warned.add(chat_id)
+            return True
+
+    def _prune(self, now):
+        for chat_id in [chat_id for chat_id, bucket in self.buckets.items() if bucket.idle(now)]:
+            del self.buckets[chat_id]
+            self.warned.discard(chat_id)
+
+
+def retry_after(e):
+    """Seconds Telegram asked us to wait, or None if e is not a 429."""
+    if not isinstance(e, apihelper.ApiTelegramException) or e.error_code != 429:
+        return None
+    return (e.result_json.get('parameters') or {}).get('retry_after', 1)
+
+
+class SendScheduler:
+    """Paces outgoing messages to stay under Telegram's global and per-chat limits.
+
+    Every send waits for a token from the global bucket and from its chat's bucket. A 429
+    pauses that chat for retry_after seconds, so the sends queued behind it wait too instead
+    of all hitting the limit. Edits of the same message are coalesced: an edit still waiting
+    for its turn is dropped when a newer one for that message arrives.
+    """
+
+    def __init__(self, global_rate=GLOBAL_SEND_RATE, chat_rate=CHAT_SEND_RATE, chat_burst=CHAT_SEND_BURST,
+                 group_rate=GROUP_SEND_RATE, max_attempts=MAX_SEND_ATTEMPTS):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}    # chat id -> TokenBucket
+        self.paused_until = {}    # chat id -> monotonic time a 429 asked us to wait until
+        self.latest_edit = {}     # (chat id, message id) -> sequence number of the newest edit
+        self.edit_sequence = 0
+
+    def call(self, chat_id, func, args, kwargs, retry=True, coalesce_key=None):
+        """Calls func(*args, **kwargs) once the limits allow a message to chat_id.
+
+        With retry, a 429 is retried after retry_after; without (the arguments are consumed
+        by a failed attempt, like an open file), it is raised for the caller to rebuild and retry.
+        Returns None without calling func if the edit was superseded by a newer one.
+        """
+        sequence = self._register_edit(coalesce_key)
+        for attempt in range(self.max_attempts):
+            self._wait_for_turn(chat_id)
+            if self._superseded(coalesce_key, sequence):
+                metrics.THROTTLED.inc(kind='coalesced')
+                return None
+            try:
+                result = func(*args, **kwargs)
+            except apihelper.ApiTelegramException as e:
+                delay = retry_after(e)
+                if delay is None:
+                    self._finish_edit(coalesce_key, sequence)
+                    raise
+                metrics.THROTTLED.inc(kind='retry_after')
+                self._pause(chat_id, delay)
+                logging.warning(f"Rate limited by Telegram on {getattr(func, '__name__', func)} in chat {chat_id}, pausing it for {delay}s.")
+                if not retry or attempt == self.max_attempts - 1:
+                    self._finish_edit(coalesce_key, sequence)
+                    raise
+                continue
+            self._finish_edit(coalesce_key, sequence)
+            return result
+
+    def _wait_for_turn(self, chat_id):
+        waited = False
+        while True:
+            now = time.monotonic()
+            with self.lock:
+                chat_bucket = self.chat_buckets.get(chat_id)
+                if chat_bucket is None:
+                    # Negative ids are groups and channels, which Telegram limits more tightly
+                    rate = self.group_rate if chat_id is not None and chat_id < 0 else self.chat_rate
+                    chat_bucket = self.chat_buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+                wait = max(self.global_bucket.wait_time(now), chat_bucket.wait_time(now),
+                           self.paused_until.get(chat_id, 0) - now)
+                if wait <= 0:
+                    self.global_bucket.take()
+                    chat_bucket.take()
+                    self.paused_until.pop(chat_id, None)
+                    if len(self.chat_buckets) > 10000:
+                        self._prune(now)
+                    break
+            if not waited:
+                metrics.THROTTLED.inc(kind='outbound_wait')
+                waited = True
+            time.sleep(wait)
+
+    def _pause(self, chat_id, delay):
+        with self.lock:
+            self.paused_until[chat_id] = max(self.paused_until.get(chat_id, 0), time.monotonic() + delay)
+
+    def _register_edit(self, key):
+        if key is None:
+            return None
+        with self.lock:
+            self.edit_sequence += 1
+            self.latest_edit[key] = self.edit_sequence
+            return self.edit_sequence
+
+    def _superseded(self, key, sequence):
+        if key is None:
+            return False
+        with self.lock:
+            return self.latest_edit.get(key) != sequence
+
+    def _finish_edit(self, key, sequence):
+        if key is None:
+            return
+        with self.lock:
+            if self.latest_edit.get(key) == sequence:
+                del self.latest_edit[key]
+
+    def _prune(self, now):
+        for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.items()
+                        if bucket.idle(now) and chat_id not in self.paused_until]:
+            del self.chat_buckets[chat_id]
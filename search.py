@@ -0,0 +1,116 @@
+import bisect
+import re
+import threading
+from collections import OrderedDict
+
+WORD_SPLIT = re.compile(r'[\W_]+')
+MAX_CACHED_QUERIES = 64
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def words(name):
+    return {word for word in WORD_SPLIT.split(name) if word} | {name}
+
+
+class FileSearchIndex:
+    """In-memory name index for inline search, kept in step with the catalog one change at a time.
+
+    Queries of three or more characters intersect the trigram sets of the query and check
+    the survivors for the substring; shorter ones match the start of a word in the name
+    through a sorted word list. Matches are returned newest (highest ID) first, limited to
+    the files the searching user may see. The index is built on the first search, so
+    startup does not pay for it.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.lock = threading.Lock()
+        self.built = False
+        self.names = {}      # file ID -> lowercased name
+        self.owners = {}     # file ID -> owner
+        self.grams = {}      # trigram -> set of file IDs
+        self.words = []      # sorted (word, file ID) pairs, for prefix lookups
+        self.results = OrderedDict()  # (owner, query) -> matching IDs, cleared on every change
+        catalog.subscribe(self.on_change)
+
+    def on_change(self, file_id, name, owner):
+        """Catalog callback: name is the entry's new name, or None if it was removed."""
+        with self.lock:
+            if not self.built:
+                return  # the build reads the catalog after this change committed
+            self._remove(file_id)
+            if name is not None:
+                self._add(file_id, name, owner)
+            self.results.clear()
+
+    def search(self, query, offset=0, limit=50, owner=None):
+        """Returns (IDs of owner's matches from offset, total number of matches). owner None searches every file."""
+        query = query.strip().lower()
+        key = (owner, query)
+        with self.lock:
+            if not self.built:
+                self._build()
+            matches = self.results.get(key)
+            if matches is None:
+                matches = self._match(query)
+                if owner is not None:
+                    matches = [file_id for file_id in matches if self.owners[file_id] in (None, owner)]
+                self.results[key] = matches
+                if len(self.results) > MAX_CACHED_QUERIES:
+                    self.results.popitem(last=False)
+            else:
+                self.results.move_to_end(key)
+        return matches[offset:offset + limit], len(matches)
+
+    def _build(self):
+        pairs = []
+        for entry in self.catalog.list_files():
+            self.owners[entry['id']] = entry['owner']
+            name = self.names[entry['id']] = entry['name'].lower()
+            for gram in trigrams(name):
+                self.grams.setdefault(gram, set()).add(entry['id'])
+            pairs.extend((word, entry['id']) for word in words(name))
+        self.words = sorted(pairs)  # one sort instead of an insort per word
+        self.built = True
+
+    def _match(self, query):
+        if not query:
+            candidates = self.names.keys()
+        elif len(query) < 3:
+            start = bisect.bisect_left(self.words, (query,))
+            end = bisect.bisect_left(self.words, (query + '\U0010ffff',), start)
+            candidates = {file_id for _, file_id in self.words[start:end]}
+        else:
+            sets = sorted((self.grams.get(gram, ()) for gram in trigrams(query)), key=len)
+            candidates = set(sets[0]).intersection(*sets[1:]) if sets[0] else set()
+            if len(query) > 3:
+                candidates = [file_id for file_id in candidates if query in self.names[file_id]]
+        return sorted(candidates, reverse=True)
+
+    def _add(self, file_id, name, owner):
+        name = name.lower()
+        self.names[file_id] = name
+        self.owners[file_id] = owner
+        for gram in trigrams(name):
+            self.grams.setdefault(gram, set()).add(file_id)
+        for word in words(name):
+            bisect.insort(self.words, (word, file_id))
+
+    def _remove(self, file_id):
+        name = self.names.pop(file_id, None)
+        self.owners.pop(file_id, None)
+        if name is None:
+            return
+        for gram in trigrams(name):
+            ids = self.grams.get(gram)
+            if ids is not None:
+                ids.discard(file_id)
+                if not ids:
+                    del self.grams[gram]
+        for word in words(name):
+            index = bisect.bisect_left(self.words, (word, file_id))
+            if index < len(self.words) and self.words[index] == (word, file_id):
+                del self.words[index]
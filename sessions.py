@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from sqlite_db import SQLiteDatabase
+
+DEFAULT_TTL = 7 * 24 * 3600  # seconds a session lasts after its last use
+DEFAULT_MAX_SESSIONS = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    chat_id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at);
+"""
+
+
+class SessionStore:
+    """Logged-in chats (chat id -> username) that expire ttl seconds after their last use.
+
+    Every use pushes the expiry back, so the order of expiry is also least-recently-used
+    order; when more than max_sessions are open, the ones closest to expiring are dropped.
+    Supports `in`, [] and del like the dict it replaces.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_sessions=DEFAULT_MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sweep_thread = None
+
+    def get(self, chat_id, default=None):
+        raise NotImplementedError
+
+    def set(self, chat_id, username):
+        raise NotImplementedError
+
+    def pop(self, chat_id, default=None):
+        raise NotImplementedError
+
+    def sweep(self):
+        """Removes expired sessions. Returns how many were removed."""
+        raise NotImplementedError
+
+    def __contains__(self, chat_id):
+        return self.get(chat_id) is not None
+
+    def __getitem__(self, chat_id):
+        username = self.get(chat_id)
+        if username is None:
+            raise KeyError(chat_id)
+        return username
+
+    def __setitem__(self, chat_id, username):
+        self.set(chat_id, username)
+
+    def __delitem__(self, chat_id):
+        if self.pop(chat_id) is None:
+            raise KeyError(chat_id)
+
+    def start_sweeper(self, interval):
+        """Starts a daemon thread that calls sweep() every interval seconds."""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    removed = self.sweep()
+                    if removed:
+                        logging.info(f"Expired {removed} idle sessions.")
+                except Exception as e:
+                    logging.error(f"Session sweep failed: {str(e)}")
+
+        self.sweep_thread = threading.Thread(target=run, name='session-sweep', daemon=True)
+        self.sweep_thread.start()
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions in this process only; they end when it restarts."""
+
+    def __init__(self, ttl=DEFAULT_TTL, max_sessions=DEFAULT_MAX_SESSIONS):
+        super().__init__(ttl, max_sessions)
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()  # chat id -> (username, expires_at), soonest to expire first
+
+    def get(self, chat_id, default=None):
+        now = time.time()
+        with self.lock:
+            session = self.sessions.get(chat_id)
+            if session is None:
+                return default
+            username, expires_at = session
+            if expires_at <= now:
+                del self.sessions[chat_id]
+                return default
+            self.sessions[chat_id] = (username, now + self.ttl)
+            self.sessions.move_to_end(chat_id)
+            return username
+
+    def set(self, chat_id, username):
+        with self.lock:
+            self.sessions[chat_id] = (username, time.time() + self.ttl)
+            self.sessions.move_to_end(chat_id)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def pop(self, chat_id, default=None):
+        with self.lock:
+            session = self.sessions.pop(chat_id, None)
+        if session is None or session[1] <= time.time():
+            return default
+        return session[0]
+
+    def sweep(self):
+        now = time.time()
+        removed = 0
+        with self.lock:
+            while self.sessions:
+                chat_id, (_, expires_at) = next(iter(self.sessions.items()))
+                if expires_at > now:
+                    break
+                del self.sessions[chat_id]
+                removed += 1
+        return removed
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sessions)
+
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions in a SQLite file, so they survive restarts and can be shared by several bot processes."""
+
+    # Only push the stored expiry back once a minute per chat instead of writing on every command
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, db_path, ttl=DEFAULT_TTL, max_sessions=DEFAULT_MAX_SESSIONS):
+        super().__init__(ttl, max_sessions)
+        self.db = SQLiteDatabase(db_path, lambda conn: conn.executescript(SCHEMA))  # created on first use
+
+    def connect(self):
+        return self.db.connect()
+
+    def write(self):
+        return self.db.write()
+
+    def get(self, chat_id, default=None):
+        now = time.time()
+        conn = self.connect()
+        row = conn.execute("SELECT username, expires_at FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row is None or row[1] <= now:
+            return default
+        if row[1] < now + self.ttl - self.TOUCH_INTERVAL:
+            conn.execute("UPDATE sessions SET expires_at = ? WHERE chat_id = ?", (now + self.ttl, chat_id))
+        return row[0]
+
+    def set(self, chat_id, username):
+        with self.write() as conn:
+            conn.execute(
+                "INSERT INTO sessions (chat_id, username, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (chat_id) DO UPDATE SET username = excluded.username, expires_at = excluded.expires_at",
+                (chat_id, username, time.time() + self.ttl),
+            )
+            excess = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - self.max_sessions
+            if excess > 0:
+                conn.execute("DELETE FROM sessions WHERE chat_id IN "
+                             "(SELECT chat_id FROM sessions ORDER BY expires_at LIMIT ?)", (excess,))
+
+    def pop(self, chat_id, default=None):
+        with self.write() as conn:
+            row = conn.execute("SELECT username, expires_at FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+            conn.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+        if row is None or row[1] <= time.time():
+            return default
+        return row[0]
+
+    def sweep(self):
+        return self.connect().execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),)).rowcount
+
+    def __len__(self):
+        return self.connect().execute("SELECT COUNT(*) FROM sessions WHERE expires_at > ?", (time.time(),)).fetchone()[0]
@@ -0,0 +1,57 @@
+"""The SQLite setup shared by the catalog, the session store and the job queue.
+
+Each thread gets its own connection in autocommit mode, with WAL so readers never wait for
+a writer; writes go through write(), which takes the write lock when it begins. Nothing is
+opened or created until the first connect(), so importing the bot leaves the disk alone.
+"""
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class SQLiteDatabase:
+    """A SQLite file opened in WAL mode, one connection per thread. Rows are sqlite3.Row.
+
+    setup(conn), if given, creates or migrates the schema; it runs once, on the first connect()
+    from any thread, and other threads wait for it. It may use connect() and write() itself.
+    """
+
+    def __init__(self, path, setup=None):
+        self.path = path
+        self.setup = setup
+        self.local = threading.local()
+        self.setup_lock = threading.RLock()
+        self.in_setup = False
+        self.ready = setup is None
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Autocommit mode; writes open their own IMMEDIATE transaction in write()
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        if not self.ready:
+            with self.setup_lock:
+                if not self.ready and not self.in_setup:  # in_setup: setup() itself connecting again
+                    self.in_setup = True
+                    try:
+                        self.setup(conn)
+                    finally:
+                        self.in_setup = False
+                    self.ready = True
+        return conn
+
+    @contextmanager
+    def write(self):
+        # Take the write lock up front so concurrent threads queue instead of failing with SQLITE_BUSY
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
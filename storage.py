@@ -0,0 +1,254 @@
+import logging
+import os
+import re
+import threading
+import time
+
+from catalog import visible_to
+from compression import open_blob
+from transfer import download_to_temp, hash_file, remove_quietly
+from usage import ContentTotals
+
+BLOB_DIR_NAME = '.blobs'
+# Temp files of transfers in progress (download_to_temp, PartAssembler.merge); any found at startup are left from a crash
+PARTIAL_FILE = re.compile(r'^\.(upload|merge)-.*\.part$')
+
+
+def loose_files(upload_dir):
+    """Plain files directly in upload_dir, as the bot stored them before the blob store."""
+    if not os.path.isdir(upload_dir):
+        return []
+    with os.scandir(upload_dir) as entries:
+        return [entry for entry in entries if not entry.name.startswith('.') and entry.is_file(follow_symlinks=False)]
+
+
+class FileStore:
+    """Per-user named files on top of a content-addressed blob store, so identical contents are kept once.
+
+    Blobs live under <upload_dir>/.blobs/<first two hex digits>/<sha256>, so no directory grows
+    past a few thousand entries; the catalog maps file IDs and (owner, name) pairs to blobs and
+    counts the references to each blob. Every file command goes through here: get() only
+    returns entries the asking user may see, and new files never replace an existing name.
+    Owners are Telegram user ids: the bot has one login shared by everyone, so the username
+    would put all users in one namespace.
+
+    With a compress_level (1-9), new contents are gzipped on their way in unless they are
+    compressed already; read them through open(), which undoes it.
+
+    usage counts the bytes on disk and totals the rest /storage shows; both follow every change
+    made through here.
+    """
+
+    def __init__(self, upload_dir, catalog, usage, compress_level=None, totals=None):
+        self.upload_dir = upload_dir
+        self.blob_dir = os.path.join(upload_dir, BLOB_DIR_NAME)
+        self.catalog = catalog
+        self.usage = usage
+        self.totals = totals or ContentTotals()
+        self.compress_level = compress_level
+        self.lock = threading.Lock()  # blob creation/removal and the catalog update that goes with it
+
+    def temp_dir(self):
+        """Directory for transfers to write into before add_file(), created on first use.
+
+        It is the blob directory itself, so adding a file is a rename.
+        """
+        os.makedirs(self.blob_dir, exist_ok=True)
+        return self.blob_dir
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blob_dir, sha256[:2], sha256)
+
+    def path(self, entry):
+        """On-disk location of a catalog entry's contents."""
+        return self.blob_path(entry['sha256'])
+
+    def get(self, file_id, owner):
+        """The entry with file_id if owner may see it, else None."""
+        entry = self.catalog.get(file_id)
+        if entry is None or not visible_to(entry, owner):
+            return None
+        return entry
+
+    def get_by_name(self, name, owner):
+        return self.catalog.get_by_name(name, owner)
+
+    def exists(self, entry):
+        return os.path.exists(self.path(entry))
+
+    def open(self, entry):
+        """Opens an entry's contents for reading, as they were uploaded."""
+        blob = self.catalog.get_blob(entry['sha256'])
+        return open_blob(self.path(entry), blob is not None and bool(blob['compressed']))
+
+    def disk_size(self, entry):
+        """Bytes the entry's contents take up on disk (shared with any other entry with the same contents)."""
+        return os.path.getsize(self.path(entry))
+
+    def store_download(self, session, url, name, owner, chunk_size, file_unique_id=None):
+        """Streams url into the store as owner's name, or a free variant of it.
+
+        Returns (file ID, name given, size, seconds, deduplicated).
+        """
+        temp_path, size, sha256, seconds, compressed = download_to_temp(session, url, self.temp_dir(), chunk_size,
+                                                                         self.compress_level)
+        try:
+            file_id, name, deduplicated = self._commit(temp_path, name, size, owner, sha256, compressed)
+        finally:
+            remove_quietly(temp_path)  # still there only if the content was a duplicate
+        if file_unique_id:
+            self.catalog.remember_unique_id(file_unique_id, sha256)
+        return file_id, name, size, seconds, deduplicated
+
+    def add_file(self, temp_path, name, owner, size, sha256, compressed=False):
+        """Moves a complete, already hashed temp file (in the blob directory) into the store.
+
+        size and sha256 are those of the contents; compressed says the temp file holds them gzipped.
+        Returns (file ID, name given, deduplicated).
+        """
+        try:
+            return self._commit(temp_path, name, size, owner, sha256, compressed)
+        finally:
+            remove_quietly(temp_path)
+
+    def link_unique_id(self, file_unique_id, name, owner):
+        """Adds name for content we already hold under Telegram's file_unique_id, without fetching it.
+
+        Returns (file ID, name given), or None if the content is not in the store.
+        """
+        sha256 = self.catalog.sha256_for_unique_id(file_unique_id)
+        if sha256 is None:
+            return None
+        with self.lock:
+            blob = self.catalog.get_blob(sha256)
+            if blob is None or not os.path.exists(self.blob_path(sha256)):
+                return None
+            file_id, name, _ = self.catalog.add(name, blob['size'], time.time(), owner, sha256)
+        return file_id, name
+
+    def rename(self, file_id, new_name):
+        self.catalog.rename(file_id, new_name)
+
+    def delete(self, file_id):
+        with self.lock:
+            entry = self.catalog.get(file_id)
+            self._release(self.catalog.remove(file_id))
+            if entry is not None and entry['pinned']:
+                self.totals.pin(-1)
+
+    def set_pinned(self, file_id, pinned):
+        with self.lock:
+            if self.catalog.set_pinned(file_id, pinned):
+                self.totals.pin(1 if pinned else -1)
+
+    def evict(self, sha256, added_before):
+        """Deletes a blob and every entry pointing at it, unless one of them was pinned or added since.
+
+        Returns (the removed entries, bytes freed on disk).
+        """
+        with self.lock:
+            entries, released = self.catalog.remove_blob(sha256, added_before)
+            self._release(released)
+        return entries, released[1] if released else 0
+
+    def reconcile(self):
+        """Brings the catalog and the blob directory in line with each other and seeds usage and totals.
+
+        Run at startup, before any transfer: half-written temp files are deleted (their jobs are
+        run again from the start). Plain files found directly in the upload directory (from before
+        the blob store) are moved into it, keeping their names and IDs.
+        """
+        partial = self._remove_partial_files()
+        imported = self.import_loose_files()
+        on_disk = self._scan_blobs()
+
+        missing = 0
+        for entry in self.catalog.list_files():
+            if entry['sha256'] not in on_disk:
+                self.catalog.remove(entry['id'])
+                missing += 1
+
+        orphaned = 0
+        for sha256, _ in self.catalog.repair_refcounts():
+            remove_quietly(self.blob_path(sha256))
+            on_disk.discard(sha256)
+            orphaned += 1
+        for sha256 in on_disk - self.catalog.blob_hashes():
+            remove_quietly(self.blob_path(sha256))
+            orphaned += 1
+
+        self.usage.reset(self.catalog.stored_size())
+        self.totals.reset(self.catalog.logical_size(), *self.catalog.compression_stats(), self.catalog.pinned_count())
+        if partial or imported or missing or orphaned:
+            logging.info(f"Storage reconciled: {partial} partial transfers removed, {imported} files imported, "
+                         f"{missing} missing entries dropped, {orphaned} orphaned blobs removed.")
+
+    def _commit(self, temp_path, name, size, owner, sha256, compressed):
+        with self.lock:
+            blob_path = self.blob_path(sha256)
+            deduplicated = os.path.exists(blob_path)
+            stored_size = os.path.getsize(temp_path)
+            if not deduplicated:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(temp_path, blob_path)
+                self.usage.add(stored_size)
+                self.totals.blob_added(size, stored_size, compressed)
+            file_id, name, _ = self.catalog.add(name, size, time.time(), owner, sha256,
+                                                stored_size=stored_size, compressed=compressed)
+        return file_id, name, deduplicated
+
+    def _release(self, released):
+        if released is None:
+            return
+        sha256, stored_size, size, compressed = released
+        remove_quietly(self.blob_path(sha256))
+        self.usage.add(-stored_size)
+        self.totals.blob_removed(size, stored_size, compressed)
+
+    def _remove_partial_files(self):
+        removed = 0
+        for directory, _, names in os.walk(self.upload_dir):
+            for name in names:
+                if PARTIAL_FILE.match(name):
+                    remove_quietly(os.path.join(directory, name))
+                    removed += 1
+        return removed
+
+    def loose_files(self):
+        return loose_files(self.upload_dir)
+
+    def import_loose_files(self, owner=None):
+        """Moves loose files into the blob store. Returns how many were imported.
+
+        A file that still has its catalog entry keeps that entry's ID and owner; any other file
+        is added for owner (None: visible to every user until claimed).
+        """
+        loose = self.loose_files()
+        for entry in loose:
+            stat = entry.stat(follow_symlinks=False)
+            sha256 = hash_file(entry.path)
+            existing = self.catalog.named(entry.name)
+            blob_path = self.blob_path(sha256)
+            with self.lock:
+                if os.path.exists(blob_path):
+                    os.remove(entry.path)
+                else:
+                    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                    os.replace(entry.path, blob_path)
+                    self.totals.blob_added(stat.st_size, stat.st_size, False)
+                _, _, released = self.catalog.add(entry.name, stat.st_size, stat.st_mtime,
+                                                  existing[0]['owner'] if existing else owner, sha256, replace=True)
+                self._release(released)
+        return len(loose)
+
+    def _scan_blobs(self):
+        found = set()
+        if not os.path.isdir(self.blob_dir):
+            return found  # nothing uploaded yet
+        with os.scandir(self.blob_dir) as shards:
+            for shard in shards:
+                if shard.name.startswith('.') or not shard.is_dir(follow_symlinks=False):
+                    continue
+                with os.scandir(shard.path) as blobs:
+                    found.update(blob.name for blob in blobs if not blob.name.startswith('.'))
+        return found
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import secrets
+import tempfile
+import time
+
+from compression import CompressingWriter
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # 1 MiB per write instead of 1 KiB
+DOWNLOAD_TIMEOUT = (15, 60)  # (connect, read between chunks) in seconds
+
+
+def download_to_temp(session, url, directory, chunk_size=DEFAULT_CHUNK_SIZE, compress_level=None):
+    """Streams url into a new hidden temp file in directory, hashing on the way.
+
+    With a compress_level, the file is gzipped as it is written unless its first bytes show
+    it is not worth it. Size and hash are always those of the uncompressed contents.
+    Returns (temp_path, size, sha256, seconds, compressed). The caller owns the temp file.
+    """
+    started = time.perf_counter()
+    sha256 = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.upload-', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f, session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            out = CompressingWriter(f, compress_level) if compress_level else f
+            for data in response.iter_content(chunk_size):
+                out.write(data)
+                sha256.update(data)
+                size += len(data)
+            if compress_level:
+                out.finish()
+    except BaseException:
+        remove_quietly(temp_path)
+        raise
+    compressed = bool(compress_level) and out.compressed
+    return temp_path, size, sha256.hexdigest(), time.perf_counter() - started, compressed
+
+
+class SizedFile:
+    """A file object to send whose size is known up front (len()), so the upload can be streamed.
+
+    Used for readers that cannot tell their own size cheaply, such as a decompressing one.
+    """
+
+    def __init__(self, file, size):
+        self.file = file
+        self.name = getattr(file, 'name', None)
+        self.remaining = size
+
+    def read(self, size=-1):
+        data = self.file.read(self.remaining if size is None or size < 0 else min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def __len__(self):
+        return self.remaining
+
+
+class MultipartStream:
+    """multipart/form-data body holding one file, read from it chunk by chunk as the body is sent.
+
+    requests' files= builds the whole body in memory before sending it; this is passed as data=
+    with its content_type instead. file must have a len() of the bytes it will yield, which
+    gives the body's Content-Length.
+    """
+
+    def __init__(self, field, file_name, file):
+        boundary = secrets.token_hex(16)
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        file_name = file_name.translate({10: '%0A', 13: '%0D', 34: '%22'})  # as requests quotes it
+        self.head = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{file_name}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n').encode()
+        self.tail = f'\r\n--{boundary}--\r\n'.encode()
+        self.file = file
+        self.file_size = len(file)
+        self.file_left = self.file_size
+        self.length = len(self.head) + self.file_size + len(self.tail)
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+        data = b''
+        if self.head:
+            data, self.head = self.head[:size], self.head[size:]
+        if len(data) < size and self.file_left:
+            chunk = self.file.read(min(size - len(data), self.file_left))
+            if not chunk:
+                raise IOError(f"file ended {self.file_left} bytes short of the {self.file_size} announced")
+            self.file_left -= len(chunk)
+            data += chunk
+        if len(data) < size and not self.file_left:
+            data, self.tail = data + self.tail[:size - len(data)], self.tail[size - len(data):]
+        return data
+
+
+def hash_file(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def throughput_mb_s(size, seconds):
+    return size / (1024 * 1024) / seconds if seconds > 0 else 0.0
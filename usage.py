@@ -0,0 +1,143 @@
+import logging
+import os
+import threading
+import time
+
+
+def scan_directory_size(directory):
+    """Total size of the regular files under directory, using the stat data os.scandir already has."""
+    total_size = 0
+    stack = [directory]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            total_size += entry.stat(follow_symlinks=False).st_size
+                    except FileNotFoundError:
+                        continue  # Removed while we were scanning
+        except FileNotFoundError:
+            continue
+    return total_size
+
+
+class UsageTracker:
+    """Running total of the bytes stored in a directory, kept up to date by the upload and delete paths."""
+
+    def __init__(self, directory, initial_size=0):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.used = initial_size
+        self.reserved = 0  # bytes promised to uploads that are still in flight
+        self.last_scan = None
+        self.scan_thread = None
+
+    def total(self):
+        with self.lock:
+            return self.used
+
+    def in_use(self):
+        """Bytes stored plus bytes reserved for uploads in flight."""
+        with self.lock:
+            return self.used + self.reserved
+
+    def reset(self, size):
+        with self.lock:
+            self.used = size
+
+    def add(self, delta):
+        with self.lock:
+            self.used += delta
+
+    def reserve(self, size, limit):
+        """Sets aside room for an upload. Returns False if it would not fit under limit."""
+        with self.lock:
+            if self.used + self.reserved + size > limit:
+                return False
+            self.reserved += size
+            return True
+
+    def release(self, size):
+        with self.lock:
+            self.reserved -= size
+
+    def rescan(self):
+        """Checks the running total against the filesystem and corrects any drift."""
+        with self.lock:
+            if self.reserved:
+                return None  # Partially written uploads would be counted, try again next pass
+        scanned = scan_directory_size(self.directory)
+        with self.lock:
+            if self.reserved:
+                return None
+            drift = scanned - self.used
+            self.used = scanned
+            self.last_scan = time.time()
+        if drift:
+            logging.warning(f"Usage counter for '{self.directory}' was off by {drift} bytes, corrected.")
+        return drift
+
+    def start_background_scan(self, interval):
+        """Starts a daemon thread that calls rescan() every interval seconds."""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.rescan()
+                except Exception as e:
+                    logging.error(f"Usage rescan of '{self.directory}' failed: {str(e)}")
+
+        self.scan_thread = threading.Thread(target=run, name='usage-scan', daemon=True)
+        self.scan_thread.start()
+
+
+class ContentTotals:
+    """Running totals over the stored contents for /storage, so it never has to sum the catalog.
+
+    Seeded from the catalog by FileStore.reconcile() and kept up to date by FileStore as blobs
+    come and go and files are pinned or unpinned.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.size = 0  # bytes of distinct content, before compression
+        self.compressed_count = 0
+        self.compressed_size = 0
+        self.compressed_stored = 0  # what the compressed ones take on disk
+        self.pinned = 0
+
+    def reset(self, size, compressed_count, compressed_size, compressed_stored, pinned):
+        with self.lock:
+            self.size = size
+            self.compressed_count = compressed_count
+            self.compressed_size = compressed_size
+            self.compressed_stored = compressed_stored
+            self.pinned = pinned
+
+    def blob_added(self, size, stored_size, compressed, sign=1):
+        with self.lock:
+            self.size += sign * size
+            if compressed:
+                self.compressed_count += sign
+                self.compressed_size += sign * size
+                self.compressed_stored += sign * stored_size
+
+    def blob_removed(self, size, stored_size, compressed):
+        self.blob_added(size, stored_size, compressed, sign=-1)
+
+    def pin(self, delta):
+        with self.lock:
+            self.pinned += delta
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'compressed_count': self.compressed_count,
+                'compressed_size': self.compressed_size,
+                'compressed_stored': self.compressed_stored,
+                'pinned': self.pinned,
+            }